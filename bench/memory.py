@@ -0,0 +1,40 @@
+# standard imports
+import sys
+import tracemalloc
+
+# local imports
+from shep import State
+from shep.compact import CompactState
+
+
+def populate(cls, n, time_index=False):
+    st = cls(3, time_index=time_index)
+    st.add('foo')
+    st.add('bar')
+    st.add('baz')
+    st.alias('xyzzy', st.FOO, st.BAR)
+    states = [st.NEW, st.FOO, st.BAR, st.XYZZY]
+    for i in range(n):
+        st.put(i, state=states[i % 4])
+    return st
+
+
+def bench(cls, n, time_index=False):
+    tracemalloc.start()
+    st = populate(cls, n, time_index=time_index)
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # per key cost over the keys actually held by the state, which also keeps it alive until measured.
+    return current / sum(st.count_by_state().values())
+
+
+if __name__ == '__main__':
+    sizes = [100000, 1000000]
+    if len(sys.argv) > 1:
+        sizes = [int(v) for v in sys.argv[1:]]
+    for n in sizes:
+        for time_index in [False, True]:
+            r = []
+            for cls in [State, CompactState]:
+                r.append(bench(cls, n, time_index=time_index))
+            print('keys {:>8} time index {:<5} State {:.1f} bytes/key CompactState {:.1f} bytes/key'.format(n, str(time_index), r[0], r[1]))
@@ -0,0 +1,38 @@
+# standard imports
+import time
+import sys
+
+# local imports
+from shep import State
+
+
+def populate(n):
+    st = State(3)
+    st.add('foo')
+    st.add('bar')
+    st.add('baz')
+    st.alias('xyzzy', st.FOO | st.BAR)
+    for i in range(n):
+        st.put(str(i), state=st.FOO)
+    return st
+
+
+def bench(st, n, rounds=1000):
+    step = max(n // rounds, 1)
+    keys = [str(i) for i in range(0, n, step)][:rounds]
+    t = time.perf_counter()
+    for k in keys:
+        st.move(k, st.BAR)
+        st.set(k, st.FOO)
+        st.unset(k, st.BAR)
+    return (time.perf_counter() - t) / (len(keys) * 3)
+
+
+if __name__ == '__main__':
+    sizes = [1000, 10000, 100000, 1000000]
+    if len(sys.argv) > 1:
+        sizes = [int(v) for v in sys.argv[1:]]
+    for n in sizes:
+        st = populate(n)
+        r = bench(st, n)
+        print('keys {:>8} move {:.2f} us'.format(n, r * 1000000))
@@ -0,0 +1,47 @@
+# standard imports
+import time
+import sys
+import tempfile
+import shutil
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+
+
+def populate(d, n):
+    factory = SimpleFileStoreFactory(d)
+    st = PersistedState(factory.add, 2)
+    st.add('foo')
+    st.add('bar')
+    for i in range(n):
+        st.put(str(i), state=st.FOO)
+    return st
+
+
+def bench_single(st, keys):
+    t = time.perf_counter()
+    for k in keys:
+        st.move(k, st.BAR)
+    return time.perf_counter() - t
+
+
+def bench_many(st, keys):
+    t = time.perf_counter()
+    st.move_many(keys, st.BAR)
+    return time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    sizes = [1000, 2000]
+    if len(sys.argv) > 1:
+        sizes = [int(v) for v in sys.argv[1:]]
+    for n in sizes:
+        keys = [str(i) for i in range(n)]
+        r = []
+        for f in [bench_single, bench_many]:
+            d = tempfile.mkdtemp()
+            st = populate(d, n)
+            r.append(f(st, keys))
+            shutil.rmtree(d)
+        print('keys {:>8} move {:.3f}s move_many {:.3f}s'.format(n, r[0], r[1]))
@@ -0,0 +1,54 @@
+# standard imports
+import os
+import time
+import sys
+import tempfile
+import shutil
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+
+
+# state names may only contain letters and underscores.
+def state_names(n):
+    r = []
+    for i in range(n):
+        r.append('s_' + chr(97 + (i // 26)) + chr(97 + (i % 26)))
+    return r
+
+
+def populate(d, states, items):
+    for k in state_names(states):
+        p = os.path.join(d, k.upper())
+        os.makedirs(p)
+        for i in range(items):
+            f = open(os.path.join(p, '{}_{}'.format(k, i)), 'w')
+            f.write(k)
+            f.close()
+
+
+def bench(d, states, workers):
+    factory = SimpleFileStoreFactory(d)
+    st = PersistedState(factory.add, states, sync_workers=workers)
+    for k in state_names(states):
+        st.add(k)
+    t = time.perf_counter()
+    st.sync()
+    r = time.perf_counter() - t
+    slowest = max(st.sync_timing.items(), key=lambda x: x[1])
+    return (r, slowest,)
+
+
+if __name__ == '__main__':
+    sizes = [(4, 1000), (16, 1000), (16, 5000)]
+    if len(sys.argv) > 2:
+        sizes = [(int(sys.argv[1]), int(sys.argv[2]))]
+    for (states, items) in sizes:
+        d = tempfile.mkdtemp()
+        populate(d, states, items)
+        r = []
+        for workers in [None, 4, 16]:
+            r.append(bench(d, states, workers))
+        shutil.rmtree(d)
+        print('states {:>4} items {:>6} serial {:.3f}s workers 4 {:.3f}s workers 16 {:.3f}s slowest state {} {:.3f}s'.format(states, items, r[0][0], r[1][0], r[2][0], r[0][1][0], r[0][1][1]))
@@ -0,0 +1,46 @@
+# standard imports
+import sys
+import time
+import tempfile
+import shutil
+import threading
+
+# local imports
+from shep.store.file import (
+        SimpleFileStoreFactory,
+        WRITE_FAST,
+        WRITE_ATOMIC,
+        WRITE_DURABLE,
+        )
+
+
+def bench(write_mode, threads, items, sync_interval=0.0):
+    d = tempfile.mkdtemp()
+    factory = SimpleFileStoreFactory(d, write_mode=write_mode, sync_interval=sync_interval)
+    store = factory.add('FOO')
+
+    def put(n):
+        for i in range(items):
+            store.put('foo{}_{}'.format(n, i), contents='foo')
+
+    ts = [threading.Thread(target=put, args=(n,)) for n in range(threads)]
+    t = time.perf_counter()
+    for v in ts:
+        v.start()
+    for v in ts:
+        v.join()
+    r = time.perf_counter() - t
+    shutil.rmtree(d)
+    return (r, factory.group_sync.syncs,)
+
+
+if __name__ == '__main__':
+    threads = 8
+    items = 200
+    if len(sys.argv) > 2:
+        threads = int(sys.argv[1])
+        items = int(sys.argv[2])
+    n = threads * items
+    for (write_mode, sync_interval) in [(WRITE_FAST, 0.0), (WRITE_ATOMIC, 0.0), (WRITE_DURABLE, 0.0), (WRITE_DURABLE, 0.005)]:
+        (r, syncs) = bench(write_mode, threads, items, sync_interval=sync_interval)
+        print('mode {:>8} interval {:.3f} writes {:>6} {:.3f}s {:>8.0f}/s directory syncs {}'.format(write_mode, sync_interval, n, r, n / r, syncs))
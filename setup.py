@@ -4,5 +4,6 @@ setup(
     extras_require={
         'redis': 'redis==3.5.3',
         'rocksdb': 'lbry-rocksdb==0.8.2',
+        'numpy': 'numpy>=1.17',
         },
         )
@@ -0,0 +1,132 @@
+# external imports
+import numpy
+
+
+class StateColumns:
+    """NumPy columns of the content keys of a state store, with their states and modification times.
+
+    Rows of keys that have been purged from a shep.compact.CompactState are left out.
+
+    :param state: State store to export
+    :type state: shep.state.State
+    """
+
+    def __init__(self, state):
+        (keys, states, modified) = state.columns()
+        n = len(keys)
+        self.keys = numpy.empty(n, dtype=object)
+        self.keys[:] = keys
+        self.states = numpy.fromiter(states, dtype=numpy.uint64, count=n)
+        self.modified = numpy.fromiter(modified, dtype=numpy.float64, count=n)
+        if n > 0:
+            live = numpy.not_equal(self.keys, None)
+            if not live.all():
+                self.keys = self.keys[live]
+                self.states = self.states[live]
+                self.modified = self.modified[live]
+        self.__now = state.now
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def ages(self, now=None):
+        """Return the number of seconds since the last modification of each key.
+
+        :param now: Timestamp to calculate ages from. If not set, the current time is used
+        :type now: float
+        :rtype: numpy.ndarray
+        :returns: Ages in seconds
+        """
+        if now == None:
+            now = self.__now()
+        return now - self.modified
+
+
+    def mask(self, state=None, required=0, forbidden=0):
+        """Return a boolean mask of the keys matching a state.
+
+        :param state: Exact state to match
+        :type state: int
+        :param required: Bits that must all be set
+        :type required: int
+        :param forbidden: Bits that must not be set
+        :type forbidden: int
+        :rtype: numpy.ndarray
+        :returns: Mask of matching keys
+        """
+        r = numpy.ones(len(self.keys), dtype=bool)
+        if state != None:
+            r &= self.states == numpy.uint64(state)
+        if required > 0:
+            required = numpy.uint64(required)
+            r &= (self.states & required) == required
+        if forbidden > 0:
+            r &= (self.states & numpy.uint64(forbidden)) == 0
+        return r
+
+
+    def histogram(self):
+        """Count the keys in each exact state.
+
+        :rtype: dict
+        :returns: Numeric state to number of keys
+        """
+        (values, counts) = numpy.unique(self.states, return_counts=True)
+        return dict(zip(values.tolist(), counts.tolist()))
+
+
+    def age_percentiles(self, percentiles=(50, 90, 99,), now=None):
+        """Calculate percentiles of the ages of keys, for each exact state.
+
+        :param percentiles: Percentiles to calculate, between 0 and 100
+        :type percentiles: tuple of float
+        :param now: Timestamp to calculate ages from. If not set, the current time is used
+        :type now: float
+        :rtype: dict
+        :returns: Numeric state to array of age percentiles in seconds
+        """
+        r = {}
+        if len(self.keys) == 0:
+            return r
+        ages = self.ages(now=now)
+        order = numpy.argsort(self.states, kind='stable')
+        states = self.states[order]
+        ages = ages[order]
+        (values, starts) = numpy.unique(states, return_index=True)
+        for (v, group) in zip(values.tolist(), numpy.split(ages, starts[1:])):
+            r[v] = numpy.percentile(group, percentiles)
+        return r
+
+
+    def stale(self, state, seconds, now=None):
+        """Return a boolean mask of the keys in a state that have not been modified for the given time.
+
+        :param state: Exact state to match
+        :type state: int
+        :param seconds: Minimum age in seconds
+        :type seconds: float
+        :param now: Timestamp to calculate ages from. If not set, the current time is used
+        :type now: float
+        :rtype: numpy.ndarray
+        :returns: Mask of stale keys
+        """
+        return self.mask(state=state) & (self.ages(now=now) > seconds)
+
+
+    def modified_per_hour(self, hours=24, now=None):
+        """Count the keys last modified within each hour before now.
+
+        Only the last modification of each key is known, so this counts the most recent transition of each key.
+
+        :param hours: Number of hours to count
+        :type hours: int
+        :param now: Timestamp to count from. If not set, the current time is used
+        :type now: float
+        :rtype: numpy.ndarray
+        :returns: Counts, where index 0 is the last hour
+        """
+        ages = self.ages(now=now)
+        ages = ages[(ages >= 0) & (ages < hours * 3600)]
+        return numpy.bincount((ages // 3600).astype(numpy.int64), minlength=hours)
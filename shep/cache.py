@@ -0,0 +1,110 @@
+# standard imports
+import sys
+from collections import OrderedDict
+
+
+def content_size(v):
+    if v == None:
+        return 0
+    if isinstance(v, (str, bytes,)):
+        return len(v)
+    return sys.getsizeof(v)
+
+
+class ContentCache:
+    """Least recently used cache of contents by content key, used by shep.persist.PersistedState to keep contents out of memory.
+
+    The cache is bounded by the number of entries, and optionally by the total size of the contents. The size of str and bytes contents is their length.
+
+    None is a valid cached value, meaning the key has no contents.
+
+    :param max_items: Maximum number of cached contents
+    :type max_items: int
+    :param max_size: Maximum total size of cached contents. If not set, only the number of entries is bounded
+    :type max_size: int
+    """
+
+    def __init__(self, max_items=1024, max_size=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.__entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self):
+        return len(self.__entries)
+
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+
+    def lookup(self, key):
+        """Look up the contents of a key, and mark it as most recently used.
+
+        :param key: Content key
+        :type key: str
+        :rtype: tuple
+        :returns: 0: True if the key is cached, 1: contents
+        """
+        try:
+            v = self.__entries[key]
+        except KeyError:
+            self.misses += 1
+            return (False, None,)
+        self.__entries.move_to_end(key)
+        self.hits += 1
+        return (True, v,)
+
+
+    def put(self, key, contents):
+        """Add or update the contents of a key, evicting the least recently used entries if the cache is full.
+
+        Contents larger than the maximum size are not cached.
+
+        :param key: Content key
+        :type key: str
+        :param contents: Contents
+        :type contents: any
+        """
+        self.remove(key)
+        size = content_size(contents)
+        if self.max_size != None and size > self.max_size:
+            return
+        self.__entries[key] = contents
+        self.size += size
+        while len(self.__entries) > self.max_items or (self.max_size != None and self.size > self.max_size):
+            (k, v) = self.__entries.popitem(last=False)
+            self.size -= content_size(v)
+            self.evictions += 1
+
+
+    def remove(self, key):
+        """Remove a key from the cache, if cached.
+
+        :param key: Content key
+        :type key: str
+        """
+        try:
+            v = self.__entries.pop(key)
+        except KeyError:
+            return
+        self.size -= content_size(v)
+
+
+    def metrics(self):
+        """Return the counters of the cache.
+
+        :rtype: dict
+        :returns: Number of entries, total size, hits, misses and evictions
+        """
+        return {
+            'items': len(self.__entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
@@ -0,0 +1,256 @@
+# standard imports
+import sys
+import array
+from collections.abc import MutableMapping
+
+# local imports
+from shep.state import State
+from shep.error import StateCorruptionError
+
+
+# scan a bitmap of 64 bit words, yielding the positions of the set bits.
+def scan_bitmap(bitmap):
+    for (i, w) in enumerate(bitmap):
+        if w == 0:
+            continue
+        base = i << 6
+        while w > 0:
+            low = w & -w
+            yield base + low.bit_length() - 1
+            w ^= low
+
+
+# a bitmap of 64 bit words as an integer, with the bit of id 0 lowest.
+def bitmap_to_int(bitmap):
+    if sys.byteorder == 'big':
+        bitmap = array.array('Q', bitmap)
+        bitmap.byteswap()
+    return int.from_bytes(bitmap.tobytes(), 'little')
+
+
+# an integer as a bitmap of the given number of 64 bit words.
+def int_to_bitmap(v, size):
+    bitmap = array.array('Q')
+    bitmap.frombytes(v.to_bytes(size * 8, 'little'))
+    if sys.byteorder == 'big':
+        bitmap.byteswap()
+    return bitmap
+
+
+class CompactModified(MutableMapping):
+    """Dict-like view of the modification times kept by shep.compact.CompactKeyIndex.
+
+    Provided as the modified_last attribute of states using the compact index.
+    """
+
+    def __init__(self, index):
+        self.__index = index
+
+
+    def __getitem__(self, key):
+        return self.__index.modified(key)
+
+
+    def __setitem__(self, key, ts):
+        self.__index.touch(key, ts)
+
+
+    def __delitem__(self, key):
+        raise TypeError('modification time is removed together with the key')
+
+
+    def __iter__(self):
+        return iter(self.__index.keys())
+
+
+    def __len__(self):
+        return len(self.__index)
+
+
+class CompactKeyIndex:
+    """Index of content keys by state, for very large numbers of keys.
+
+    Keys are interned to integer ids. The state and modification time of each key is kept in typed arrays indexed by id, and the keys of each exact state value are kept in a bitmap of 64 bit words indexed by id.
+
+    Lists of keys are in id order. Ids of purged keys are reused, so ordering is only the order of insertion as long as no keys are purged.
+
+    State values are limited to 64 bits.
+
+    See shep.index.KeyIndex for the interface.
+    """
+
+    def __init__(self):
+        self.__ids = {}
+        self.__keys = []
+        self.__free = []
+        self.__unlisted = {}
+        self.__states = array.array('Q')
+        self.__modified = array.array('d')
+        self.__bitmaps = {}
+        self.__counts = {}
+        self.modified_last = CompactModified(self)
+
+
+    def __len__(self):
+        return len(self.__ids)
+
+
+    def __id(self, key):
+        i = self.__ids.get(key)
+        if i != None:
+            return i
+        if len(self.__free) > 0:
+            i = self.__free.pop()
+            self.__keys[i] = key
+        else:
+            i = len(self.__keys)
+            self.__keys.append(key)
+            self.__states.append(0)
+            self.__modified.append(0.0)
+        self.__ids[key] = i
+        return i
+
+
+    # set or clear the bit for an id in the bitmap of an exact state value.
+    def __mark(self, state, i, on=True):
+        bitmap = self.__bitmaps.get(state)
+        if bitmap == None:
+            bitmap = array.array('Q')
+            self.__bitmaps[state] = bitmap
+        w = i >> 6
+        if w >= len(bitmap):
+            bitmap.extend([0] * (w + 1 - len(bitmap)))
+        if on:
+            bitmap[w] |= 1 << (i & 63)
+        else:
+            bitmap[w] &= ~(1 << (i & 63))
+
+
+    # bitmap of all ids listed for a state. For pure states, the bitmaps of all states including that bit are merged.
+    def __bitmap(self, state, parts):
+        if state == 0 or len(parts) != 1 or parts[0] != state:
+            bitmap = self.__bitmaps.get(state)
+            if bitmap == None:
+                return array.array('Q')
+            return array.array('Q', bitmap)
+        # merged as integers, so the words are combined in C rather than one by one.
+        r = 0
+        size = 0
+        for (k, bitmap) in self.__bitmaps.items():
+            if k & state == 0:
+                continue
+            r |= bitmap_to_int(bitmap)
+            if len(bitmap) > size:
+                size = len(bitmap)
+        return int_to_bitmap(r, size)
+
+
+    def keys(self):
+        """Return all keys known by the index.
+
+        :rtype: list of str
+        :returns: Keys
+        """
+        return list(self.__ids.keys())
+
+
+    def state(self, key):
+        i = self.__ids.get(key)
+        if i == None:
+            return self.__unlisted.get(key)
+        return self.__states[i]
+
+
+    def add(self, key, state, parts, listed=True):
+        if not listed:
+            self.__unlisted[key] = state
+            return
+        i = self.__id(key)
+        self.__states[i] = state
+        self.__mark(state, i)
+        self.__counts[state] = self.__counts.get(state, 0) + 1
+
+
+    def has(self, key, state, parts):
+        i = self.__ids.get(key)
+        if i == None:
+            return False
+        return self.__states[i] == state
+
+
+    def remove(self, key, state, parts):
+        if not self.has(key, state, parts):
+            raise StateCorruptionError(state)
+        i = self.__ids[key]
+        self.__mark(state, i, on=False)
+        self.__counts[state] -= 1
+
+
+    def forget(self, key):
+        i = self.__ids.pop(key)
+        self.__keys[i] = None
+        self.__states[i] = 0
+        self.__modified[i] = 0.0
+        self.__free.append(i)
+
+
+    def list(self, state, parts=None):
+        return list(self.members(state, parts=parts))
+
+
+    def members(self, state, parts=None):
+        if parts == None:
+            parts = self.__parts(state)
+        bitmap = self.__bitmap(state, parts)
+        return (self.__keys[i] for i in scan_bitmap(bitmap))
+
+
+    # the index does not know the schema, but pure states can be recognized from the value alone.
+    def __parts(self, state):
+        if state > 0 and state & (state - 1) == 0:
+            return (state,)
+        return ()
+
+
+    def size(self, state):
+        parts = self.__parts(state)
+        if len(parts) == 0:
+            return self.__counts.get(state, 0)
+        c = 0
+        for (k, v) in self.__counts.items():
+            if k & state > 0:
+                c += v
+        return c
+
+
+    def counts(self):
+        return self.__counts
+
+
+    def columns(self):
+        """Return the keys of the index with their states and modification times as columns.
+
+        The state and modification time columns are the typed arrays of the index, and include the slots of purged keys. Those slots have None in the key column.
+
+        :rtype: tuple
+        :returns: 0: list of keys, 1: array of states, 2: array of modification times, all in the same order
+        """
+        return (self.__keys, self.__states, self.__modified,)
+
+
+    def touch(self, key, ts):
+        self.__modified[self.__ids[key]] = ts
+
+
+    def modified(self, key):
+        return self.__modified[self.__ids[key]]
+
+
+class CompactState(State):
+    """State using shep.compact.CompactKeyIndex to keep the per key memory cost low.
+
+    The interface is the same as shep.state.State.
+    """
+
+    def __init__(self, bits, logger=None, verifier=None, check_alias=True, event_callback=None, default_state=None, time_index=False):
+        super(CompactState, self).__init__(bits, logger=logger, verifier=verifier, check_alias=check_alias, event_callback=event_callback, default_state=default_state, index=CompactKeyIndex(), time_index=time_index)
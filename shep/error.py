@@ -38,3 +38,12 @@ class StateLockedKey(Exception):
     """Attempt to write to a state key that is being written to by another client
     """
     pass
+
+
+class StateWriteError(Exception):
+    """Buffered store operations could not be written. The failed attribute maps each content key that failed to its error.
+    """
+
+    def __init__(self, failed):
+        super(StateWriteError, self).__init__('write failed for {} keys: {}'.format(len(failed), ', '.join(failed.keys())))
+        self.failed = failed
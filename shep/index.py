@@ -0,0 +1,375 @@
+# standard imports
+import bisect
+
+# local imports
+from shep.error import StateCorruptionError
+
+
+class KeyIndex:
+    """In-memory index of content keys by state, used by shep.state.State.
+
+    Each state list is a dict used as an insertion-ordered set, the values are unused.
+
+    A key is listed under every bit of its state. Keys in the zero state or in alias states are additionally listed under the exact state value. Thus, the list of a pure state also includes the keys of all aliases containing it.
+
+    The index has no knowledge of the state schema; the caller passes the bits (parts) of the state value along with it.
+    """
+
+    def __init__(self):
+        self.__states = {}
+        self.__unlisted = {}
+        self.__lists = {0: {}}
+        self.__counts = {}
+        self.modified_last = {}
+
+
+    def __len__(self):
+        return len(self.__states)
+
+
+    # true if the key should be listed under the exact state value, in addition to its bits.
+    def __listed(self, state, parts):
+        return state == 0 or len(parts) != 1 or parts[0] != state
+
+
+    def state(self, key):
+        """Return the state of a key.
+
+        :param key: Content key
+        :type key: str
+        :rtype: int
+        :returns: State, or None if the key is not known
+        """
+        r = self.__states.get(key)
+        if r == None:
+            return self.__unlisted.get(key)
+        return r
+
+
+    def add(self, key, state, parts, listed=True):
+        """Record a key for a state.
+
+        :param key: Content key
+        :type key: str
+        :param state: State value
+        :type state: int
+        :param parts: Bits of the state value
+        :type parts: tuple of int
+        :param listed: If False, only the state of the key is recorded, and the key will not appear in any list
+        :type listed: bool
+        """
+        if not listed:
+            self.__unlisted[key] = state
+            return
+        self.__states[key] = state
+        if self.__listed(state, parts):
+            if self.__lists.get(state) == None:
+                self.__lists[state] = {}
+            self.__lists[state][key] = None
+        self.__counts[state] = self.__counts.get(state, 0) + 1
+        for part in parts:
+            if self.__lists.get(part) == None:
+                self.__lists[part] = {}
+            self.__lists[part][key] = None
+
+
+    def has(self, key, state, parts):
+        """Check whether a key is recorded for the given state.
+
+        :rtype: bool
+        :returns: True if the key is listed for the state
+        """
+        if self.__listed(state, parts):
+            l = self.__lists.get(state)
+        else:
+            l = self.__lists.get(parts[0])
+        if l == None:
+            return False
+        return key in l
+
+
+    def remove(self, key, state, parts):
+        """Remove a key from the lists of a state.
+
+        The state of the key is left in place, and must be overwritten by add or removed by forget.
+
+        :raises StateCorruptionError: Key is not recorded for the state
+        """
+        if not self.has(key, state, parts):
+            raise StateCorruptionError(state)
+        if self.__listed(state, parts):
+            del self.__lists[state][key]
+        self.__counts[state] -= 1
+        for part in parts:
+            self.__lists[part].pop(key, None)
+
+
+    def forget(self, key):
+        """Remove all records of a key, after it has been removed from its state.
+        """
+        del self.__states[key]
+        try:
+            del self.modified_last[key]
+        except KeyError:
+            pass
+
+
+    def list(self, state):
+        """List the keys of a state.
+
+        :rtype: list of str
+        :returns: Keys in insertion order
+        """
+        l = self.__lists.get(state)
+        if l == None:
+            return []
+        return list(l)
+
+
+    def members(self, state):
+        """Return an iterable over the keys of a state, without copying.
+
+        :rtype: iterable
+        :returns: Keys in insertion order
+        """
+        return self.__lists.get(state, ())
+
+
+    def size(self, state):
+        """Return the number of keys listed for a state.
+
+        :rtype: int
+        :returns: Number of keys
+        """
+        return len(self.__lists.get(state, ()))
+
+
+    def counts(self):
+        """Return the number of keys in each exact state.
+
+        :rtype: dict
+        :returns: State value to number of keys
+        """
+        return self.__counts
+
+
+    def columns(self):
+        """Return the keys of the index with their states and modification times as columns.
+
+        Keys recorded with listed=False are not included.
+
+        :rtype: tuple
+        :returns: 0: list of keys, 1: iterable of states, 2: iterable of modification times, all in the same order
+        """
+        keys = list(self.__states.keys())
+        states = self.__states.values()
+        modified = map(self.modified_last.get, keys)
+        return (keys, states, modified,)
+
+
+    def touch(self, key, ts):
+        """Record the modification time of a key.
+        """
+        self.modified_last[key] = ts
+
+
+    def modified(self, key):
+        """Return the modification time of a key.
+
+        :raises KeyError: Key is not known
+        :rtype: float
+        :returns: Timestamp
+        """
+        return self.modified_last[key]
+
+
+class TimeList:
+    """Time-ordered list of key modifications.
+
+    Entries are never updated in place. A new entry is added for every modification, and entries superseded by later modifications are skipped when read, and dropped when the list is compacted.
+    """
+
+    def __init__(self):
+        self.ts = []
+        self.keys = []
+        self.head = 0
+
+
+    def __len__(self):
+        return len(self.ts) - self.head
+
+
+    def add(self, key, ts):
+        if len(self.ts) > 0 and ts < self.ts[-1]:
+            i = bisect.bisect_right(self.ts, ts, lo=self.head)
+            self.ts.insert(i, ts)
+            self.keys.insert(i, key)
+            return
+        self.ts.append(ts)
+        self.keys.append(key)
+
+
+    # drop entries before the head, and entries for which valid returns False.
+    def compact(self, valid):
+        ts = []
+        keys = []
+        for i in range(self.head, len(self.ts)):
+            if valid(self.keys[i], self.ts[i]):
+                ts.append(self.ts[i])
+                keys.append(self.keys[i])
+        self.ts = ts
+        self.keys = keys
+        self.head = 0
+
+
+    def since(self, ts, valid):
+        i = bisect.bisect_left(self.ts, ts, lo=self.head)
+        for i in range(i, len(self.ts)):
+            if valid(self.keys[i], self.ts[i]):
+                yield self.keys[i]
+
+
+    def oldest(self, n, valid):
+        r = []
+        i = self.head
+        while i < len(self.ts) and len(r) < n:
+            if valid(self.keys[i], self.ts[i]):
+                r.append(self.keys[i])
+            elif len(r) == 0:
+                self.head = i + 1
+            i += 1
+        if self.head > len(self.ts) // 2:
+            self.ts = self.ts[self.head:]
+            self.keys = self.keys[self.head:]
+            self.head = 0
+        return r
+
+
+class TimeIndex:
+    """Time-ordered index of key modifications, overall and for each exact state.
+
+    Used by shep.state.State to find keys modified since a point in time, and the least recently modified keys of a state.
+
+    :param state: Returns the current state of a key, or None if the key is not known
+    :type state: function
+    :param modified: Returns the current modification time of a key, or raises KeyError if the key is not known
+    :type modified: function
+    """
+
+    def __init__(self, state, modified):
+        self.__state = state
+        self.__modified = modified
+        self.__all = TimeList()
+        self.__by_state = {}
+
+
+    # an entry is valid if it records the current modification of the key, and the key is still in the state.
+    def __valid(self, key, ts, state=None):
+        try:
+            if self.__modified(key) != ts:
+                return False
+        except KeyError:
+            return False
+        if state == None:
+            return True
+        return self.__state(key) == state
+
+
+    def __valid_for(self, state):
+        def valid(key, ts):
+            return self.__valid(key, ts, state=state)
+        return valid
+
+
+    def __maybe_compact(self, l, live, valid):
+        if len(l) > (live * 2) + 64:
+            l.compact(valid)
+
+
+    def add(self, key, ts, state, live=0, live_state=0):
+        """Record a modification of a key.
+
+        :param key: Content key
+        :type key: str
+        :param ts: Modification time
+        :type ts: float
+        :param state: State of the key after the modification
+        :type state: int
+        :param live: Number of known keys, used to decide when to compact
+        :type live: int
+        :param live_state: Number of known keys in the state, used to decide when to compact
+        :type live_state: int
+        """
+        self.__all.add(key, ts)
+        l = self.__by_state.get(state)
+        if l == None:
+            l = TimeList()
+            self.__by_state[state] = l
+        l.add(key, ts)
+        self.__maybe_compact(self.__all, live, self.__valid)
+        self.__maybe_compact(l, live_state, self.__valid_for(state))
+
+
+    def rebuild(self, keys, states, modified):
+        """Replace the index with the given keys, states and modification times.
+
+        See shep.index.KeyIndex.columns
+        """
+        entries = []
+        for (key, state, ts) in zip(keys, states, modified):
+            if key == None or ts == None:
+                continue
+            entries.append((ts, key, state,))
+        entries.sort(key=lambda x: x[0])
+        self.__all = TimeList()
+        self.__by_state = {}
+        for (ts, key, state) in entries:
+            self.__all.ts.append(ts)
+            self.__all.keys.append(key)
+            l = self.__by_state.get(state)
+            if l == None:
+                l = TimeList()
+                self.__by_state[state] = l
+            l.ts.append(ts)
+            l.keys.append(key)
+
+
+    def since(self, ts, state=None):
+        """Return the keys modified at or after the given time, in order of modification.
+
+        :param ts: Timestamp
+        :type ts: float
+        :param state: If set, only return keys currently in this exact state
+        :type state: int
+        :rtype: list of str
+        :returns: Keys
+        """
+        if state == None:
+            l = self.__all
+        else:
+            l = self.__by_state.get(state)
+            if l == None:
+                return []
+        r = []
+        seen = {}
+        for key in l.since(ts, self.__valid_for(state)):
+            if seen.get(key) == None:
+                seen[key] = True
+                r.append(key)
+        return r
+
+
+    def oldest(self, state, n):
+        """Return the least recently modified keys currently in a state.
+
+        :param state: Exact state
+        :type state: int
+        :param n: Maximum number of keys to return
+        :type n: int
+        :rtype: list of str
+        :returns: Keys, least recently modified first
+        """
+        l = self.__by_state.get(state)
+        if l == None:
+            return []
+        return l.oldest(n, self.__valid_for(state))
@@ -0,0 +1,376 @@
+# standard imports
+import os
+import struct
+import threading
+import time
+import zlib
+import logging
+
+# local imports
+from shep.error import StateLockedKey
+from shep.snapshot import (
+        encode_value,
+        decode_value,
+        encode_string,
+        )
+
+logg = logging.getLogger(__name__)
+
+OP_PUT = 1
+OP_MOVE = 2
+OP_REPLACE = 3
+OP_BEGIN = 4
+
+header_format = '<II'
+entry_format = '<QBB'
+length_format = '<I'
+
+
+def encode_entry(seq, op, key, from_state, to_state, contents):
+    (typ, b) = encode_value(contents, allow_none=True)
+    body = struct.pack(entry_format, seq, op, typ)
+    body += encode_string(key)
+    body += encode_string(from_state)
+    body += encode_string(to_state)
+    body += struct.pack(length_format, len(b)) + b
+    return struct.pack(header_format, len(body), zlib.crc32(body)) + body
+
+
+def decode_entry(body):
+    (seq, op, typ) = struct.unpack_from(entry_format, body, 0)
+    offset = struct.calcsize(entry_format)
+    r = []
+    for i in range(4):
+        (l,) = struct.unpack_from(length_format, body, offset)
+        offset += struct.calcsize(length_format)
+        r.append(body[offset:offset+l])
+        offset += l
+    (key, from_state, to_state, contents) = r
+    return (seq, op, key.decode('utf-8'), from_state.decode('utf-8'), to_state.decode('utf-8'), decode_value(typ, contents),)
+
+
+class Journal:
+    """Append-only write-ahead journal of persisted state operations.
+
+    Entries are tuples of sequence number, operation, content key, from state name, to state name and contents. Operations are shep.journal.OP_PUT, shep.journal.OP_MOVE and shep.journal.OP_REPLACE.
+
+    Appending writes the entries to the journal file and waits until they have been synced to disk. Concurrent appends share a single fsync. Entries are then applied to the stores by a background thread, which only applies entries once they have been synced. The sequence number of the last applied entry is recorded in a separate file, which is synced to disk together with its directory. Entries that were not applied when the journal was last closed are replayed when the journal is started.
+
+    Replayed entries may already have been applied before a crash, so failing replayed entries are logged and skipped. If a new entry fails to apply, the background thread stops. The entry and all entries after it are not recorded as applied, so they are replayed when the journal is started again. The error is kept in the failure attribute, and is raised by shep.journal.Journal.drain and shep.journal.Journal.close.
+
+    Entries appended as atomic are preceded by a shep.journal.OP_BEGIN entry with the number of entries in the group as contents. If the journal ends before all entries of a group, the whole group is cut off, so that a group is either replayed completely or not at all.
+
+    A journal started without background apply only writes entries. The caller applies them, and records them as applied with shep.journal.Journal.mark. Entries are still replayed when the journal is started.
+
+    When all entries are applied and the journal file exceeds checkpoint_size bytes, the journal file is truncated.
+
+    :param path: Journal file
+    :type path: str
+    :param sync: Sync the journal file to disk before an append returns
+    :type sync: bool
+    :param checkpoint_size: Journal file size in bytes after which it is truncated when fully applied
+    :type checkpoint_size: int
+    :param lock_retries: Number of times to retry an entry for which the store reports a locked key
+    :type lock_retries: int
+    """
+
+    def __init__(self, path, sync=True, checkpoint_size=1 << 20, lock_retries=100):
+        self.path = path
+        self.applied_path = path + '.applied'
+        self.__do_sync = sync
+        self.__checkpoint_size = checkpoint_size
+        self.__lock_retries = lock_retries
+        self.__lock = threading.Lock()
+        self.__sync_lock = threading.Lock()
+        self.__cond = threading.Condition()
+        self.__queue = []
+        self.__thread = None
+        self.__closing = False
+        self.__apply = None
+        self.__background = True
+
+        self.applied = self.__read_applied()
+        self.pending = self.__read()
+        self.seq = self.applied
+        if len(self.pending) > 0:
+            self.seq = max(self.seq, self.pending[-1][0])
+        self.durable = self.seq
+        self.syncs = 0
+        self.errors = 0
+        self.failure = None
+
+        self.__f = open(self.path, 'ab')
+
+
+    def __read_applied(self):
+        try:
+            f = open(self.applied_path, 'r')
+        except FileNotFoundError:
+            return 0
+        v = f.read()
+        f.close()
+        if len(v) == 0:
+            return 0
+        return int(v)
+
+
+    # read the entries not yet applied. a torn or corrupt entry ends the journal, and is cut off.
+    def __read(self):
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return []
+        b = f.read()
+        f.close()
+
+        r = []
+        group = []
+        remaining = 0
+        offset = 0
+        end = 0
+        l = struct.calcsize(header_format)
+        while offset + l <= len(b):
+            (size, crc) = struct.unpack_from(header_format, b, offset)
+            body = b[offset+l:offset+l+size]
+            if len(body) < size or zlib.crc32(body) != crc:
+                break
+            entry = decode_entry(body)
+            offset += l + size
+            if entry[1] == OP_BEGIN:
+                remaining = entry[5]
+                continue
+            group.append(entry)
+            if remaining > 0:
+                remaining -= 1
+            if remaining == 0:
+                r += [v for v in group if v[0] > self.applied]
+                group = []
+                end = offset
+
+        if end < len(b):
+            logg.warning('journal {} truncated at {} of {} bytes'.format(self.path, end, len(b)))
+            os.truncate(self.path, end)
+        return r
+
+
+    def __write_applied(self, seq):
+        tmp_path = self.applied_path + '.tmp'
+        f = open(tmp_path, 'w')
+        f.write(str(seq))
+        if self.__do_sync:
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        os.replace(tmp_path, self.applied_path)
+        if self.__do_sync:
+            self.__sync_dir()
+        self.applied = seq
+
+
+    # sync the directory of the journal, so that renames in it are durable.
+    def __sync_dir(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.applied_path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def start(self, apply, background=True):
+        """Replay the entries that were not applied, and start applying new entries in the background.
+
+        :param apply: Function applying a single entry to the stores
+        :type apply: function
+        :param background: Apply new entries in a background thread. If not set, the caller applies them and calls shep.journal.Journal.mark
+        :type background: bool
+        """
+        self.__apply = apply
+        self.__background = background
+        for entry in self.pending:
+            try:
+                self.__apply_entry(entry)
+            except Exception as e:
+                logg.warning('skip replayed journal entry {}: {}'.format(entry[0], e))
+        if len(self.pending) > 0:
+            self.__write_applied(self.pending[-1][0])
+            self.pending = []
+        if not background:
+            return
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+
+    def __apply_entry(self, entry):
+        i = 0
+        while True:
+            try:
+                return self.__apply(entry)
+            except StateLockedKey as e:
+                i += 1
+                if i > self.__lock_retries:
+                    raise e
+                time.sleep(0.01)
+
+
+    def append(self, entries, atomic=False):
+        """Write entries to the journal and queue them for applying.
+
+        With sync, the entries are not applied before they have been synced to disk.
+
+        :param entries: Operation, content key, from state name, to state name and contents tuples
+        :type entries: list of tuple
+        :param atomic: Replay the entries only if all of them were written
+        :type atomic: bool
+        :raises ValueError: Contents cannot be represented in the journal
+        :rtype: int
+        :returns: Sequence number of the last entry
+        """
+        b = b''
+        seq_entries = []
+        with self.__lock:
+            seq = self.seq
+            if atomic and len(entries) > 1:
+                seq += 1
+                b += encode_entry(seq, OP_BEGIN, '', '', '', len(entries))
+            for (op, key, from_state, to_state, contents) in entries:
+                seq += 1
+                b += encode_entry(seq, op, key, from_state, to_state, contents)
+                seq_entries.append((seq, op, key, from_state, to_state, contents,))
+            self.__f.write(b)
+            self.seq = seq
+            if self.__background and self.failure == None:
+                with self.__cond:
+                    self.__queue += seq_entries
+                    self.__cond.notify_all()
+        if self.__do_sync:
+            self.commit(seq)
+        return seq
+
+
+    def commit(self, seq=None):
+        """Sync the journal file to disk, up to and including the given sequence number.
+
+        If another thread is already syncing, the call waits for it and only syncs again if the entry was not covered.
+
+        :param seq: Sequence number. If not set, all entries are synced
+        :type seq: int
+        """
+        if seq == None:
+            seq = self.seq
+        with self.__sync_lock:
+            if self.durable >= seq:
+                return
+            with self.__lock:
+                self.__f.flush()
+                seq = self.seq
+            os.fsync(self.__f.fileno())
+            with self.__cond:
+                self.durable = seq
+                self.__cond.notify_all()
+            self.syncs += 1
+
+
+    def mark(self, seq):
+        """Record that the entries up to and including the given sequence number have been applied, for a journal started without background apply.
+
+        :param seq: Sequence number
+        :type seq: int
+        """
+        with self.__cond:
+            self.__write_applied(seq)
+            self.__cond.notify_all()
+        self.__checkpoint()
+
+
+    # number of queued entries that may be applied. with sync, only entries that have been synced to disk are applied.
+    def __ready(self):
+        if not self.__do_sync or len(self.__queue) == 0 or self.__queue[-1][0] <= self.durable:
+            return len(self.__queue)
+        i = 0
+        for entry in self.__queue:
+            if entry[0] > self.durable:
+                break
+            i += 1
+        return i
+
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while True:
+                    if self.__closing:
+                        c = len(self.__queue)
+                        break
+                    c = self.__ready()
+                    if c > 0:
+                        break
+                    self.__cond.wait()
+                if c == 0:
+                    return
+                entries = self.__queue[:c]
+                self.__queue = self.__queue[c:]
+
+            last = None
+            failure = None
+            for entry in entries:
+                try:
+                    self.__apply_entry(entry)
+                except Exception as e:
+                    self.errors += 1
+                    logg.error('journal entry {} failed, stopping apply: {}'.format(entry[0], e))
+                    failure = e
+                    break
+                last = entry[0]
+
+            with self.__cond:
+                if last != None:
+                    self.__write_applied(last)
+                if failure != None:
+                    self.failure = failure
+                    self.__queue = []
+                self.__cond.notify_all()
+            if failure != None:
+                return
+            self.__checkpoint()
+
+
+    # truncate the journal file when all entries are applied.
+    def __checkpoint(self):
+        with self.__lock:
+            if self.applied != self.seq:
+                return
+            self.__f.flush()
+            if self.__f.tell() < self.__checkpoint_size:
+                return
+            self.__f.truncate(0)
+            self.__f.seek(0)
+
+
+    def drain(self):
+        """Wait until all entries appended so far have been applied.
+
+        :raises Exception: Applying an entry failed. The error of the entry is raised
+        """
+        seq = self.seq
+        with self.__cond:
+            while self.applied < seq and self.failure == None and self.__thread != None and self.__thread.is_alive():
+                self.__cond.wait()
+        if self.failure != None:
+            raise self.failure
+
+
+    def close(self):
+        """Sync and apply all entries, stop the background thread and close the journal file.
+
+        :raises Exception: Applying an entry failed. The error of the entry is raised after the journal file is closed
+        """
+        self.commit()
+        if self.__thread != None:
+            with self.__cond:
+                self.__closing = True
+                self.__cond.notify_all()
+            self.__thread.join()
+            self.__thread = None
+        self.__f.close()
+        if self.failure != None:
+            raise self.failure
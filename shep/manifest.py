@@ -0,0 +1,69 @@
+# standard imports
+import json
+import hashlib
+
+# local imports
+from shep.error import StateCorruptionError
+
+version = 1
+
+
+def digest(schema):
+    """Calculate a digest of a schema, that is the same for equal schemas regardless of the order states were added in.
+
+    :param schema: Schema, as returned by shep.state.State.schema
+    :type schema: dict
+    :rtype: str
+    :returns: Hex digest
+    """
+    v = {
+        'bits': schema['bits'],
+        'default': schema['default'],
+        'states': sorted([[k, v] for (k, v) in schema['states']], key=lambda x: x[1]),
+        }
+    b = json.dumps(v, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(b).hexdigest()
+
+
+def encode(schema, serial=0):
+    """Serialize a schema to a manifest.
+
+    :param schema: Schema, as returned by shep.state.State.schema
+    :type schema: dict
+    :param serial: Number of times the manifest has been written, incremented by the caller
+    :type serial: int
+    :rtype: bytes
+    :returns: Manifest
+    """
+    v = {
+        'version': version,
+        'serial': serial,
+        'digest': digest(schema),
+        'bits': schema['bits'],
+        'default': schema['default'],
+        'states': [[k, v] for (k, v) in schema['states']],
+        }
+    return json.dumps(v, sort_keys=True).encode('utf-8')
+
+
+def decode(b):
+    """Parse a manifest.
+
+    The returned dict can be passed as a schema to shep.state.State.apply_schema, and also has the manifest version, serial and digest.
+
+    :param b: Manifest
+    :type b: bytes
+    :raises StateCorruptionError: Manifest is invalid, of an unknown version, or does not match its digest
+    :rtype: dict
+    :returns: Manifest
+    """
+    try:
+        v = json.loads(b)
+    except ValueError as e:
+        raise StateCorruptionError('invalid manifest: {}'.format(e))
+    if v.get('version') != version:
+        raise StateCorruptionError('unknown manifest version {}'.format(v.get('version')))
+    v['states'] = [(k, s,) for (k, s) in v['states']]
+    if digest(v) != v['digest']:
+        raise StateCorruptionError('manifest does not match digest {}'.format(v['digest']))
+    return v
@@ -1,5 +1,8 @@
 # standard imports
-import datetime
+import contextlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # local imports
 from .state import (
@@ -8,9 +11,22 @@ from .state import (
         )
 from .error import (
         StateItemExists,
+        StateItemNotFound,
         StateLockedKey,
         StateExists,
         )
+from .journal import (
+        OP_PUT,
+        OP_MOVE,
+        OP_REPLACE,
+        )
+from .manifest import (
+        encode as encode_manifest,
+        decode as decode_manifest,
+        digest as schema_digest,
+        )
+
+logg = logging.getLogger(__name__)
 
 
 class PersistedState(State):
@@ -22,13 +38,143 @@ class PersistedState(State):
     :type bits: int
     :param logger: Logger to capture logging output, or None for no logging.
     :type logger: object
+    :param index: Index to record content keys and their states in. Passed to the superclass.
+    :type index: shep.index.KeyIndex
+    :param journal: If set, store operations are written to the journal and applied to the stores in the background. Unapplied operations in the journal are replayed on construction.
+    :type journal: shep.journal.Journal
+    :param write_behind: If set, store operations are buffered, coalesced and written to the stores in the background. Cannot be combined with a journal.
+    :type write_behind: shep.writebehind.WriteBehind
+    :param sync_workers: If set, sync lists and reads the state stores concurrently with this number of threads.
+    :type sync_workers: int
+    :param lazy: If set, the store of a state is synced the first time the state is listed, counted or queried, and keys not known in memory are looked up in the stores of the states not yet synced.
+    :type lazy: bool
+    :param cache: If set, contents are not kept in memory with the keys. Contents are read from the stores through the cache instead.
+    :type cache: shep.cache.ContentCache
+    :param time_index: Keep a time index of modifications. Passed to the superclass.
+    :type time_index: bool
+    :param tx_journal: If set, the store operations of a transaction are written to this journal before they are performed, for stores without a batch method. Transactions interrupted by a crash are completed from the journal on construction. Cannot be combined with a journal or write behind buffer.
+    :type tx_journal: shep.journal.Journal
+    :raises ValueError: Both journal and write behind buffer are given, or a transaction journal is given with either
     """
 
-    def __init__(self, factory, bits, logger=None, verifier=None, check_alias=True, event_callback=None, default_state=None):
-        super(PersistedState, self).__init__(bits, logger=logger, verifier=verifier, check_alias=check_alias, event_callback=event_callback, default_state=default_state)
+    def __init__(self, factory, bits, logger=None, verifier=None, check_alias=True, event_callback=None, default_state=None, index=None, journal=None, write_behind=None, sync_workers=None, lazy=False, cache=None, tx_journal=None, time_index=False):
+        if journal != None and write_behind != None:
+            raise ValueError('journal and write behind cannot be combined')
+        if tx_journal != None and (journal != None or write_behind != None):
+            raise ValueError('transaction journal cannot be combined with journal or write behind')
+        super(PersistedState, self).__init__(bits, logger=logger, verifier=verifier, check_alias=check_alias, event_callback=event_callback, default_state=default_state, index=index, time_index=time_index)
         self.__store_factory = factory
         self.__stores = {}
         self.__ensure_store(self.base_state_name)
+        self.__journal = journal
+        if self.__journal != None:
+            self.__journal.start(self.__apply_entry)
+        self.__tx_journal = tx_journal
+        if self.__tx_journal != None:
+            self.__tx_journal.start(self.__apply_entry, background=False)
+        self.__write_behind = write_behind
+        if self.__write_behind != None:
+            self.__write_behind.start(self.__write_batch)
+        self.__tx = None
+        self.__tx_undo = None
+        self.__markers = {}
+        self.__sync_workers = sync_workers
+        self.sync_timing = {}
+        self.sync_chunk_size = 1000
+        self.__lazy = lazy
+        self.__loaded = {}
+        self.__cache = cache
+        self.__unloaded = set()
+        self.__manifest_factory = None
+        self.manifest_serial = None
+
+
+    @classmethod
+    def from_manifest(cls, store_factory, **kwargs):
+        """Create a persisted state with the schema of the manifest stored through a store factory, instead of adding the states and aliases again.
+
+        The stores are not listed. Call sync to load the keys.
+
+        The store factory is remembered, and is used by default by shep.persist.PersistedState.write_manifest and shep.persist.PersistedState.manifest_drift.
+
+        :param store_factory: Store factory the manifest was written with
+        :type store_factory: shep.store.base.StoreFactory
+        :param kwargs: Other arguments to the constructor, except factory, bits and default_state
+        :type kwargs: dict
+        :raises FileNotFoundError: No manifest has been stored
+        :raises StateCorruptionError: Manifest is invalid
+        :rtype: shep.persist.PersistedState
+        :returns: Persisted state
+        """
+        b = store_factory.get_manifest()
+        if b == None:
+            raise FileNotFoundError('no manifest stored')
+        manifest = decode_manifest(b)
+        default_state = None
+        if manifest['default'] != cls.base_state_name:
+            default_state = manifest['default']
+        o = cls(store_factory.add, manifest['bits'], default_state=default_state, **kwargs)
+        o.apply_schema(manifest)
+        o.__manifest_factory = store_factory
+        o.manifest_serial = manifest['serial']
+        return o
+
+
+    def __manifest_store(self, store_factory):
+        if store_factory == None:
+            store_factory = self.__manifest_factory
+        if store_factory == None:
+            raise ValueError('no store factory for manifest')
+        return store_factory
+
+
+    def write_manifest(self, store_factory=None):
+        """Store the current schema as the manifest, replacing any previous manifest.
+
+        The serial of the manifest is one more than the serial of the manifest it replaces.
+
+        :param store_factory: Store factory to write the manifest with. If not set, the factory the state was created from with shep.persist.PersistedState.from_manifest is used
+        :type store_factory: shep.store.base.StoreFactory
+        :raises ValueError: No store factory given, and state was not created from a manifest
+        :rtype: int
+        :returns: Serial of the manifest written
+        """
+        store_factory = self.__manifest_store(store_factory)
+        serial = 0
+        b = store_factory.get_manifest()
+        if b != None:
+            serial = decode_manifest(b)['serial'] + 1
+        store_factory.put_manifest(encode_manifest(self.schema(), serial=serial))
+        self.manifest_serial = serial
+        return serial
+
+
+    def manifest_drift(self, store_factory=None, apply=False):
+        """Check whether the schema differs from the stored manifest, for example because another process has added states.
+
+        Only the digests of the schemas are compared.
+
+        :param store_factory: Store factory to read the manifest with. If not set, the factory the state was created from with shep.persist.PersistedState.from_manifest is used
+        :type store_factory: shep.store.base.StoreFactory
+        :param apply: If set, add the states and aliases of the manifest that are not registered.
+        :type apply: bool
+        :raises ValueError: No store factory given, and state was not created from a manifest
+        :raises StateCorruptionError: Manifest conflicts with the registered states, when applying
+        :rtype: bool
+        :returns: True if the schema differs from the manifest, after applying it if apply is set
+        """
+        store_factory = self.__manifest_store(store_factory)
+        b = store_factory.get_manifest()
+        if b == None:
+            return True
+        manifest = decode_manifest(b)
+        if manifest['digest'] == schema_digest(self.schema()):
+            return False
+        if not apply:
+            return True
+        self.apply_schema(manifest)
+        self.manifest_serial = manifest['serial']
+        return manifest['digest'] != schema_digest(self.schema())
 
 
     # Create state store container if missing.
@@ -47,11 +193,76 @@ class PersistedState(State):
 
         self.__ensure_store(k)
 
+        # a key may exist in the store of a state not synced yet.
+        if self.__lazy:
+            try:
+                self.state(key)
+                raise StateItemExists(key)
+            except StateItemNotFound:
+                pass
+
+        if self.__tx != None:
+            super(PersistedState, self).put(key, state=state, contents=self.__memory_contents(contents))
+            self.__cache_put(key, contents)
+            self.__stage(key, None, k, contents=contents, dirty=True)
+            return
+
+        if self.__journal != None:
+            super(PersistedState, self).put(key, state=state, contents=self.__memory_contents(contents))
+            try:
+                self.__journal.append([(OP_PUT, key, '', k, contents,)])
+            except Exception as e:
+                self.purge(key)
+                raise e
+            self.__cache_put(key, contents)
+            return
+
+        if self.__write_behind != None:
+            super(PersistedState, self).put(key, state=state, contents=self.__memory_contents(contents))
+            self.__cache_put(key, contents)
+            self.__write_behind.put(key, k, contents)
+            return
+
         self.__stores[k].put(key, contents)
 
-        super(PersistedState, self).put(key, state=state, contents=contents)
+        super(PersistedState, self).put(key, state=state, contents=self.__memory_contents(contents))
+        self.__cache_put(key, contents)
+
+
+    # contents to keep in memory with the key. none if contents are cached instead.
+    def __memory_contents(self, contents):
+        if self.__cache != None:
+            return None
+        return contents
+
+
+    def __cache_put(self, key, contents):
+        if self.__cache != None:
+            self.__cache.put(key, contents)
+
+
+    def load(self, key, state, contents=None):
+        """Record the state and contents of a key as found in a backend.
+
+        If a content cache is used, the contents are added to the cache instead of memory.
+
+        See shep.state.State.load
+        """
+        r = super(PersistedState, self).load(key, state, contents=self.__memory_contents(contents))
+        self.__cache_put(key, contents)
+        self.__unloaded.discard(key)
+        return r
+
+
+    def purge(self, key):
+        """Remove a key from memory, without removing it from the stores.
 
-        self.register_modify(key)
+        See shep.state.State.purge
+        """
+        super(PersistedState, self).purge(key)
+        self.__unloaded.discard(key)
+        if self.__cache != None:
+            self.__cache.remove(key)
 
 
     def set(self, key, or_state):
@@ -68,11 +279,8 @@ class PersistedState(State):
         k_to = self.name(to_state)
         self.__ensure_store(k_to)
 
-        contents = None
         try:
-            contents = self.__stores[k_from].get(key)
-            self.__stores[k_to].put(key, contents)
-            self.__stores[k_from].remove(key)
+            self.__move_key(k_from, k_to, key)
         except StateLockedKey as e:
             super(PersistedState, self).unset(key, or_state, allow_base=True)
             raise e
@@ -95,9 +303,7 @@ class PersistedState(State):
         k_to = self.name(to_state)
         self.__ensure_store(k_to)
 
-        contents = self.__stores[k_from].get(key)
-        self.__stores[k_to].put(key, contents)
-        self.__stores[k_from].remove(key)
+        self.__move_key(k_from, k_to, key)
 
         return to_state
 
@@ -115,11 +321,7 @@ class PersistedState(State):
         k_to = self.name(to_state)
         self.__ensure_store(k_to)
 
-        contents = self.__stores[k_from].get(key)
-        self.__stores[k_to].put(key, contents)
-        self.__stores[k_from].remove(key)
-
-        self.register_modify(key)
+        self.__move_key(k_from, k_to, key)
 
         return to_state
 
@@ -154,27 +356,553 @@ class PersistedState(State):
 
         self.__ensure_store(k_to)
 
-        contents = self.__stores[k_from].get(key)
-        self.__stores[k_to].put(key, contents)
-        self.__stores[k_from].remove(key)
+        self.__move_key(k_from, k_to, key)
 
         self.__ensure_parts(to_state)
 
-        self.register_modify(key)
-
-        self.sync(to_state)
+        if not self.__deferred():
+            self.sync(to_state)
 
         return to_state
 
 
+    # common procedure for moving several persisted resources, grouped by source and target state.
+    # keys for which the store operations fail are moved back to their original state in memory.
+    def __movestore_many(self, moved, from_states, failed):
+        groups = {}
+        for (key, to_state) in moved.items():
+            k = (from_states[key], to_state,)
+            if groups.get(k) == None:
+                groups[k] = []
+            groups[k].append(key)
+
+        if self.__deferred():
+            return self.__defer_many(groups, moved, failed)
+
+        to_states = []
+        for ((from_state, to_state), keys) in groups.items():
+            k_from = self.name(from_state)
+            k_to = self.name(to_state)
+            self.__ensure_store(k_to)
+            store_from = self.__stores[k_from]
+            store_to = self.__stores[k_to]
+
+            # a native move never reads the contents, and is always preferred over copy and remove.
+            if getattr(store_from, 'move_keys', None) != None:
+                # keys known to have no contents are moved without reading them.
+                empty = []
+                full = []
+                for key in keys:
+                    if self.__contents_empty(key):
+                        empty.append(key)
+                    else:
+                        full.append(key)
+                r = {}
+                if len(empty) > 0:
+                    r.update(store_from.move_keys(empty, store_to, contents=False))
+                if len(full) > 0:
+                    r.update(store_from.move_keys(full, store_to))
+                for (key, e) in r.items():
+                    self.__undo_move(key, from_state)
+                    del moved[key]
+                    failed[key] = e
+            elif getattr(store_from, 'move', None) != None:
+                for key in keys:
+                    try:
+                        store_from.move(key, store_to)
+                    except Exception as e:
+                        self.__undo_move(key, from_state)
+                        del moved[key]
+                        failed[key] = e
+            else:
+                items = []
+                for (key, contents) in self.__store_get_many(store_from, keys):
+                    if isinstance(contents, Exception):
+                        self.__undo_move(key, from_state)
+                        del moved[key]
+                        failed[key] = contents
+                        continue
+                    items.append((key, contents,))
+
+                self.__store_put_many(store_to, items)
+                self.__store_remove_many(store_from, [v[0] for v in items])
+
+            if to_state not in to_states:
+                to_states.append(to_state)
+
+        for to_state in to_states:
+            self.__ensure_parts(to_state)
+            self.sync(to_state)
+
+        return (moved, failed,)
+
+
+    # put a key back in its state in memory after its store operation failed, without running the verifier or event callback.
+    def __undo_move(self, key, state):
+        super(PersistedState, self).load(key, state, contents=super(PersistedState, self).get(key))
+
+
+    # hand the moves of several keys to the journal with a single commit, or to the write behind buffer.
+    def __defer_many(self, groups, moved, failed):
+        entries = []
+        for ((from_state, to_state), keys) in groups.items():
+            k_from = self.name(from_state)
+            k_to = self.name(to_state)
+            self.__ensure_store(k_to)
+            self.__ensure_parts(to_state)
+            for key in keys:
+                entries.append((OP_MOVE, key, k_from, k_to, None,))
+        if self.__tx != None:
+            for entry in entries:
+                self.__stage(entry[1], entry[2], entry[3], before=(self.from_name(entry[2]), self.get(entry[1]),))
+        elif self.__write_behind != None:
+            for entry in entries:
+                self.__write_behind.move(entry[1], entry[2], entry[3])
+        elif len(entries) > 0:
+            self.__journal.append(entries)
+        return (moved, failed,)
+
+
+    # move a key between the stores of two states, through the journal or write behind buffer if one is used.
+    def __move_key(self, k_from, k_to, key):
+        if self.__tx != None:
+            self.__stage(key, k_from, k_to, before=(self.from_name(k_from), self.get(key),))
+            return
+        if self.__journal != None:
+            self.__journal.append([(OP_MOVE, key, k_from, k_to, None,)])
+            return
+        if self.__write_behind != None:
+            self.__write_behind.move(key, k_from, k_to)
+            return
+        self.__store_move(self.__stores[k_from], self.__stores[k_to], key, empty=self.__contents_empty(key))
+
+
+    # apply a journal entry to the stores.
+    def __apply_entry(self, entry):
+        (seq, op, key, k_from, k_to, contents) = entry
+        self.__ensure_store(k_to)
+        if op == OP_PUT:
+            self.__stores[k_to].put(key, contents)
+        elif op == OP_MOVE:
+            self.__ensure_store(k_from)
+            self.__store_move(self.__stores[k_from], self.__stores[k_to], key)
+        elif op == OP_REPLACE:
+            self.__stores[k_to].replace(key, contents)
+        else:
+            raise ValueError('unknown journal operation {}'.format(op))
+
+
+    # write a batch of coalesced operations from the write behind buffer to the stores.
+    # moves are grouped by source and target state, and use the batch operations of the stores where available.
+    def __write_batch(self, entries):
+        groups = {}
+        for (key, entry) in entries.items():
+            k = (entry[0], entry[1],)
+            if groups.get(k) == None:
+                groups[k] = []
+            groups[k].append((key, entry[2], entry[3],))
+
+        failed = {}
+        for ((k_from, k_to), items) in groups.items():
+            try:
+                self.__write_group(k_from, k_to, items, failed)
+            except Exception as e:
+                for item in items:
+                    failed[item[0]] = e
+        return failed
+
+
+    # write the operations of a write behind group, and record only the keys that failed.
+    def __write_group(self, k_from, k_to, items, failed):
+        self.__ensure_store(k_to)
+        store_to = self.__stores[k_to]
+        put = lambda v: self.__store_put_many(store_to, v)
+        if k_from == None:
+            self.__write_each(put, [(key, contents,) for (key, contents, dirty) in items], failed)
+            return
+        if k_from == k_to:
+            self.__write_each(put, [(key, contents,) for (key, contents, dirty) in items if dirty], failed)
+            return
+
+        self.__ensure_store(k_from)
+        store_from = self.__stores[k_from]
+        if getattr(store_from, 'move_keys', None) != None:
+            moved = self.__write_each(lambda v: store_from.move_keys(v, store_to), [v[0] for v in items], failed, key=lambda v: v)
+            moved = set(moved)
+            self.__write_each(put, [(key, contents,) for (key, contents, dirty) in items if dirty and key in moved], failed)
+            return
+        if getattr(store_from, 'move', None) != None:
+            for (key, contents, dirty) in items:
+                try:
+                    store_from.move(key, store_to)
+                    if dirty:
+                        store_to.put(key, contents)
+                except Exception as e:
+                    failed[key] = e
+            return
+
+        changed = {}
+        for (key, contents, dirty) in items:
+            if dirty:
+                changed[key] = contents
+        keys = [v[0] for v in items]
+        try:
+            got = self.__store_get_many(store_from, keys)
+        except Exception:
+            got = []
+            for key in keys:
+                try:
+                    got += self.__store_get_many(store_from, [key])
+                except Exception as e:
+                    got.append((key, e,))
+        puts = []
+        for (key, contents) in got:
+            if isinstance(contents, Exception):
+                failed[key] = contents
+                continue
+            if key in changed:
+                contents = changed[key]
+            puts.append((key, contents,))
+        puts = self.__write_each(put, puts, failed)
+        self.__write_each(lambda v: self.__store_remove_many(store_from, v), [v[0] for v in puts], failed, key=lambda v: v)
+
+
+    # run a batch store operation for a write behind group, and return the items that were written.
+    # if the batch raises, it is repeated item by item, so that only the items that fail are recorded.
+    def __write_each(self, f, items, failed, key=lambda v: v[0]):
+        if len(items) == 0:
+            return items
+        try:
+            r = f(items)
+        except Exception:
+            r = {}
+            for item in items:
+                try:
+                    r.update(f([item]) or {})
+                except Exception as e:
+                    r[key(item)] = e
+        if r == None:
+            return items
+        failed.update(r)
+        return [item for item in items if key(item) not in r]
+
+
+    # true if store operations are not performed immediately.
+    def __deferred(self):
+        return self.__tx != None or self.__journal != None or self.__write_behind != None
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group changes to several keys, and persist them together.
+
+        Changes made by put, move, set, unset, change, replace, next and the batch methods inside the context are applied in memory immediately, and the verifier is run for each of them as usual. The store operations are staged, and only performed when the context exits. Several changes of the same key are combined into one store operation.
+
+        If the store implements a batch method, all operations are written in one batch; a single write batch for RocksDB, and a MULTI/EXEC transaction for Redis. Otherwise the operations are performed one by one, and undone in reverse order if one of them fails. If a transaction journal is used, the operations are written to it before they are performed, so that a transaction interrupted by a crash is completed when the state is constructed again. If a journal is used, the operations are appended to it with a single commit, and are replayed either all or none. If a write behind buffer is used, they are added to it.
+
+        If an exception is raised inside the context or when persisting, all keys changed in the context are restored to their state and contents in memory before the transaction, and the exception is raised again.
+
+        Nested transactions are part of the outermost transaction.
+
+        :rtype: shep.persist.PersistedState
+        :returns: The persisted state itself
+        """
+        if self.__tx != None:
+            yield self
+            return
+
+        self.__tx = {}
+        self.__tx_undo = {}
+        try:
+            yield self
+            entries = self.__tx
+            self.__tx = None
+            self.__commit_transaction(entries)
+        except Exception as e:
+            self.__tx = None
+            self.__rollback(self.__tx_undo)
+            raise e
+        finally:
+            self.__tx = None
+            self.__tx_undo = None
+
+
+    # record a store operation in the open transaction, together with the memory state of the key before the transaction.
+    def __stage(self, key, k_from, k_to, contents=None, dirty=False, before=None):
+        if key not in self.__tx_undo:
+            self.__tx_undo[key] = before
+        entry = self.__tx.get(key)
+        if entry == None:
+            self.__tx[key] = [k_from, k_to, contents, dirty]
+            return
+        entry[1] = k_to
+        if dirty:
+            entry[2] = contents
+            entry[3] = True
+
+
+    # restore the memory state of keys changed in a failed transaction.
+    def __rollback(self, undo):
+        for (key, before) in undo.items():
+            if before == None:
+                try:
+                    self.purge(key)
+                except StateItemNotFound:
+                    pass
+                continue
+            self.load(key, before[0], contents=before[1])
+
+
+    def __commit_transaction(self, entries):
+        if self.__journal != None:
+            journal_entries = self.__journal_entries(entries)
+            if len(journal_entries) > 0:
+                self.__journal.append(journal_entries, atomic=True)
+            return
+
+        if self.__write_behind != None:
+            for (key, (k_from, k_to, contents, dirty)) in entries.items():
+                if k_from == None:
+                    self.__write_behind.put(key, k_to, contents)
+                    continue
+                if k_from != k_to:
+                    self.__write_behind.move(key, k_from, k_to)
+                if dirty:
+                    self.__write_behind.replace(key, k_to, contents)
+            return
+
+        ops = []
+        for (key, (k_from, k_to, contents, dirty)) in entries.items():
+            if k_from == k_to and not dirty:
+                continue
+            self.__ensure_store(k_to)
+            store_from = None
+            if k_from != None:
+                self.__ensure_store(k_from)
+                store_from = self.__stores[k_from]
+            ops.append((key, store_from, self.__stores[k_to], contents, dirty,))
+        if len(ops) == 0:
+            return
+
+        f = getattr(ops[0][2], 'batch', None)
+        if f != None:
+            return f(ops)
+        if self.__tx_journal == None:
+            return self.__batch_undoable(ops)
+        seq = self.__tx_journal.append(self.__journal_entries(entries), atomic=True)
+        try:
+            self.__batch_undoable(ops)
+        finally:
+            self.__tx_journal.mark(seq)
+
+
+    # journal entries for the staged operations of a transaction.
+    def __journal_entries(self, entries):
+        r = []
+        for (key, (k_from, k_to, contents, dirty)) in entries.items():
+            if k_from == None:
+                r.append((OP_PUT, key, '', k_to, contents,))
+                continue
+            if k_from != k_to:
+                r.append((OP_MOVE, key, k_from, k_to, None,))
+            if dirty:
+                r.append((OP_REPLACE, key, '', k_to, contents,))
+        return r
+
+
+    # perform the operations of a transaction one by one, and undo the performed operations if one fails.
+    def __batch_undoable(self, ops):
+        undo = []
+        try:
+            for (key, store_from, store_to, contents, dirty) in ops:
+                if store_from == None:
+                    store_to.put(key, contents)
+                    undo.append((store_to, None, key, None,))
+                    continue
+                old = None
+                if dirty:
+                    old = store_from.get(key)
+                if store_from != store_to:
+                    self.__store_move(store_from, store_to, key)
+                undo.append((store_to, store_from, key, old,))
+                if dirty:
+                    store_to.put(key, contents)
+        except Exception as e:
+            for (store, store_back, key, old) in reversed(undo):
+                try:
+                    if store_back == None:
+                        store.remove(key)
+                        continue
+                    if old != None:
+                        store.put(key, old)
+                    if store_back != store:
+                        self.__store_move(store, store_back, key)
+                except Exception as ee:
+                    logg.error('could not undo transaction operation on {}: {}'.format(key, ee))
+            raise e
+
+
+    # wait for the journal to be applied or the write behind buffer to be written, before reading from the stores.
+    def __settle(self):
+        if self.__journal != None:
+            self.__journal.drain()
+        if self.__write_behind != None:
+            self.__write_behind.flush()
+
+
+    def flush(self):
+        """Wait until all operations written to the journal have been applied to the stores, or write all operations in the write behind buffer.
+
+        Does nothing if neither is used.
+        """
+        self.__settle()
+
+
+    # true only if the key is known to have no contents, without reading the store.
+    # keys restored from a snapshot without contents have none in memory, but may have contents in the store.
+    def __contents_empty(self, key):
+        if key in self.__unloaded:
+            return False
+        if self.__cache == None:
+            return super(PersistedState, self).get(key) == None
+        if key not in self.__cache:
+            return False
+        return self.__cache.lookup(key)[1] == None
+
+
+    # use the native batch move of the store, else the native move if available, otherwise copy and remove.
+    # keys known to have no contents are moved without reading them.
+    def __store_move(self, store_from, store_to, key, empty=False):
+        f = getattr(store_from, 'move_keys', None)
+        if f != None:
+            r = f([key], store_to, contents=not empty)
+            if len(r) > 0:
+                raise r[key]
+            return
+        f = getattr(store_from, 'move', None)
+        if f != None:
+            return f(key, store_to)
+        contents = store_from.get(key)
+        store_to.put(key, contents)
+        store_from.remove(key)
+
+
+    def __store_get_many(self, store, keys):
+        f = getattr(store, 'get_many', None)
+        if f != None:
+            return f(keys)
+        r = []
+        for key in keys:
+            try:
+                r.append((key, store.get(key),))
+            except StateLockedKey as e:
+                r.append((key, e,))
+        return r
+
+
+    def __store_put_many(self, store, items):
+        f = getattr(store, 'put_many', None)
+        if f != None:
+            return f(items)
+        for (key, contents) in items:
+            store.put(key, contents)
+
+
+    def __store_remove_many(self, store, keys):
+        f = getattr(store, 'remove_many', None)
+        if f != None:
+            return f(keys)
+        for key in keys:
+            store.remove(key)
+
+
+    # resolve the current states of keys before a batch operation, unknown keys are left for the superclass to report.
+    def __states_of(self, keys):
+        r = {}
+        for key in keys:
+            try:
+                r[key] = self.state(key)
+            except StateItemNotFound:
+                pass
+        return r
+
+
+    def move_many(self, keys, to_state=None):
+        """Persist a new state for several keys in one operation.
+
+        See shep.state.State.move_many
+        """
+        if to_state == None:
+            keys = dict(keys)
+        else:
+            keys = list(keys)
+        from_states = self.__states_of(keys)
+        (moved, failed) = super(PersistedState, self).move_many(keys, to_state=to_state)
+        return self.__movestore_many(moved, from_states, failed)
+
+
+    def set_many(self, keys, or_state):
+        """Persist a bit set for several keys in one operation.
+
+        Keys that already have the bit set are left unchanged, and are returned with their current state.
+
+        See shep.state.State.set_many
+        """
+        keys_in = list(keys)
+        from_states = self.__states_of(keys_in)
+        keys = []
+        unchanged = {}
+        for key in keys_in:
+            from_state = from_states.get(key)
+            if from_state != None and from_state & or_state == or_state:
+                unchanged[key] = from_state
+            else:
+                keys.append(key)
+        (moved, failed) = super(PersistedState, self).set_many(keys, or_state)
+        (moved, failed) = self.__movestore_many(moved, from_states, failed)
+        moved.update(unchanged)
+        return (moved, failed,)
+
+
+    def unset_many(self, keys, not_state, allow_base=False):
+        """Persist a bit unset for several keys in one operation.
+
+        See shep.state.State.unset_many
+        """
+        keys = list(keys)
+        from_states = self.__states_of(keys)
+        (moved, failed) = super(PersistedState, self).unset_many(keys, not_state, allow_base=allow_base)
+        return self.__movestore_many(moved, from_states, failed)
+
+
+    def change_many(self, keys, bits_set, bits_unset):
+        """Persist a bits set and unset for several keys in one operation.
+
+        See shep.state.State.change_many
+        """
+        keys = list(keys)
+        from_states = self.__states_of(keys)
+        (moved, failed) = super(PersistedState, self).change_many(keys, bits_set, bits_unset)
+        return self.__movestore_many(moved, from_states, failed)
+
+
     def sync(self, state=None, not_state=None, ignore_auto=True):
         """Reload resources for a single state in memory from the persisted state store.
 
+        Stores that implement a change marker are only listed if the marker changed since the last sync. For those, only the differences to memory are applied; keys that are new or found in a different state are loaded with their contents, and keys no longer found in any of the listed states are looked up in the stores of the other states, and purged only if no store has them. Contents of keys already known in the same state are not reloaded.
+
+        Stores without a change marker are listed in full, and keys not already known are added.
+
+        Stores that implement a scan method are listed in chunks of at most sync_chunk_size keys, and each chunk is applied before the next is read, so only one chunk of contents is held at a time.
+
+        If sync_workers was set, the stores are listed and read concurrently, and the results are applied in the order of the states afterwards. The time spent listing and reading each store is recorded in the sync_timing attribute, by state name.
+
         :param state: State to load
         :type state: int
         :raises StateItemExists: A content key is already recorded with a different state in memory than in persisted store.
         # :todo: if sync state is none, sync all
         """
+        self.__settle()
 
         states_numeric = []
         if state == None:
@@ -182,40 +910,410 @@ class PersistedState(State):
         else:
             states_numeric = [state]
        
+        if not_state == None:
+            not_state = 0
+
         states = []
         for state in states_numeric:
-            if not_state != None:
-                if state & not_state == 0:
-                    states.append(self.name(state))
-            else:
+            if self.matches(state, forbidden=not_state):
                 states.append(self.name(state))
 
-        ks = []
-        for k in states:
-            ks.append(k)
+        self.__sync_names(states)
 
+
+    def __sync_names(self, ks):
+        for k in ks:
+            self.__ensure_store(k)
+            self.__loaded[k] = True
+
+        self.sync_timing = {}
         for k in ks:
+            self.sync_timing[k] = 0.0
+
+        # in parallel, each store is read completely by a worker. otherwise, stores are read chunk by chunk as the results are merged.
+        if self.__sync_workers != None and len(ks) > 1:
+            with ThreadPoolExecutor(max_workers=self.__sync_workers) as executor:
+                results = list(executor.map(self.__sync_read_all, ks))
+        else:
+            results = [self.__sync_read(k) for k in ks]
+
+        # results are merged in the order of the states, regardless of the order the reads completed in.
+        listed = {}
+        for (k, marker, chunks, full) in results:
+            if chunks == None:
+                continue
+            if full:
+                self.__sync_full(k, chunks)
+            else:
+                listed[k] = (marker, chunks,)
+
+        self.__sync_delta(listed)
+
+
+    # sync the stores of states that have not been synced yet.
+    def __hydrate(self, names):
+        ks = []
+        for k in names:
+            if self.__loaded.get(k) == None:
+                ks.append(k)
+        if len(ks) > 0:
+            self.__settle()
+            self.__sync_names(ks)
+
+
+    # sync the stores of a state, and of all states that include it if it is an atomic state.
+    def __hydrate_state(self, state):
+        if not self.__lazy:
+            return
+        names = [self.name(state)]
+        if state > 0 and self.is_pure(state):
+            for v in self.all(numeric=True, ignore_auto=False):
+                if v != state and v & state > 0:
+                    names.append(self.name(v))
+        self.__hydrate(names)
+
+
+    def __hydrate_all(self):
+        if not self.__lazy:
+            return
+        self.__hydrate(self.all(ignore_auto=False))
+
+
+    # look up a key unknown in memory in the stores of the states not synced yet, and load it if found.
+    def __probe(self, key, skip=None):
+        if skip == None:
+            skip = self.__loaded
+        for k in self.all(ignore_auto=False):
+            if skip.get(k) != None:
+                continue
+            self.__ensure_store(k)
+            store = self.__stores[k]
+            if not self.__store_has(store, key):
+                continue
+            contents = store.get(key)
+            if contents != None and len(contents) == 0:
+                contents = None
+            self.load(key, self.from_name(k), contents=contents)
+            return True
+        return False
+
+
+    def __store_has(self, store, key):
+        f = getattr(store, 'has', None)
+        if f != None:
+            return f(key)
+        try:
+            return store.get(key) != None
+        except FileNotFoundError:
+            return False
+
+
+    def state(self, key):
+        """Return the current numeric state for the given content key.
+
+        In lazy mode, a key not known in memory is looked up in the stores of the states not yet synced.
+
+        See shep.state.State.state
+        """
+        try:
+            return super(PersistedState, self).state(key)
+        except StateItemNotFound as e:
+            if not self.__lazy:
+                raise e
+            self.__settle()
+            if not self.__probe(key):
+                raise e
+        return super(PersistedState, self).state(key)
+
+
+    def get(self, key):
+        """Retrieve the content for a content key.
+
+        In lazy mode, a key not known in memory is looked up in the stores of the states not yet synced.
+
+        If a content cache is used, contents not in the cache are read from the store of the state of the key, and added to the cache.
+
+        See shep.state.State.get
+        """
+        if self.__cache == None:
+            if self.__lazy:
+                try:
+                    self.state(key)
+                except StateItemNotFound:
+                    pass
+            return super(PersistedState, self).get(key)
+
+        try:
+            state = self.state(key)
+        except StateItemNotFound:
+            return None
+        (hit, contents) = self.__cache.lookup(key)
+        if hit:
+            return contents
+        self.__settle()
+        k = self.name(state)
+        self.__ensure_store(k)
+        contents = self.__stores[k].get(key)
+        if contents != None and len(contents) == 0:
+            contents = None
+        self.__cache.put(key, contents)
+        return contents
+
+
+    def query(self, required=0, optional=0, forbidden=0):
+        """Iterate all content keys whose state matches the given bitmasks.
+
+        In lazy mode, the stores of all matching states are synced first.
+
+        See shep.state.State.query
+        """
+        if self.__lazy:
+            names = []
+            for v in self.all(numeric=True, ignore_auto=False):
+                if self.matches(v, required=required, optional=optional, forbidden=forbidden):
+                    names.append(self.name(v))
+            self.__hydrate(names)
+        return super(PersistedState, self).query(required=required, optional=optional, forbidden=forbidden)
+
+
+    def count_by_state(self):
+        """Return the number of content keys in each state.
+
+        In lazy mode, the stores of all states are synced first.
+
+        See shep.state.State.count_by_state
+        """
+        self.__hydrate_all()
+        return super(PersistedState, self).count_by_state()
+
+
+    def histogram(self, pure=True, aliases=True):
+        """Return the number of content keys in each registered state.
+
+        In lazy mode, the stores of all states are synced first.
+
+        See shep.state.State.histogram
+        """
+        self.__hydrate_all()
+        return super(PersistedState, self).histogram(pure=pure, aliases=aliases)
+
+
+    # check the change marker of a state store, and return the chunks of the store listing to merge, or none if the store is unchanged. the chunks are read as they are consumed.
+    def __sync_read(self, k):
+        t = time.perf_counter()
+        store = self.__stores[k]
+        f = getattr(store, 'marker', None)
+        if f == None:
+            marker = None
+            full = True
+        else:
+            marker = f()
+            full = False
+        self.sync_timing[k] += time.perf_counter() - t
+        if marker != None and self.__markers.get(k) == marker:
+            return (k, marker, None, False,)
+        return (k, marker, self.__sync_chunks(k, store, full), full,)
+
+
+    # read a state store completely. does not change memory, and can run in a worker thread.
+    def __sync_read_all(self, k):
+        (k, marker, chunks, full) = self.__sync_read(k)
+        if chunks != None:
+            chunks = list(chunks)
+        return (k, marker, chunks, full,)
+
+
+    # list a state store in chunks, and read the contents of the keys that may need loading. the time spent reading is added to the sync timing of the state.
+    def __sync_chunks(self, k, store, full):
+        state = self.from_name(k)
+        t = time.perf_counter()
+        for chunk in self.__store_scan(store, contents=full):
+            if full:
+                items = chunk
+            else:
+                items = []
+                for (key, contents) in chunk:
+                    try:
+                        current_state = super(PersistedState, self).state(key)
+                    except StateItemNotFound:
+                        current_state = None
+                    if current_state == state:
+                        items.append((key, None, False,))
+                        continue
+                    # with a content cache, contents are read when first requested.
+                    if self.__cache != None:
+                        items.append((key, None, True,))
+                        continue
+                    try:
+                        contents = store.get(key)
+                    except FileNotFoundError:
+                        continue
+                    if contents != None and len(contents) == 0:
+                        contents = None
+                    items.append((key, contents, True,))
+            self.sync_timing[k] += time.perf_counter() - t
+            yield items
+            t = time.perf_counter()
+        self.sync_timing[k] += time.perf_counter() - t
+
+
+    # add the keys of a state store that are not known in memory.
+    def __sync_full(self, k, chunks):
+        state = self.from_name(k)
+        for items in chunks:
+            for o in items:
+                try:
+                    super(PersistedState, self).put(o[0], state=state, contents=self.__memory_contents(o[1]))
+                except StateItemExists:
+                    continue
+                self.__cache_put(o[0], o[1])
+
+
+    # apply the differences between listed state stores and memory.
+    def __sync_delta(self, listed):
+        found = {}
+        for (k, (marker, chunks)) in listed.items():
+            state = self.from_name(k)
+            for items in chunks:
+                for (key, contents, read) in items:
+                    if read and self.__cache != None:
+                        super(PersistedState, self).load(key, state)
+                        self.__cache.remove(key)
+                    elif read:
+                        self.load(key, state, contents=contents)
+                    found[key] = True
+
+        # keys missing from the store of their state may have been moved to a state that was not listed.
+        for (k, (marker, chunks)) in listed.items():
+            state = self.from_name(k)
+            missing = []
+            for key in super(PersistedState, self).list(state):
+                if found.get(key) == None and self.state(key) == state:
+                    missing.append(key)
+            for key in missing:
+                if not self.__probe(key, skip=listed):
+                    self.purge(key)
+            self.__markers[k] = marker
+
+
+    def restore(self, path, sync=True):
+        """Load the schema, keys, states and modification times from a snapshot file, and reconcile them with the persisted stores.
+
+        The reconciliation lists the keys of every store without reading contents. Contents are only read for keys that are not in the snapshot, that are in a different state than in the snapshot, or that the store reports as modified after the snapshot was taken. If the snapshot does not include contents, contents are read for all keys. Keys in the snapshot that are no longer found in any store are purged.
+
+        See shep.state.State.restore
+
+        :param path: Snapshot file
+        :type path: str
+        :param sync: Reconcile with the persisted stores after loading the snapshot
+        :type sync: bool
+        :rtype: shep.snapshot.Snapshot
+        :returns: The closed snapshot, for its timestamp and flags
+        """
+        snapshot = super(PersistedState, self).restore(path)
+        if sync:
+            self.__sync_since(snapshot.timestamp, reload_contents=not snapshot.contents)
+        elif not snapshot.contents:
+            for key in self.columns()[0]:
+                if key != None:
+                    self.__unloaded.add(key)
+        return snapshot
+
+
+    def __sync_since(self, ts, reload_contents=False):
+        self.__settle()
+        found = {}
+        for state in self.all(numeric=True, ignore_auto=False):
+            k = self.name(state)
             self.__ensure_store(k)
-            for o in self.__stores[k].list():
-                state = self.from_name(k)
+            store = self.__stores[k]
+            for key in self.__store_list_keys(store):
+                found[key] = True
+                current_state = None
                 try:
-                    super(PersistedState, self).put(o[0], state=state, contents=o[1])
-                except StateItemExists as e:
+                    current_state = super(PersistedState, self).state(key)
+                except StateItemNotFound:
                     pass
+                if current_state == state and not reload_contents:
+                    if not self.__store_modified_since(store, key, ts):
+                        continue
+                contents = store.get(key)
+                if contents != None and len(contents) == 0:
+                    contents = None
+                self.load(key, state, contents=contents)
+
+        for key in self.columns()[0]:
+            if key == None or found.get(key) != None:
+                continue
+            self.purge(key)
+
+
+    # iterate the listing of a store in chunks of content key and contents tuples. contents are only read if requested.
+    def __store_scan(self, store, contents=False):
+        f = getattr(store, 'scan', None)
+        if f != None:
+            return f(contents=contents, chunk_size=self.sync_chunk_size)
+        if contents:
+            return [store.list()]
+        return [[(key, None,) for key in self.__store_list_keys(store)]]
+
+
+    def __store_list_keys(self, store):
+        f = getattr(store, 'list_keys', None)
+        if f != None:
+            return f()
+        return [v[0] for v in store.list()]
+
+
+    def __store_modified_since(self, store, key, ts):
+        try:
+            return store.modified(key) >= ts
+        except (TypeError, ValueError, FileNotFoundError):
+            return True
 
 
     def list(self, state):
         """List all content keys for a particular state.
 
-        This method will return from memory, and will not sync the persisted state first.
+        This method will return from memory, and will not sync the persisted state first. In lazy mode, the state is synced the first time it is listed.
    
         See shep.state.State.list
         """
         k = self.name(state)
         self.__ensure_store(k)
+        self.__hydrate_state(state)
         return super(PersistedState, self).list(state)
 
 
+    def count_persisted(self, state=None):
+        """Count the content keys in the persisted stores.
+
+        Stores that implement a count method return the count without listing their contents. Otherwise the store is listed.
+
+        :param state: State to count. If not set, all states are counted
+        :type state: int
+        :rtype: int or dict
+        :returns: Number of keys in state, or state name to number of keys if no state was given
+        """
+        if state != None:
+            return self.__count_store(self.name(state))
+        r = {}
+        for v in self.all(numeric=True):
+            k = self.name(v)
+            r[k] = self.__count_store(k)
+        return r
+
+
+    def __count_store(self, k):
+        self.__settle()
+        self.__ensure_store(k)
+        store = self.__stores[k]
+        f = getattr(store, 'count', None)
+        if f != None:
+            return f()
+        return len(store.list())
+
+
     def path(self, state, key=None):
         """Return a file path or URL pointing to the persisted state.
         
@@ -251,12 +1349,33 @@ class PersistedState(State):
         """
         state = self.state(key)
         k = self.name(state)
+        if self.__tx != None:
+            self.__stage(key, k, k, contents=contents, dirty=True, before=(state, self.get(key),))
+            self.__replace_memory(key, contents)
+            return
+        if self.__journal != None:
+            self.__journal.append([(OP_REPLACE, key, '', k, contents,)])
+            self.__replace_memory(key, contents)
+            return
+        if self.__write_behind != None:
+            self.__replace_memory(key, contents)
+            self.__write_behind.replace(key, k, contents)
+            return
         r = self.__stores[k].replace(key, contents)
-        super(PersistedState, self).replace(key, contents)
+        self.__replace_memory(key, contents)
         return r
 
 
+    def __replace_memory(self, key, contents):
+        self.__unloaded.discard(key)
+        if self.__cache != None:
+            self.__cache.put(key, contents)
+            return
+        super(PersistedState, self).replace(key, contents)
+
+
     def modified(self, key):
+        self.__settle()
         state = self.state(key)
         k = self.name(state)
         return self.__stores[k].modified(key)
@@ -270,3 +1389,13 @@ class PersistedState(State):
     def alias(self, key, *args):
         self.__ensure_store(key)
         super(PersistedState, self).alias(key, *args)
+
+
+    def apply_schema(self, schema):
+        """Add the atomic states and aliases of a schema that are not already registered, and create their stores.
+
+        See shep.state.State.apply_schema
+        """
+        super(PersistedState, self).apply_schema(schema)
+        for (k, v) in schema['states']:
+            self.__ensure_store(k)
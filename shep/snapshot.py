@@ -0,0 +1,190 @@
+# standard imports
+import os
+import mmap
+import struct
+import time
+
+# local imports
+from shep.error import StateCorruptionError
+
+magic = b'SHEP'
+version = 1
+
+FLAG_CONTENTS = 1
+
+TYPE_NONE = 0
+TYPE_STR = 1
+TYPE_BYTES = 2
+TYPE_INT = 3
+
+header_format = '<4sHHdQ'
+schema_format = '<iI'
+state_format = '<Q'
+record_format = '<QdB'
+length_format = '<I'
+
+
+def encode_value(v, allow_none=False):
+    if v == None and allow_none:
+        return (TYPE_NONE, b'',)
+    if isinstance(v, str):
+        return (TYPE_STR, v.encode('utf-8'),)
+    if isinstance(v, bytes):
+        return (TYPE_BYTES, v,)
+    if isinstance(v, int) and not isinstance(v, bool):
+        return (TYPE_INT, str(v).encode('utf-8'),)
+    raise ValueError('cannot snapshot value of type {}'.format(type(v)))
+
+
+def decode_value(typ, b):
+    if typ == TYPE_NONE:
+        return None
+    if typ == TYPE_STR:
+        return b.decode('utf-8')
+    if typ == TYPE_BYTES:
+        return b
+    if typ == TYPE_INT:
+        return int(b)
+    raise StateCorruptionError('unknown value type {}'.format(typ))
+
+
+def encode_string(s):
+    b = s.encode('utf-8')
+    return struct.pack(length_format, len(b)) + b
+
+
+def write(path, schema, records, count, with_contents=False):
+    """Write a snapshot file.
+
+    The file is written to a temporary file first, and moved in place when complete.
+
+    :param path: File to write
+    :type path: str
+    :param schema: Schema, as returned by shep.state.State.schema
+    :type schema: dict
+    :param records: Key, state, modification time and contents tuples
+    :type records: iterable
+    :param count: Number of records
+    :type count: int
+    :param with_contents: Include contents
+    :type with_contents: bool
+    :raises ValueError: A key or contents cannot be represented
+    :rtype: float
+    :returns: Timestamp of the snapshot
+    """
+    ts = time.time()
+    flags = 0
+    if with_contents:
+        flags |= FLAG_CONTENTS
+
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(struct.pack(header_format, magic, version, flags, ts, count))
+        f.write(struct.pack(schema_format, schema['bits'], len(schema['states'])))
+        f.write(encode_string(schema['default']))
+        for (k, v) in schema['states']:
+            f.write(struct.pack(state_format, v))
+            f.write(encode_string(k))
+
+        c = 0
+        for (key, state, modified, contents) in records:
+            (typ, b) = encode_value(key)
+            f.write(struct.pack(record_format, state, modified, typ))
+            f.write(struct.pack(length_format, len(b)))
+            f.write(b)
+            if with_contents:
+                (typ, b) = encode_value(contents, allow_none=True)
+                f.write(struct.pack('<B', typ))
+                f.write(struct.pack(length_format, len(b)))
+                f.write(b)
+            c += 1
+        if c != count:
+            raise StateCorruptionError('record count {} does not match {}'.format(c, count))
+        f.flush()
+        os.fsync(f.fileno())
+    except Exception as e:
+        f.close()
+        os.unlink(tmp_path)
+        raise e
+    f.close()
+    os.replace(tmp_path, path)
+    return ts
+
+
+class Snapshot:
+    """Reader for a snapshot file written by shep.snapshot.write.
+
+    The file is memory mapped, and records are decoded lazily while iterating.
+
+    :param path: Snapshot file
+    :type path: str
+    :raises StateCorruptionError: Not a snapshot file, or unsupported version
+    """
+
+    def __init__(self, path):
+        self.__f = open(path, 'rb')
+        self.__m = mmap.mmap(self.__f.fileno(), 0, access=mmap.ACCESS_READ)
+        (m, v, flags, ts, count) = struct.unpack_from(header_format, self.__m, 0)
+        if m != magic:
+            self.close()
+            raise StateCorruptionError('not a snapshot file: {}'.format(path))
+        if v != version:
+            self.close()
+            raise StateCorruptionError('unsupported snapshot version {}'.format(v))
+        self.timestamp = ts
+        self.count = count
+        self.contents = flags & FLAG_CONTENTS > 0
+        self.__offset = struct.calcsize(header_format)
+
+        (bits, c) = self.__unpack(schema_format)
+        default = self.__string()
+        states = []
+        for i in range(c):
+            (v,) = self.__unpack(state_format)
+            states.append((self.__string(), v,))
+        self.schema = {
+            'bits': bits,
+            'default': default,
+            'states': states,
+            }
+        self.__records = self.__offset
+
+
+    def __unpack(self, fmt):
+        r = struct.unpack_from(fmt, self.__m, self.__offset)
+        self.__offset += struct.calcsize(fmt)
+        return r
+
+
+    def __bytes(self):
+        (l,) = self.__unpack(length_format)
+        b = self.__m[self.__offset:self.__offset+l]
+        self.__offset += l
+        return b
+
+
+    def __string(self):
+        return self.__bytes().decode('utf-8')
+
+
+    def __iter__(self):
+        """Iterate the records of the snapshot.
+
+        :rtype: generator of tuple
+        :returns: Key, state, modification time and contents. Contents is always None if the snapshot was written without contents
+        """
+        self.__offset = self.__records
+        for i in range(self.count):
+            (state, modified, typ) = self.__unpack(record_format)
+            key = decode_value(typ, self.__bytes())
+            contents = None
+            if self.contents:
+                (typ,) = self.__unpack('<B')
+                contents = decode_value(typ, self.__bytes())
+            yield (key, state, modified, contents,)
+
+
+    def close(self):
+        self.__m.close()
+        self.__f.close()
@@ -1,6 +1,7 @@
 # standard imports
 import re
-import datetime
+import time
+import heapq
 import logging
 logg = logging.getLogger()
 
@@ -13,6 +14,14 @@ from shep.error import (
         StateTransitionInvalid,
         StateCorruptionError,
         )
+from shep.index import (
+        KeyIndex,
+        TimeIndex,
+        )
+from shep.snapshot import (
+        Snapshot,
+        write as write_snapshot,
+        )
 
 re_name = r'^[a-zA-Z_\.]+$'
 
@@ -39,32 +48,44 @@ class State:
     :type bits: int
     :param logger: Standard library logging instance to output to
     :type logger: logging.Logger
+    :param index: Index to record content keys and their states in. If not set, a shep.index.KeyIndex is used
+    :type index: shep.index.KeyIndex
+    :param time_index: Keep a shep.index.TimeIndex of modifications, so that modified_since and oldest do not scan all keys. Costs memory for every modification
+    :type time_index: bool
     """
 
     base_state_name = 'NEW'
 
-    def __init__(self, bits, logger=None, verifier=None, check_alias=True, event_callback=None, default_state=None):
+    def __init__(self, bits, logger=None, verifier=None, check_alias=True, event_callback=None, default_state=None, index=None, time_index=False):
         self.__initial_bits = bits
         self.__bits = bits
         self.__limit = (1 << bits) - 1
         self.__c = 0
 
-        self.__keys_reverse = {}
+        if index == None:
+            index = KeyIndex()
+        self.__index = index
 
         if default_state == None:
             default_state = self.base_state_name
         else:
             default_state = self.__check_name_valid(default_state)
             self.base_state_name = default_state
-            self.__keys_reverse[default_state] = 0
+            self.__index.add(default_state, 0, (), listed=False)
 
         setattr(self, default_state, 0)
 
         self.__reverse = {0: default_state}
-        self.__keys = {0: []}
+        self.__names = {default_state: 0}
+        self.__all = {}
+        self.__decomposed = {}
 
         self.__contents = {}
-        self.modified_last = {}
+        self.modified_last = self.__index.modified_last
+        self.__times = None
+        if time_index:
+            self.__times = TimeIndex(self.__index.state, self.__index.modified)
+        self.__last_ts = 0.0
         self.verifier = verifier
         self.check_alias = check_alias
         self.event_callback = event_callback
@@ -75,16 +96,40 @@ class State:
         cls.base_state_name = state_name.upper()
 
 
-    # return true if v is a single-bit state
+    # return true if v is a registered single-bit state, or the default state
     def is_pure(self, v):
-        if v == 0:
-            return True
+        if v & (v - 1) != 0 or v > self.__limit:
+            return False
+        return self.__reverse.get(v) != None
+
+
+    # return true if v has at most one bit set, whether or not the bit is registered
+    def __single_bit(self, v):
+        return v & (v - 1) == 0
+
+
+    # split a state value into its bits, the names of the registered bits, and the generated alias name if all bits are registered.
+    # results are cached until the next schema change.
+    def __decompose(self, v):
+        r = self.__decomposed.get(v)
+        if r != None:
+            return r
+        bits = []
+        names = []
         c = 1
         for i in range(self.__bits):
-            if c & v > 0:
-                break
+            if v & c > 0:
+                bits.append(c)
+                k = self.__reverse.get(c)
+                if k != None:
+                    names.append(k)
             c <<= 1
-        return c == v
+        alias = None
+        if len(bits) == len(names):
+            alias = join_elements(names)
+        r = (tuple(bits), tuple(names), alias,)
+        self.__decomposed[v] = r
+        return r
 
 
     # validates a state name and return its canonical representation
@@ -149,50 +194,29 @@ class State:
     def __set(self, k, v):
         setattr(self, k, v)
         self.__reverse[v] = k
+        self.__names[k] = v
         self.__c += 1
+        self.__decomposed = {}
+        self.__all = {}
 
 
     # check validity of key to register state for
     def __check_key(self, item):
-        if self.__keys_reverse.get(item) != None:
+        if self.__index.state(item) != None:
             raise StateItemExists(item)
 
 
     # adds a new key to the state store
     def __add_state_list(self, state, item):
-        if self.__keys.get(state) == None:
-            self.__keys[state] = []
-        if not self.is_pure(state) or state == 0:
-            self.__keys[state].append(item)
-        c = 1
-        for i in range(self.__bits):
-            part = c & state
-            if part > 0:
-                if self.__keys.get(part) == None:
-                    self.__keys[part] = []
-                self.__keys[part].append(item)
-            c <<= 1
-        self.__keys_reverse[item] = state
+        self.__index.add(item, state, self.__decompose(state)[0])
         if self.__reverse.get(state) == None and not self.check_alias:
             s = self.elements(state)
             self.__alias(s, state)
 
 
-    def __state_list_index(self, item, state_list):
-        """Get index of a key for a given state.
-        A key should only ever exist in one state.
-        A failed lookup should indicate a mistake on the caller part, (it may also indicate corruption, but probanbly impossible to tell the difference)
-        """
-        idx = -1
-        try:
-            idx = state_list.index(item)
-        except ValueError:
-            pass
-
-        if idx == -1:
-            raise StateCorruptionError() # should have state int here as value
-
-        return idx
+    # removes a key from all lists it was added to by __add_state_list
+    def __remove_state_list(self, state, item):
+        self.__index.remove(item, state, self.__decompose(state)[0])
 
 
     def add(self, k):
@@ -220,7 +244,7 @@ class State:
         for a in args:
             a = self.__check_value_cursor(a)
             v = self.__check_limit(v | a, pure=False)
-        if self.is_pure(v):
+        if self.__single_bit(v):
             raise ValueError('use add to add pure values')
         k = k.replace('.', '__')
         return self.__set(k, v)
@@ -253,57 +277,66 @@ class State:
 
 
     def all(self, pure=False, numeric=False, ignore_auto=True, bit_order=False):
-        """Return list of all unique atomic and alias state strings.
+        """Return all unique atomic and alias states.
+
+        The result is read from the registry of state names, and is cached until the next schema change.
         
-        :rtype: list of ints
+        :rtype: tuple of ints or strs
         :return: states
         """
+        cache_key = (pure, numeric, ignore_auto, bit_order,)
+        r = self.__all.get(cache_key)
+        if r != None:
+            return r
+
         l = []
         v = None
         if bit_order:
             v = self.__all_bit()
         else:
-            v = dir(self)
+            v = sorted(self.__names.keys())
         for k in v:
-            state = None
             if k[0] == '_' and ignore_auto:
                 continue
-            if k.upper() != k:
-                continue
-            if pure:
+            state = self.__names.get(k)
+            if state == None:
                 state = self.from_name(k)
+            if pure:
                 if not self.is_pure(state):
                     continue
             if numeric:
-                if state == None:
-                    state = self.from_name(k)
                 l.append(state)
             else:
                 l.append(k)
         if not bit_order:
             l.sort()
-        return l
+        r = tuple(l)
+        self.__all[cache_key] = r
+        return r
 
 
     def elements(self, v, numeric=False, as_string=True):
-        r = []
         if v == None or v == 0:
             return self.base_state_name
-        c = 1
-        for i in range(self.__bits):
-            if (v & c) > 0:
-                if numeric:
-                    r.append(c)
-                else:
-                    r.append(self.name(c))
-            c <<= 1
+        (bits, names, alias) = self.__decompose(v)
+        if numeric:
+            return list(bits)
+        if alias != None:
+            r = list(names)
+        else:
+            r = []
+            for c in bits:
+                r.append(self.name(c))
 
-        if numeric or not as_string:
+        if not as_string:
             return r
 
         if len(r) == 1:
             return self.name(v)
 
+        if alias != None:
+            return alias
+
         return join_elements(r) #'_' + '.'.join(r)
 
 
@@ -357,10 +390,16 @@ class State:
         :rtype: int
         :return: Numeric state value
         """
+        v = self.__names.get(k)
+        if v != None:
+            return v
         k = self.__check_name_valid(k)
         if k == self.base_state_name:
             return 0
-        return getattr(self, k)
+        v = self.__names.get(k)
+        if v == None:
+            raise AttributeError(k)
+        return v
 
 
     def match(self, v, pure=False):
@@ -380,16 +419,7 @@ class State:
         if not pure:
             alias = self.__reverse.get(v)
 
-        r = []
-        c = 1
-        for i in range(self.__bits):
-            if v & c > 0:
-                try:
-                    k = self.__reverse[c]
-                    r.append(k)
-                except KeyError:
-                    pass
-            c <<= 1
+        r = list(self.__decompose(v)[1])
 
         return (alias, r,)
 
@@ -419,7 +449,7 @@ class State:
         self.__check_key(key)
 
         if self.event_callback != None:
-            old_state = self.__keys_reverse.get(key)
+            old_state = self.__index.state(key)
             self.event_callback(key, None, self.name(state))
 
         self.__add_state_list(state, key)
@@ -442,50 +472,118 @@ class State:
         :rtype: integer
         :return: Resulting state from move (should match the state given as input)
         """
-        current_state = self.__keys_reverse.get(key)
+        current_state = self.__index.state(key)
         if current_state == None:
             raise StateItemNotFound(key)
 
-        new_state = self.__reverse.get(to_state)
-        if new_state == None and self.check_alias:
-            raise StateInvalid(to_state)
+        to_state = self.__target_move(key, current_state, to_state)
 
         return self.__move(key, current_state, to_state)
 
 
     # implementation for state move that ensures integrity of keys and states.
-    def __move(self, key, from_state, to_state):
-        current_state_list = self.__keys.get(from_state)
-        if current_state_list == None:
-            raise StateCorruptionError(current_state)
-
-        idx = self.__state_list_index(key, current_state_list)
-
-        new_state_list = self.__keys.get(to_state)
-        if current_state_list == None:
-            raise StateCorruptionError(to_state)
+    def __move(self, key, from_state, to_state, ts=None):
+        if not self.__index.has(key, from_state, self.__decompose(from_state)[0]):
+            raise StateCorruptionError(from_state)
 
         if self.verifier != None:
             r = self.verifier(self, key, from_state, to_state)
             if r != None:
                 raise StateTransitionInvalid(r)
 
-        old_state = self.__keys_reverse.get(key)
+        old_state = self.__index.state(key)
         if self.event_callback != None:
             self.event_callback(key, self.name(old_state), self.name(to_state))
 
-        if old_state == 0:
-            current_state_list.pop(idx)
-        else:
-            for k in self.elements(from_state, numeric=True):
-                self.__keys[k].remove(key)
+        self.__remove_state_list(from_state, key)
         self.__add_state_list(to_state, key)
 
-        self.register_modify(key)
+        self.register_modify(key, ts=ts)
 
-        logg.debug('move {} {} {}'.format(key, from_state, to_state))
+        if ts == None:
+            logg.debug('move {} {} {}'.format(key, from_state, to_state))
+        return to_state
+
+
+    # implementation for moving several keys, with a single modification timestamp for all keys.
+    # the target callback resolves and validates the target state of each key, the results of the validation are cached per (from, to) pair.
+    def __move_many(self, items, target):
+        ts = self.now()
+        r = {}
+        e = {}
+        for (key, v) in items:
+            try:
+                current_state = self.__index.state(key)
+                if current_state == None:
+                    raise StateItemNotFound(key)
+                to_state = target(key, current_state, v)
+                r[key] = self.__move(key, current_state, to_state, ts=ts)
+            except (StateItemNotFound, StateInvalid, StateTransitionInvalid, ValueError) as ex:
+                e[key] = ex
+        logg.debug('move many {} ok {} failed'.format(len(r), len(e)))
+        return (r, e,)
+
+
+    # cache target resolutions for a batch, as long as the resolution only depends on the current state of the key.
+    # failed resolutions are not cached, as the error may refer to the individual key.
+    def __cached_target(self, target):
+        cache = {}
+        def resolve(key, current_state, v):
+            k = (current_state, v,)
+            r = cache.get(k)
+            if r == None:
+                r = target(key, current_state, v)
+                cache[k] = r
+            return r
+        return resolve
+
+
+    def __target_move(self, key, current_state, to_state):
+        new_state = self.__reverse.get(to_state)
+        if new_state == None and self.check_alias:
+            raise StateInvalid(to_state)
+        return to_state
+
+
+    def __target_set(self, key, current_state, or_state):
+        to_state = current_state | or_state
+        new_state = self.__reverse.get(to_state)
+        if new_state == None and self.check_alias:
+            raise StateInvalid('resulting to state is unknown: {}'.format(to_state))
+        return to_state
+
+
+    def __target_unset(self, key, current_state, not_state, allow_base=False):
+        to_state = current_state & (~not_state)
+        if to_state == current_state:
+            raise ValueError('invalid change for state {}: {}'.format(key, not_state))
+
+        if to_state == getattr(self, self.base_state_name) and not allow_base:
+            raise ValueError('State {} for {} cannot be reverted to {}'.format(current_state, key, self.base_state_name))
+
+        new_state = self.__reverse.get(to_state)
+        if new_state == None:
+            raise StateInvalid('resulting to state is unknown: {}'.format(to_state))
+        return to_state
+
+
+    def __target_change(self, key, current_state, sets, unsets):
+        to_state = current_state | sets
+        to_state &= ~unsets & self.__limit
+
+        if sets == 0:
+            to_state = current_state & (~unsets)
+            if to_state == current_state:
+                raise ValueError('invalid change by unsets for state {}: {}'.format(key, unsets))
+
+        if to_state == getattr(self, self.base_state_name):
+            raise ValueError('State {} for {} cannot be reverted to {}'.format(current_state, key, self.base_state_name))
+
+        new_state = self.__reverse.get(to_state)
+        if new_state == None:
+            raise StateInvalid('resulting to state is unknown: {}'.format(to_state))
         return to_state
-   
+
 
     def set(self, key, or_state):
         """Move to an alias state by setting a single bit.
@@ -503,14 +601,11 @@ class State:
         if not self.is_pure(or_state):
             raise ValueError('can only apply using single bit states')
 
-        current_state = self.__keys_reverse.get(key)
+        current_state = self.__index.state(key)
         if current_state == None:
             raise StateItemNotFound(key)
 
-        to_state = current_state | or_state
-        new_state = self.__reverse.get(to_state)
-        if new_state == None and self.check_alias:
-            raise StateInvalid('resulting to state is unknown: {}'.format(to_state))
+        to_state = self.__target_set(key, current_state, or_state)
         
         return self.__move(key, current_state, to_state)
 
@@ -535,44 +630,87 @@ class State:
         if not self.is_pure(not_state):
             raise ValueError('can only apply using single bit states')
 
-        current_state = self.__keys_reverse.get(key)
+        current_state = self.__index.state(key)
         if current_state == None:
             raise StateItemNotFound(key)
 
-        to_state = current_state & (~not_state)
-        if to_state == current_state:
-            raise ValueError('invalid change for state {}: {}'.format(key, not_state))
-
-        if to_state == getattr(self, self.base_state_name) and not allow_base:
-            raise ValueError('State {} for {} cannot be reverted to {}'.format(current_state, key, self.base_state_name))
-
-        new_state = self.__reverse.get(to_state)
-        if new_state == None:
-            raise StateInvalid('resulting to state is unknown: {}'.format(to_state))
+        to_state = self.__target_unset(key, current_state, not_state, allow_base=allow_base)
 
         return self.__move(key, current_state, to_state)
 
 
     def change(self, key, sets, unsets):
-        current_state = self.__keys_reverse.get(key)
+        current_state = self.__index.state(key)
         if current_state == None:
             raise StateItemNotFound(key)
-        to_state = current_state | sets
-        to_state &= ~unsets & self.__limit
 
-        if sets == 0:
-            to_state = current_state & (~unsets)
-            if to_state == current_state:
-                raise ValueError('invalid change by unsets for state {}: {}'.format(key, unsets))
+        to_state = self.__target_change(key, current_state, sets, unsets)
 
-        if to_state == getattr(self, self.base_state_name):
-            raise ValueError('State {} for {} cannot be reverted to {}'.format(current_state, key, self.base_state_name))
+        return self.__move(key, current_state, to_state)
 
-        new_state = self.__reverse.get(to_state)
-        if new_state == None:
-            raise StateInvalid('resulting to state is unknown: {}'.format(to_state))
 
-        return self.__move(key, current_state, to_state)
+    def move_many(self, keys, to_state=None):
+        """Move several content keys in one operation.
+
+        If to_state is given, all keys are moved to that state, which is validated once for the whole batch. Otherwise keys must be a dict, or an iterable of key and state pairs.
+
+        A failure to move one key does not abort the batch. The keys that could not be moved are returned together with the exception that prevented the move.
+
+        :param keys: Content keys to move, or key to state pairs
+        :type keys: iterable
+        :param to_state: Numeric state to move all keys to
+        :type to_state: int
+        :raises StateInvalid: Given state has not been registered
+        :rtype: tuple
+        :return: 0: dict of moved keys and their resulting state, 1: dict of failed keys and the exception that caused the failure
+        """
+        if to_state != None:
+            self.__target_move(None, None, to_state)
+            items = ((k, to_state,) for k in keys)
+        elif isinstance(keys, dict):
+            items = keys.items()
+        else:
+            items = keys
+        return self.__move_many(items, self.__cached_target(self.__target_move))
+
+
+    def set_many(self, keys, or_state):
+        """Set a single bit for several content keys in one operation.
+
+        See shep.state.State.set and shep.state.State.move_many
+
+        :raises ValueError: State is not a single bit state
+        """
+        if not self.is_pure(or_state):
+            raise ValueError('can only apply using single bit states')
+        items = ((k, or_state,) for k in keys)
+        return self.__move_many(items, self.__cached_target(self.__target_set))
+
+
+    def unset_many(self, keys, not_state, allow_base=False):
+        """Unset a single bit for several content keys in one operation.
+
+        See shep.state.State.unset and shep.state.State.move_many
+
+        :raises ValueError: State is not a single bit state
+        """
+        if not self.is_pure(not_state):
+            raise ValueError('can only apply using single bit states')
+        def target(key, current_state, v):
+            return self.__target_unset(key, current_state, v, allow_base=allow_base)
+        items = ((k, not_state,) for k in keys)
+        return self.__move_many(items, self.__cached_target(target))
+
+
+    def change_many(self, keys, sets, unsets):
+        """Set and unset bits for several content keys in one operation.
+
+        See shep.state.State.change and shep.state.State.move_many
+        """
+        def target(key, current_state, v):
+            return self.__target_change(key, current_state, sets, unsets)
+        items = ((k, None,) for k in keys)
+        return self.__move_many(items, self.__cached_target(target))
 
 
     def state(self, key):
@@ -584,7 +722,7 @@ class State:
         :rtype: int
         :returns: State
         """
-        state = self.__keys_reverse.get(key)
+        state = self.__index.state(key)
         if state == None:
             raise StateItemNotFound(key)
         return state
@@ -609,10 +747,79 @@ class State:
         :rtype: list of str
         :returns: Matching content keys
         """
-        try:
-            return self.__keys[state]
-        except KeyError:
-            return []
+        return self.__index.list(state)
+
+
+    def matches(self, v, required=0, optional=0, forbidden=0):
+        """Check whether a state value satisfies a bitmask query.
+
+        See shep.state.State.query
+
+        :param v: State to check
+        :type v: int
+        :rtype: bool
+        :returns: True if the state matches
+        """
+        if v & required != required:
+            return False
+        if optional > 0 and v & optional == 0:
+            return False
+        return v & forbidden == 0
+
+
+    def query(self, required=0, optional=0, forbidden=0):
+        """Iterate all content keys whose state matches the given bitmasks.
+
+        A key matches if its state has all the bits in required set, at least one of the bits in optional set (if optional is not zero), and none of the bits in forbidden set.
+
+        Candidates are drawn from the per-bit key lists, using the smallest list of the required bits, or the lists of the optional bits. Each key is yielded at most once.
+
+        The iterator is lazy. Changing the states of keys while iterating is not supported, and the results should be collected first if that is needed.
+
+        :param required: Bits that must all be set
+        :type required: int
+        :param optional: Bits of which at least one must be set
+        :type optional: int
+        :param forbidden: Bits that must not be set
+        :type forbidden: int
+        :rtype: generator of str
+        :returns: Matching content keys
+        """
+        if required & forbidden > 0:
+            return
+        if required > 0:
+            size = None
+            candidates = None
+            for bit in self.elements(required, numeric=True):
+                c = self.__index.size(bit)
+                if size == None or c < size:
+                    size = c
+                    candidates = bit
+            if candidates == None:
+                return
+            for key in self.__index.members(candidates):
+                if self.matches(self.__index.state(key), required, optional, forbidden):
+                    yield key
+            return
+
+        if optional == 0:
+            for key in self.__index.members(0):
+                yield key
+            optional = self.__limit
+        else:
+            optional &= ~forbidden
+            if optional == 0:
+                return
+
+        # a key is yielded from the list of the lowest matching bit only
+        for bit in self.elements(optional, numeric=True):
+            for key in self.__index.members(bit):
+                v = self.__index.state(key)
+                if v & forbidden > 0:
+                    continue
+                m = v & optional
+                if m & -m == bit:
+                    yield key
 
 
     def sync(self, state=None, not_state=None, ignore_auto=True):
@@ -645,7 +852,7 @@ class State:
         :rtype: int
         :returns: Next state
         """
-        state = self.__keys_reverse.get(key)
+        state = self.__index.state(key)
         if state == None:
             raise StateItemNotFound(key)
         if not self.is_pure(state):
@@ -690,11 +897,88 @@ class State:
 
 
     def modified(self, key):
-        return self.modified_last[key]
+        return self.__index.modified(key)
+
+
+    def columns(self):
+        """Return all content keys with their states and modification times as columns, for bulk processing.
+
+        See shep.index.KeyIndex.columns and shep.analytics
+
+        :rtype: tuple
+        :returns: 0: keys, 1: states, 2: modification times
+        """
+        return self.__index.columns()
+
+
+    def now(self):
+        """Return the timestamp to use for a modification.
+
+        The timestamp is the current UNIX time, but is guaranteed to be greater than the timestamp previously returned, so modifications can be ordered by it.
+
+        :rtype: float
+        :returns: Timestamp
+        """
+        ts = time.time()
+        if ts <= self.__last_ts:
+            ts = self.__last_ts + 0.000001
+        self.__last_ts = ts
+        return ts
+
+
+    def register_modify(self, key, ts=None):
+        if ts == None:
+            ts = self.now()
+        self.__index.touch(key, ts)
+        if self.__times == None:
+            return
+        state = self.__index.state(key)
+        self.__times.add(key, ts, state, live=len(self.__index), live_state=self.__index.counts().get(state, 0))
+
+
+    # modification times and keys at or after the given time, in index order, for states without a time index.
+    def __scan_times(self, ts, state=None):
+        (keys, states, modified) = self.__index.columns()
+        r = []
+        for (key, v, t) in zip(keys, states, modified):
+            if key == None or t == None or t < ts:
+                continue
+            if state != None and v != state:
+                continue
+            r.append((t, key,))
+        return r
+
+
+    def modified_since(self, ts, state=None):
+        """Return the content keys modified at or after the given time.
+
+        :param ts: Timestamp, as returned by shep.state.State.now
+        :type ts: float
+        :param state: If set, only return keys currently in this exact state
+        :type state: int
+        :rtype: list of str
+        :returns: Keys, in order of modification. Without a time index, keys modified at the same time by a batch method are in no particular order
+        """
+        if self.__times == None:
+            return [v[1] for v in sorted(self.__scan_times(ts, state=state), key=lambda v: v[0])]
+        return self.__times.since(ts, state=state)
+
 
+    def oldest(self, state, n=1):
+        """Return the least recently modified content keys in a state.
 
-    def register_modify(self, key):
-        self.modified_last[key] = datetime.datetime.utcnow().timestamp()
+        Keys are matched by their exact state, so keys in an alias state are not returned for the atomic states of the alias.
+
+        :param state: State
+        :type state: int
+        :param n: Maximum number of keys to return
+        :type n: int
+        :rtype: list of str
+        :returns: Keys, least recently modified first
+        """
+        if self.__times == None:
+            return [v[1] for v in heapq.nsmallest(n, self.__scan_times(0, state=state), key=lambda v: v[0])]
+        return self.__times.oldest(state, n)
 
 
     def mask(self, key, states=0):
@@ -709,21 +993,196 @@ class State:
         state = self.state(key)
         state_name = self.name(state)
 
-        v = self.__keys.get(state)
-        v.remove(key) 
+        self.__remove_state_list(state, key)
 
-        del self.__keys_reverse[key]
+        self.__index.forget(key)
 
         try:
             del self.__contents[key]
         except KeyError:
             pass
 
+
+    def load(self, key, state, contents=None):
+        """Record the state and contents of a key as found in a backend.
+
+        Unknown keys are added, and keys known in a different state are moved. The verifier and event callback are not invoked, as the change has already happened elsewhere.
+
+        :param key: Content key
+        :type key: str
+        :param state: State of the key
+        :type state: int
+        :param contents: Contents of the key
+        :type contents: any
+        :rtype: int
+        :returns: Previous state of the key, or None if the key was unknown
+        """
+        current_state = self.__index.state(key)
+        if current_state != state:
+            if current_state != None:
+                self.__remove_state_list(current_state, key)
+            self.__add_state_list(state, key)
+            self.register_modify(key)
+        if contents == None:
+            self.__contents.pop(key, None)
+        else:
+            self.__contents[key] = contents
+        return current_state
+
+
+    def schema(self):
+        """Return the state schema, the atomic states and aliases with their values, and the default state.
+
+        :rtype: dict
+        :returns: Schema
+        """
+        states = []
+        for (k, v) in self.__names.items():
+            if v == 0:
+                continue
+            states.append((k, v,))
+        states.sort(key=lambda x: x[1])
+        return {
+            'bits': self.__initial_bits,
+            'default': self.base_state_name,
+            'states': states,
+            }
+
+
+    def apply_schema(self, schema):
+        """Add the atomic states and aliases of a schema that are not already registered.
+
+        :param schema: Schema, as returned by shep.state.State.schema
+        :type schema: dict
+        :raises StateCorruptionError: Schema conflicts with the registered states
+        """
+        if schema['default'] != self.base_state_name:
+            raise StateCorruptionError('default state {} does not match {}'.format(schema['default'], self.base_state_name))
+        pure = []
+        aliases = []
+        for (k, v) in schema['states']:
+            if self.__single_bit(v):
+                pure.append((k, v,))
+            else:
+                aliases.append((k, v,))
+        pure.sort(key=lambda x: x[1])
+        for (k, v) in pure + aliases:
+            current = self.__names.get(k)
+            if current != None:
+                if current != v:
+                    raise StateCorruptionError('state {} has value {}, schema has {}'.format(k, current, v))
+                continue
+            if self.__reverse.get(v) != None:
+                raise StateCorruptionError('state value {} is {}, schema has {}'.format(v, self.__reverse[v], k))
+            self.__restore_state(k, v)
+
+
+    # register a state name at the value recorded in a schema. the value is validated as add and alias would, and the cursor is advanced the same way, so states added afterwards get the same values as in the schema source.
+    def __restore_state(self, k, v):
+        k = self.__check_name(k)
+        v = self.__check_valid(v)
+        if self.__single_bit(v):
+            self.__check_limit(v)
+        else:
+            c = 1
+            while c <= v:
+                if v & c > 0 and self.__reverse.get(c) == None:
+                    raise StateCorruptionError('alias {} has unregistered state {}'.format(k, c))
+                c <<= 1
+            self.__check_limit(v, pure=False)
+        self.__set(k, v)
+
+
+    def snapshot(self, path, contents=False):
+        """Write the schema, keys, states and modification times to a binary snapshot file.
+
+        See shep.snapshot
+
+        :param path: File to write
+        :type path: str
+        :param contents: Include contents. Contents must be str or bytes
+        :type contents: bool
+        :raises ValueError: A key or contents cannot be represented in the snapshot
+        :rtype: float
+        :returns: Timestamp of the snapshot
+        """
+        (keys, states, modified) = self.__index.columns()
+        def records():
+            for (key, state, ts) in zip(keys, states, modified):
+                if key == None:
+                    continue
+                v = None
+                if contents:
+                    v = self.__contents.get(key)
+                yield (key, state, ts, v,)
+        return write_snapshot(path, self.schema(), records(), len(self.__index), with_contents=contents)
+
+
+    def restore(self, path):
+        """Load the schema, keys, states and modification times from a snapshot file.
+
+        States and aliases in the snapshot that are not registered are added. The verifier and event callback are not invoked for the restored keys.
+
+        :param path: Snapshot file
+        :type path: str
+        :raises StateCorruptionError: Snapshot schema conflicts with the registered states
+        :raises StateItemExists: A key in the snapshot is already known
+        :rtype: shep.snapshot.Snapshot
+        :returns: The closed snapshot, for its timestamp and flags
+        """
+        snapshot = Snapshot(path)
         try:
-            del self.modified_last[key]
-        except KeyError:
-            pass
+            self.apply_schema(snapshot.schema)
+            for (key, state, ts, contents) in snapshot:
+                self.__check_key(key)
+                self.__index.add(key, state, self.__decompose(state)[0])
+                self.__index.touch(key, ts)
+                if contents != None:
+                    self.__contents[key] = contents
+        finally:
+            snapshot.close()
+            if self.__times != None:
+                self.__times.rebuild(*self.__index.columns())
+        return snapshot
 
 
     def count(self):
         return self.__c
+
+
+    def count_by_state(self):
+        """Return the number of content keys in each state.
+
+        Only states that currently hold keys are included. Keys are counted by their exact state, so a key in an alias state is not counted in the atomic states of the alias.
+
+        :rtype: dict
+        :returns: Numeric state to number of keys
+        """
+        r = {}
+        for (k, v) in self.__index.counts().items():
+            if v > 0:
+                r[k] = v
+        return r
+
+
+    def histogram(self, pure=True, aliases=True):
+        """Return the number of content keys in each registered state, including empty states.
+
+        See shep.state.State.count_by_state
+
+        :param pure: Include atomic states (and the default state)
+        :type pure: bool
+        :param aliases: Include alias states
+        :type aliases: bool
+        :rtype: dict
+        :returns: State name to number of keys
+        """
+        r = {}
+        for (v, k) in self.__reverse.items():
+            if self.is_pure(v):
+                if not pure:
+                    continue
+            elif not aliases:
+                continue
+            r[self.name(v)] = self.__index.counts().get(v, 0)
+        return r
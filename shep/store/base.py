@@ -17,3 +17,11 @@ class StoreFactory:
 
     def ls(self):
         raise NotImplementedError()
+
+
+    def get_manifest(self):
+        raise NotImplementedError()
+
+
+    def put_manifest(self, b):
+        raise NotImplementedError()
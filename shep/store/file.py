@@ -2,6 +2,10 @@
 import os
 import re
 import stat
+import time
+import zlib
+import threading
+import logging
 
 # local imports
 from .base import (
@@ -10,26 +14,267 @@ from .base import (
         )
 from shep.error import StateLockedKey
 
+logg = logging.getLogger(__name__)
+
+WRITE_FAST = 'fast'
+WRITE_ATOMIC = 'atomic'
+WRITE_DURABLE = 'durable'
+
+
+def shard_dir(i, shards):
+    """Return the name of a subdirectory of a sharded state directory.
+
+    :param i: Index of the subdirectory
+    :type i: int
+    :param shards: Number of subdirectories per state
+    :type shards: int
+    :rtype: str
+    :return: Subdirectory name, in hex
+    """
+    w = len('{:x}'.format(shards - 1))
+    return '{:0{}x}'.format(i, w)
+
+
+def shard_name(k, shards):
+    """Return the name of the subdirectory of a content key in a sharded state directory.
+
+    :param k: Content key
+    :type k: str
+    :param shards: Number of subdirectories per state
+    :type shards: int
+    :rtype: str
+    :return: Subdirectory name, in hex
+    """
+    return shard_dir(zlib.crc32(k.encode('utf-8')) % shards, shards)
+
+
+class GroupSync:
+    """Sync directories to disk on behalf of many writers, sharing a single fsync per directory between writes that happen close together.
+
+    The first writer to request a sync becomes the leader. If the previous round covered more than one writer, it waits interval seconds for other writers to join. It then syncs all directories requested so far, and wakes the writers that requested them. Writers arriving while the leader is syncing are covered by the next round. A single writer is never kept waiting for others.
+
+    If a directory sync fails, the error is raised to every writer of that round.
+
+    :param interval: Seconds the leader waits for other writers before syncing
+    :type interval: float
+    """
+
+    def __init__(self, interval=0.0):
+        self.interval = interval
+        self.__cond = threading.Condition()
+        self.__pending = {}
+        self.__round = 0
+        self.__done = 0
+        self.__leader = False
+        self.__waiting = {}
+        self.__failed = {}
+        self.__last_writers = 0
+        self.writes = 0
+        self.syncs = 0
+        self.errors = 0
+
+
+    def sync(self, *paths):
+        """Sync directories to disk, returning when they have been synced.
+
+        :param paths: Directories to sync
+        :type paths: str
+        :raises OSError: A directory of the round could not be synced
+        """
+        with self.__cond:
+            for p in paths:
+                self.__pending[p] = True
+            self.writes += 1
+            mine = self.__round + 1
+            self.__waiting[mine] = self.__waiting.get(mine, 0) + 1
+            if self.__leader:
+                while self.__done < mine:
+                    self.__cond.wait()
+                return self.__finish(mine)
+            self.__leader = True
+            wait = self.__last_writers > 1
+
+        if wait and self.interval > 0:
+            time.sleep(self.interval)
+
+        while True:
+            with self.__cond:
+                pending = self.__pending
+                self.__pending = {}
+                self.__round += 1
+                r = self.__round
+                self.__last_writers = self.__waiting.get(r, 0)
+            err = None
+            for p in pending.keys():
+                fd = None
+                try:
+                    fd = os.open(p, os.O_RDONLY)
+                    os.fsync(fd)
+                except OSError as e:
+                    self.errors += 1
+                    logg.error('directory sync failed for {}: {}'.format(p, e))
+                    if err == None:
+                        err = e
+                finally:
+                    if fd != None:
+                        os.close(fd)
+            with self.__cond:
+                if err != None:
+                    self.__failed[r] = err
+                self.__done = r
+                self.syncs += 1
+                self.__cond.notify_all()
+                if len(self.__pending) == 0:
+                    self.__leader = False
+                    return self.__finish(mine)
+
+
+    # count a writer of a round as done, and raise the error of the round if there was one. must be called with the condition held.
+    def __finish(self, r):
+        e = self.__failed.get(r)
+        self.__waiting[r] -= 1
+        if self.__waiting[r] == 0:
+            del self.__waiting[r]
+            self.__failed.pop(r, None)
+        if e != None:
+            raise e
+
 
 class SimpleFileStore:
     """Filesystem store of contents for state, with one directory per state.
 
+    If shards is set, the files of the state are spread over that number of subdirectories of the state directory, by a hash of the content key. This keeps the directories small when a state holds very many keys. The subdirectories are created on the first write to them.
+
+    The write mode decides how contents are written:
+
+    * shep.store.file.WRITE_FAST writes the file in place, without syncing. Readers may see partially written contents.
+    * shep.store.file.WRITE_ATOMIC writes to a temporary file, and moves it in place. Readers see either the old or the new contents.
+    * shep.store.file.WRITE_DURABLE also syncs the temporary file before it is moved in place, and syncs the directory after. Directory syncs are shared between writes through group_sync.
+
+    Temporary files are written to tmp_path, which must be on the same filesystem as the state directory. It defaults to the directory ".tmp" next to the state directory.
+
     :param path: Filesystem base path for all state directory
     :type path: str
+    :param binary: Read and write contents as bytes
+    :type binary: bool
+    :param lock_path: If set, content keys are locked with lock files in this directory
+    :type lock_path: str
+    :param shards: Number of subdirectories to spread content keys over. If 0, all content keys are files directly in the state directory
+    :type shards: int
+    :param write_mode: Write mode
+    :type write_mode: str
+    :param tmp_path: Directory for temporary files
+    :type tmp_path: str
+    :param group_sync: Directory syncs for durable writes. If not set, the store uses its own
+    :type group_sync: shep.store.file.GroupSync
+    :param lock_manager: If set, content keys are locked with the lock manager instead of lock files in lock_path
+    :type lock_manager: shep.store.lock.StripedLock
+    :raises ValueError: Unknown write mode
     """
-    def __init__(self, path, binary=False, lock_path=None):
+    def __init__(self, path, binary=False, lock_path=None, shards=0, write_mode=WRITE_FAST, tmp_path=None, group_sync=None, lock_manager=None):
+        if write_mode not in [WRITE_FAST, WRITE_ATOMIC, WRITE_DURABLE]:
+            raise ValueError('unknown write mode {}'.format(write_mode))
         self.__path = path
         os.makedirs(self.__path, exist_ok=True)
+        self.__shards = shards
+        self.__dirs = [self.__path]
+        self.__made = set()
+        if self.__shards > 0:
+            self.__dirs = [os.path.join(self.__path, shard_dir(i, self.__shards)) for i in range(self.__shards)]
         if binary:
             self.__m = ['rb', 'wb']
         else:
             self.__m = ['r', 'w']
+        self.__lock_manager = lock_manager
         self.__lock_path = lock_path
-        if self.__lock_path != None:
+        if self.__lock_manager != None:
+            self.__lock_path = None
+        elif self.__lock_path != None:
             os.makedirs(lock_path, exist_ok=True)
+        self.__write_mode = write_mode
+        self.__tmp_path = None
+        self.__group_sync = None
+        if self.__write_mode != WRITE_FAST:
+            if tmp_path == None:
+                tmp_path = os.path.join(os.path.dirname(os.path.normpath(self.__path)), '.tmp')
+            self.__tmp_path = tmp_path
+            os.makedirs(self.__tmp_path, exist_ok=True)
+        if self.__write_mode == WRITE_DURABLE:
+            if group_sync == None:
+                group_sync = GroupSync()
+            self.__group_sync = group_sync
+
+
+    # create the shard directory of a file on the first write to it.
+    def __ensure_dir(self, fp):
+        if self.__shards == 0:
+            return
+        d = os.path.dirname(fp)
+        if d in self.__made:
+            return
+        if not os.path.isdir(d):
+            os.makedirs(d, exist_ok=True)
+            self.__sync_dirs(d)
+        self.__made.add(d)
+
+
+    # iterate the entries of a directory of the state. shard directories that have not been written to yet do not exist.
+    def __scan_dir(self, d):
+        try:
+            it = os.scandir(d)
+        except FileNotFoundError:
+            return
+        with it:
+            for v in it:
+                yield v
+
+
+    # write the contents of a content key according to the write mode.
+    def __write(self, k, fp, contents):
+        self.__ensure_dir(fp)
+        if self.__write_mode == WRITE_FAST:
+            f = open(fp, self.__m[1])
+            f.write(contents)
+            f.close()
+            return
+
+        tmp_path = os.path.join(self.__tmp_path, '{}.{}.{}'.format(k, os.getpid(), threading.get_ident()))
+        try:
+            f = open(tmp_path, self.__m[1])
+            try:
+                f.write(contents)
+                if self.__write_mode == WRITE_DURABLE:
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.replace(tmp_path, fp)
+        except Exception as e:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise e
+        self.__sync_dirs(fp)
+
+
+    # sync the directories of changed files, if writes are durable.
+    def __sync_dirs(self, *fps):
+        if self.__write_mode != WRITE_DURABLE:
+            return
+        self.__group_sync.sync(*[os.path.dirname(fp) for fp in fps])
+
+
+    # filesystem path of the file of a content key.
+    def __file(self, k):
+        if self.__shards == 0:
+            return os.path.join(self.__path, k)
+        return os.path.join(self.__path, shard_name(k, self.__shards), k)
 
 
     def __lock(self, k):
+        if self.__lock_manager != None:
+            return self.__lock_manager.acquire(k)
         if self.__lock_path == None:
             return
         fp = os.path.join(self.__lock_path, k)
@@ -44,6 +289,8 @@ class SimpleFileStore:
 
 
     def __unlock(self, k):
+        if self.__lock_manager != None:
+            return self.__lock_manager.release(k)
         if self.__lock_path == None:
             return
         fp = os.path.join(self.__lock_path, k)
@@ -62,17 +309,17 @@ class SimpleFileStore:
         :type contents: any
         """
         self.__lock(k)
-        fp = os.path.join(self.__path, k)
+        fp = self.__file(k)
         if contents == None:
             if self.__m[1] == 'wb':
                 contents = b''
             else:
                 contents = ''
 
-        f = open(fp, self.__m[1])
-        f.write(contents)
-        f.close()
-        self.__unlock(k)
+        try:
+            self.__write(k, fp, contents)
+        finally:
+            self.__unlock(k)
 
 
     def remove(self, k):
@@ -83,9 +330,55 @@ class SimpleFileStore:
         :raises FileNotFoundError: Content key does not exist in the state
         """
         self.__lock(k)
-        fp = os.path.join(self.__path, k)
-        os.unlink(fp)
-        self.__unlock(k)
+        fp = self.__file(k)
+        try:
+            os.unlink(fp)
+        finally:
+            self.__unlock(k)
+        self.__sync_dirs(fp)
+
+
+    def move(self, k, to_store):
+        """Move a content key and its contents to the store of another state, in a single filesystem operation.
+
+        :param k: Content key to move
+        :type k: str
+        :param to_store: Store of the state to move to
+        :type to_store: shep.store.file.SimpleFileStore
+        :raises FileNotFoundError: Content key does not exist in the state
+        """
+        self.__lock(k)
+        fp = self.__file(k)
+        to_fp = to_store.path(k)
+        try:
+            to_store.__ensure_dir(to_fp)
+            os.replace(fp, to_fp)
+        finally:
+            self.__unlock(k)
+        self.__sync_dirs(fp, to_fp)
+
+
+    def move_keys(self, ks, to_store, contents=True):
+        """Move several content keys to the store of another state.
+
+        The files are moved without being read, so contents are always kept. Keys that cannot be moved are reported, and the other keys are still moved.
+
+        :param ks: Content keys to move
+        :type ks: list of str
+        :param to_store: Store of the state to move to
+        :type to_store: shep.store.file.SimpleFileStore
+        :param contents: Ignored. Contents are always kept
+        :type contents: bool
+        :rtype: dict
+        :return: Content key to exception, for the keys that could not be moved
+        """
+        failed = {}
+        for k in ks:
+            try:
+                self.move(k, to_store)
+            except (OSError, StateLockedKey) as e:
+                failed[k] = e
+        return failed
 
     
     def get(self, k):
@@ -98,14 +391,27 @@ class SimpleFileStore:
         :return: Contents
         """
         self.__lock(k)
-        fp = os.path.join(self.__path, k)
-        f = open(fp, self.__m[0])
-        r = f.read()
-        f.close()
-        self.__unlock(k)
+        fp = self.__file(k)
+        try:
+            f = open(fp, self.__m[0])
+            r = f.read()
+            f.close()
+        finally:
+            self.__unlock(k)
         return r
 
 
+    def has(self, k):
+        """Check whether a content key is persisted for the state, without reading its contents.
+
+        :param k: Content key
+        :type k: str
+        :rtype: bool
+        :return: True if the key exists
+        """
+        return os.path.exists(self.__file(k))
+
+
     def list(self):
         """List all content keys persisted for the state.
 
@@ -114,20 +420,120 @@ class SimpleFileStore:
         """
         self.__lock('.list')
         files = []
-        for p in os.listdir(self.__path):
-            fp = os.path.join(self.__path, p)
-            f = None
+        try:
+            for d in self.__dirs:
+                for v in self.__scan_dir(d):
+                    (p, fp) = (v.name, v.path,)
+                    f = None
+                    try:
+                        f = open(fp, self.__m[0])
+                    except FileNotFoundError:
+                        continue
+                    r = f.read()
+                    f.close()
+                    if len(r) == 0:
+                        r = None
+                    files.append((p, r,))
+        finally:
+            self.__unlock('.list')
+        return files
+
+
+    def list_keys(self):
+        """List all content keys persisted for the state, without reading their contents.
+
+        :rtype: list of str
+        :return: Content keys in state
+        """
+        r = []
+        for d in self.__dirs:
+            r += [v.name for v in self.__scan_dir(d)]
+        return r
+
+
+    def scan(self, contents=False, chunk_size=1000):
+        """Iterate the content keys persisted for the state in chunks, without listing the whole state first.
+
+        The state directory is read incrementally, and each chunk is returned as soon as it is complete, so only one chunk of contents is held at a time.
+
+        If contents are read, the list lock is held while the files of a chunk are read, and released before the chunk is returned. Files removed while the state is scanned are skipped.
+
+        :param contents: If set, read the contents of the keys
+        :type contents: bool
+        :param chunk_size: Maximum number of content keys per chunk
+        :type chunk_size: int
+        :rtype: generator of list of tuple
+        :return: Chunks of content key and contents tuples. Contents are None if not read, or if empty
+        """
+        chunk = []
+        for d in self.__dirs:
+            for v in self.__scan_dir(d):
+                chunk.append((v.name, v.path,))
+                if len(chunk) >= chunk_size:
+                    yield self.__read_chunk(chunk, contents)
+                    chunk = []
+        if len(chunk) > 0:
+            yield self.__read_chunk(chunk, contents)
+
+
+    # read the files of a chunk of content keys listed by scan.
+    def __read_chunk(self, chunk, contents):
+        if not contents:
+            return [(v[0], None,) for v in chunk]
+        self.__lock('.list')
+        r = []
+        try:
+            for (k, fp) in chunk:
+                try:
+                    f = open(fp, self.__m[0])
+                except FileNotFoundError:
+                    continue
+                v = f.read()
+                f.close()
+                if len(v) == 0:
+                    v = None
+                r.append((k, v,))
+        finally:
+            self.__unlock('.list')
+        return r
+
+
+    def count(self):
+        """Count the content keys persisted for the state, without reading their contents.
+
+        :rtype: int
+        :return: Number of content keys in state
+        """
+        c = 0
+        for d in self.__dirs:
+            for v in self.__scan_dir(d):
+                c += 1
+        return c
+
+
+    def marker(self):
+        """Return the modification time of the state directory, which changes when content keys are added, removed or moved.
+
+        Changes of the contents of existing keys do not change the marker.
+
+        If the state directory is sharded, the latest modification time of the subdirectories is used.
+
+        Directory timestamps have limited resolution. If the directory was modified less than a second ago, later changes may not change the timestamp, and None is returned to signal that the state must be listed.
+
+        :rtype: int
+        :return: Modification time of the directory in nanoseconds, or None
+        """
+        r = 0
+        for d in self.__dirs:
             try:
-                f = open(fp, self.__m[0])
+                st = os.stat(d)
             except FileNotFoundError:
                 continue
-            r = f.read()
-            f.close()
-            if len(r) == 0:
-                r = None
-            files.append((p, r,))
-        self.__unlock('.list')
-        return files
+            if st.st_mtime_ns > r:
+                r = st.st_mtime_ns
+        if time.time_ns() - r < 1000000000:
+            return None
+        return r
 
 
     def path(self, k=None):
@@ -140,7 +546,7 @@ class SimpleFileStore:
         """
         if k == None:
             return self.__path
-        return os.path.join(self.__path, k)
+        return self.__file(k)
 
 
     def replace(self, k, contents):
@@ -152,19 +558,21 @@ class SimpleFileStore:
         :type contents: any
         """
         self.__lock(k)
-        fp = os.path.join(self.__path, k)
-        os.stat(fp)
-        f = open(fp, self.__m[1])
-        r = f.write(contents)
-        f.close()
-        self.__unlock(k)
+        fp = self.__file(k)
+        try:
+            os.stat(fp)
+            self.__write(k, fp, contents)
+        finally:
+            self.__unlock(k)
 
 
     def modified(self, k):
         self.__lock(k)
         path = self.path(k)
-        st = os.stat(path)
-        self.__unlock(k)
+        try:
+            st = os.stat(path)
+        finally:
+            self.__unlock(k)
         return st.st_ctime
 
 
@@ -177,11 +585,23 @@ class SimpleFileStoreFactory(StoreFactory):
 
     :param path: Filesystem path as base path for states
     :type path: str
+    :param shards: Number of subdirectories to spread the content keys of each state over. See shep.store.file.SimpleFileStore
+    :type shards: int
+    :param write_mode: Write mode of the stores. See shep.store.file.SimpleFileStore
+    :type write_mode: str
+    :param sync_interval: Seconds to wait for other writes before syncing directories, in durable write mode. See shep.store.file.GroupSync
+    :type sync_interval: float
+    :param lock_manager: If set, content keys are locked with the lock manager, shared by all stores of the factory, instead of the lock files used by use_lock
+    :type lock_manager: shep.store.lock.StripedLock
     """
-    def __init__(self, path, binary=False, use_lock=False):
+    def __init__(self, path, binary=False, use_lock=False, shards=0, write_mode=WRITE_FAST, sync_interval=0.0, lock_manager=None):
         self.__path = path
         self.__binary = binary
         self.__use_lock = use_lock
+        self.__shards = shards
+        self.__write_mode = write_mode
+        self.group_sync = GroupSync(interval=sync_interval)
+        self.lock_manager = lock_manager
 
 
     def add(self, k):
@@ -198,7 +618,8 @@ class SimpleFileStoreFactory(StoreFactory):
 
         k = str(k)
         store_path = os.path.join(self.__path, k)
-        return SimpleFileStore(store_path, binary=self.__binary, lock_path=lock_path)
+        tmp_path = os.path.join(self.__path, '.tmp')
+        return SimpleFileStore(store_path, binary=self.__binary, lock_path=lock_path, shards=self.__shards, write_mode=self.__write_mode, tmp_path=tmp_path, group_sync=self.group_sync, lock_manager=self.lock_manager)
 
 
     def ls(self):
@@ -218,7 +639,7 @@ class SimpleFileStoreFactory(StoreFactory):
             lock_path = os.path.join(self.__path, '.lock')
         for d in self.ls():
             p = os.path.join(self.__path, d)
-            s = SimpleFileStore(p, binary=self.__binary, lock_path=lock_path)
+            s = SimpleFileStore(p, binary=self.__binary, lock_path=lock_path, shards=self.__shards, lock_manager=self.lock_manager)
             try:
                 s.get(k)
             except:
@@ -226,5 +647,111 @@ class SimpleFileStoreFactory(StoreFactory):
             return True
 
 
+    def get_manifest(self):
+        """Read the schema manifest stored with the states.
+
+        :rtype: bytes
+        :returns: Manifest, or None if no manifest has been stored
+        """
+        fp = os.path.join(self.__path, '.manifest')
+        try:
+            f = open(fp, 'rb')
+        except FileNotFoundError:
+            return None
+        r = f.read()
+        f.close()
+        return r
+
+
+    def put_manifest(self, b):
+        """Store the schema manifest with the states, replacing any previous manifest.
+
+        The manifest is written to a temporary file first, and moved in place when complete.
+
+        :param b: Manifest
+        :type b: bytes
+        """
+        os.makedirs(self.__path, exist_ok=True)
+        fp = os.path.join(self.__path, '.manifest')
+        tmp_path = fp + '.tmp'
+        f = open(tmp_path, 'wb')
+        f.write(b)
+        f.close()
+        os.replace(tmp_path, fp)
+
+
     def close(self):
         pass
+
+
+# prefix of files set aside by migrate, because their content key is the name of a directory in the way.
+migrate_prefix = '.migrate.'
+
+
+def migrate(path, shards):
+    """Move the files of all state directories under a base path to the layout for the given number of shards.
+
+    The current layout of each state directory is detected, so flat and sharded directories can be converted in either direction, and to a different number of shards. Files already in place are left alone, so an interrupted migration can be run again.
+
+    A content key can have the same name as a subdirectory of the old or new layout. Such files are set aside in the state directory under a temporary name, and moved in place once the subdirectory has been created or removed.
+
+    Stores must not be in use while migrating.
+
+    :param path: Filesystem base path of the states, as given to shep.store.file.SimpleFileStoreFactory
+    :type path: str
+    :param shards: Number of subdirectories per state to migrate to, or 0 for a flat layout
+    :type shards: int
+    :rtype: int
+    :return: Number of files moved
+    """
+    c = 0
+    for v in os.listdir(path):
+        state_path = os.path.join(path, v)
+        if not re.match(re_processedname, v) or not os.path.isdir(state_path):
+            continue
+
+        keep = {}
+        for i in range(shards):
+            keep[shard_dir(i, shards)] = True
+
+        files = []
+        dirs = []
+        aside = []
+        for e in os.scandir(state_path):
+            if e.is_dir():
+                dirs.append(e.path)
+                for ee in os.scandir(e.path):
+                    files.append((ee.name, ee.path,))
+            elif e.name[:len(migrate_prefix)] == migrate_prefix:
+                aside.append((e.name[len(migrate_prefix):], e.path,))
+            elif keep.get(e.name) != None:
+                fp = os.path.join(state_path, migrate_prefix + e.name)
+                os.replace(e.path, fp)
+                aside.append((e.name, fp,))
+            else:
+                files.append((e.name, e.path,))
+
+        store = SimpleFileStore(state_path, shards=shards)
+        for k in keep.keys():
+            os.makedirs(os.path.join(state_path, k), exist_ok=True)
+        for (k, fp) in files:
+            new_fp = store.path(k)
+            if new_fp == fp:
+                continue
+            if os.path.isdir(new_fp):
+                aside_fp = os.path.join(state_path, migrate_prefix + k)
+                os.replace(fp, aside_fp)
+                aside.append((k, aside_fp,))
+                continue
+            os.replace(fp, new_fp)
+            c += 1
+
+        # remove subdirectories that are not part of the new layout.
+        for d in dirs:
+            if keep.get(os.path.basename(d)) == None:
+                os.rmdir(d)
+
+        for (k, fp) in aside:
+            os.replace(fp, store.path(k))
+            c += 1
+    return c
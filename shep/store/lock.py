@@ -0,0 +1,147 @@
+# standard imports
+import os
+import fcntl
+import threading
+import time
+import zlib
+
+# local imports
+from shep.error import StateLockedKey
+
+
+class StripedLock:
+    """Lock manager for content keys of shep.store.file.SimpleFileStore, using byte-range locks in a single lock file.
+
+    Content keys are hashed to a fixed number of stripes, and each stripe is a one byte range of the lock file. Keys that share a stripe share a lock. The byte-range locks are held by the process, and are released by the operating system if the process dies. Threads of the same process are excluded from each other by a thread lock per stripe.
+
+    A lock that is held by another thread or process is retried with exponential backoff until the timeout has passed. A timeout of 0 fails immediately.
+
+    The same instance must be used for all stores of a process that share the lock file, since closing any descriptor of the lock file releases all locks the process holds on it.
+
+    :param path: Lock file
+    :type path: str
+    :param stripes: Number of stripes
+    :type stripes: int
+    :param timeout: Seconds to wait for a lock before failing
+    :type timeout: float
+    :param backoff: Seconds to wait before the first retry. The wait doubles with every retry
+    :type backoff: float
+    :param max_backoff: Maximum seconds to wait between retries
+    :type max_backoff: float
+    """
+
+    def __init__(self, path, stripes=256, timeout=1.0, backoff=0.001, max_backoff=0.05):
+        d = os.path.dirname(path)
+        if d != '':
+            os.makedirs(d, exist_ok=True)
+        self.path = path
+        self.stripes = stripes
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.__locks = [threading.Lock() for i in range(stripes)]
+        self.__stats_lock = threading.Lock()
+
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+
+    def stripe(self, k):
+        """Return the stripe of a content key.
+
+        :param k: Content key
+        :type k: str
+        :rtype: int
+        """
+        return zlib.crc32(k.encode('utf-8')) % self.stripes
+
+
+    def acquire(self, k):
+        """Lock a content key, waiting up to the timeout if it is locked.
+
+        :param k: Content key
+        :type k: str
+        :raises StateLockedKey: Lock was not acquired within the timeout
+        """
+        i = self.stripe(k)
+        t = time.perf_counter()
+        deadline = t + self.timeout
+        contended = False
+
+        lock = self.__locks[i]
+        if not lock.acquire(blocking=False):
+            contended = True
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 or not lock.acquire(timeout=remaining):
+                self.__count(t, contended, True)
+                raise StateLockedKey(k)
+
+        backoff = self.backoff
+        while True:
+            try:
+                fcntl.lockf(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, i, os.SEEK_SET)
+                break
+            except OSError:
+                contended = True
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                lock.release()
+                self.__count(t, contended, True)
+                raise StateLockedKey(k)
+            time.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, self.max_backoff)
+
+        self.__count(t, contended, False)
+
+
+    def __count(self, t, contended, timeout):
+        wait = time.perf_counter() - t
+        with self.__stats_lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.acquired += 1
+            if contended:
+                self.contended += 1
+                self.wait_time += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
+
+
+    def release(self, k):
+        """Unlock a content key locked with shep.store.lock.StripedLock.acquire.
+
+        :param k: Content key
+        :type k: str
+        """
+        i = self.stripe(k)
+        fcntl.lockf(self.__fd, fcntl.LOCK_UN, 1, i, os.SEEK_SET)
+        self.__locks[i].release()
+
+
+    def metrics(self):
+        """Return the counters of the lock manager.
+
+        :rtype: dict
+        :returns: Locks acquired, acquisitions that had to wait, acquisitions that timed out, and total and maximum seconds waited for contended locks
+        """
+        with self.__stats_lock:
+            return {
+                'acquired': self.acquired,
+                'contended': self.contended,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time,
+                'max_wait': self.max_wait,
+                }
+
+
+    def close(self):
+        """Close the lock file, releasing all locks held by the process.
+        """
+        if self.__fd != None:
+            os.close(self.__fd)
+            self.__fd = None
@@ -0,0 +1,614 @@
+# standard imports
+import os
+import mmap
+import struct
+import threading
+import time
+import zlib
+import logging
+
+# local imports
+from .base import StoreFactory
+from shep.error import StateCorruptionError
+from shep.snapshot import encode_string
+
+logg = logging.getLogger(__name__)
+
+OP_PUT = 1
+OP_REMOVE = 2
+OP_MOVE = 3
+
+segment_magic = b'SHLG'
+hint_magic = b'SHLH'
+version = 1
+
+segment_header_format = '<4sHQ'
+hint_header_format = '<4sHQQQ'
+hint_entry_format = '<QQd'
+header_format = '<II'
+record_format = '<Bd'
+length_format = '<I'
+
+
+def encode_record(op, state, key, from_state, contents, ts):
+    body = struct.pack(record_format, op, ts)
+    body += encode_string(state)
+    body += encode_string(key)
+    body += encode_string(from_state)
+    body += struct.pack(length_format, len(contents)) + contents
+    return struct.pack(header_format, len(body), zlib.crc32(body)) + body
+
+
+def decode_record(b, offset):
+    (op, ts) = struct.unpack_from(record_format, b, offset)
+    offset += struct.calcsize(record_format)
+    r = []
+    for i in range(4):
+        (l,) = struct.unpack_from(length_format, b, offset)
+        offset += struct.calcsize(length_format)
+        r.append((offset, l,))
+        offset += l
+    (state, key, from_state) = [bytes(b[o:o+l]).decode('utf-8') for (o, l) in r[:3]]
+    return (op, ts, state, key, from_state, r[3][0], r[3][1],)
+
+
+# estimate of the bytes a live key takes up in a compacted segment.
+def live_size(state, key, size):
+    return struct.calcsize(header_format) + struct.calcsize(record_format) + len(state) + len(key) + size + 4 * struct.calcsize(length_format)
+
+
+class Log:
+    """Append-only segment file shared by the states of a shep.store.log.LogStoreFactory.
+
+    Every write appends a record of operation, state, content key, from state and contents to the segment. The offset and size of the contents of each live key is kept in an index in memory, by state. Moving a key between states appends a record without contents, and the index entry points to the contents of the earlier record.
+
+    Compaction writes the contents of the live keys to a new segment, and replaces the old segment with it. The index is then written to a hint file, which is also written on close. When the segment is opened, the index is loaded from the hint file if it matches the segment, and only the records appended after it was written are read. Otherwise the whole segment is read. A torn or corrupt record ends the segment, and is cut off.
+
+    The segment is only safe to use from a single process.
+
+    :param path: Directory of the segment and hint files
+    :type path: str
+    :param sync: Sync the segment to disk after every write
+    :type sync: bool
+    """
+
+    def __init__(self, path, sync=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, 'segment')
+        self.hint_path = os.path.join(path, 'hint')
+        self.__do_sync = sync
+        self.__lock = threading.RLock()
+        self.__index = {}
+        self.__versions = {}
+        self.live = 0
+        self.compactions = 0
+        self.__fd = None
+        self.__open()
+
+
+    def __open(self):
+        self.__fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self.__fd).st_size
+        l = struct.calcsize(segment_header_format)
+        if size < l:
+            os.ftruncate(self.__fd, 0)
+            self.generation = 1
+            os.write(self.__fd, struct.pack(segment_header_format, segment_magic, version, self.generation))
+            self.end = l
+            return
+
+        (m, v, self.generation) = struct.unpack(segment_header_format, os.pread(self.__fd, l, 0))
+        if m != segment_magic:
+            raise StateCorruptionError('not a segment file: {}'.format(self.path))
+        if v != version:
+            raise StateCorruptionError('unsupported segment version {}'.format(v))
+
+        self.end = self.__read_hint(size)
+        if self.end == None:
+            self.__index = {}
+            self.live = 0
+            self.end = l
+        self.__replay(size)
+
+
+    # load the index from the hint file, and return the segment offset it covers. returns none if there is no hint file, or it does not match the segment.
+    def __read_hint(self, size):
+        try:
+            f = open(self.hint_path, 'rb')
+        except FileNotFoundError:
+            return None
+        b = f.read()
+        f.close()
+
+        l = struct.calcsize(hint_header_format)
+        if len(b) < l + 4:
+            return None
+        (crc,) = struct.unpack_from('<I', b, len(b) - 4)
+        if zlib.crc32(b[:-4]) != crc:
+            logg.warning('hint file {} is corrupt, reading segment'.format(self.hint_path))
+            return None
+        (m, v, generation, end, count) = struct.unpack_from(hint_header_format, b, 0)
+        if m != hint_magic or v != version or generation != self.generation or end > size:
+            return None
+
+        offset = l
+        for i in range(count):
+            s = []
+            for j in range(2):
+                (ll,) = struct.unpack_from(length_format, b, offset)
+                offset += struct.calcsize(length_format)
+                s.append(b[offset:offset+ll].decode('utf-8'))
+                offset += ll
+            (content_offset, content_size, ts) = struct.unpack_from(hint_entry_format, b, offset)
+            offset += struct.calcsize(hint_entry_format)
+            self.__set(s[0], s[1], (content_offset, content_size, ts,))
+        return end
+
+
+    # apply the records from the current end of the index to the end of the segment.
+    def __replay(self, size):
+        if size <= self.end:
+            return
+        f = open(self.path, 'rb')
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = self.end
+        l = struct.calcsize(header_format)
+        try:
+            while offset + l <= size:
+                (body_size, crc) = struct.unpack_from(header_format, m, offset)
+                body = m[offset+l:offset+l+body_size]
+                if len(body) < body_size or zlib.crc32(body) != crc:
+                    break
+                (op, ts, state, key, from_state, content_offset, content_size) = decode_record(body, 0)
+                self.__apply(op, state, key, from_state, offset + l + content_offset, content_size, ts)
+                offset += l + body_size
+        finally:
+            m.close()
+            f.close()
+
+        if offset < size:
+            logg.warning('segment {} truncated at {} of {} bytes'.format(self.path, offset, size))
+            os.ftruncate(self.__fd, offset)
+        self.end = offset
+
+
+    def __set(self, state, key, v):
+        keys = self.__index.get(state)
+        if keys == None:
+            keys = {}
+            self.__index[state] = keys
+        old = keys.get(key)
+        if old != None:
+            self.live -= live_size(state, key, old[1])
+        keys[key] = v
+        self.live += live_size(state, key, v[1])
+
+
+    def __pop(self, state, key):
+        keys = self.__index.get(state)
+        if keys == None:
+            return None
+        v = keys.pop(key, None)
+        if v != None:
+            self.live -= live_size(state, key, v[1])
+        return v
+
+
+    def __apply(self, op, state, key, from_state, content_offset, content_size, ts):
+        if op == OP_PUT:
+            self.__set(state, key, (content_offset, content_size, ts,))
+        elif op == OP_REMOVE:
+            self.__pop(state, key)
+        elif op == OP_MOVE:
+            v = self.__pop(from_state, key)
+            if v != None:
+                self.__set(state, key, (v[0], v[1], ts,))
+        self.__versions[state] = self.__versions.get(state, 0) + 1
+        if from_state != '':
+            self.__versions[from_state] = self.__versions.get(from_state, 0) + 1
+
+
+    def write(self, records):
+        """Append records to the segment, and apply them to the index.
+
+        :param records: Operation, state, content key, from state and contents tuples. From state is an empty string for operations other than move
+        :type records: list of tuple
+        """
+        if len(records) == 0:
+            return
+        ts = time.time()
+        b = b''
+        applied = []
+        with self.__lock:
+            offset = self.end
+            for (op, state, key, from_state, contents) in records:
+                rec = encode_record(op, state, key, from_state, contents, ts)
+                applied.append((op, state, key, from_state, offset + len(b) + len(rec) - len(contents), len(contents),))
+                b += rec
+            os.write(self.__fd, b)
+            if self.__do_sync:
+                os.fsync(self.__fd)
+            self.end = offset + len(b)
+            for v in applied:
+                self.__apply(*v, ts)
+
+
+    def entry(self, state, key):
+        """Return the index entry of a content key.
+
+        :rtype: tuple
+        :returns: Offset and size of the contents, and modification time, or None if the key is not in the state
+        """
+        keys = self.__index.get(state)
+        if keys == None:
+            return None
+        return keys.get(key)
+
+
+    def read(self, state, key):
+        """Read the contents of a content key.
+
+        :raises FileNotFoundError: Content key does not exist in the state
+        :rtype: bytes
+        :returns: Contents
+        """
+        with self.__lock:
+            v = self.entry(state, key)
+            if v == None:
+                raise FileNotFoundError(key)
+            return os.pread(self.__fd, v[1], v[0])
+
+
+    def keys(self, state):
+        """Return the content keys of a state.
+
+        :rtype: list of str
+        """
+        with self.__lock:
+            return list(self.__index.get(state, {}).keys())
+
+
+    def count(self, state):
+        return len(self.__index.get(state, {}))
+
+
+    def states(self):
+        """Return the states that have content keys.
+
+        :rtype: list of str
+        """
+        with self.__lock:
+            return [k for (k, v) in self.__index.items() if len(v) > 0]
+
+
+    def version(self, state):
+        """Return the number of writes to a state since the segment was opened.
+
+        :rtype: int
+        """
+        return self.__versions.get(state, 0)
+
+
+    def dead(self):
+        """Return the estimated fraction of the segment that is taken up by records of removed, overwritten or moved keys.
+
+        :rtype: float
+        """
+        if self.end == 0:
+            return 0.0
+        return max(0.0, 1.0 - self.live / self.end)
+
+
+    def compact(self):
+        """Write the contents of all live keys to a new segment, replace the segment with it, and write the hint file.
+
+        Writes wait until compaction has completed.
+        """
+        with self.__lock:
+            generation = self.generation + 1
+            tmp_path = self.path + '.tmp'
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(struct.pack(segment_header_format, segment_magic, version, generation))
+                offset = f.tell()
+                index = {}
+                for (state, keys) in self.__index.items():
+                    for (key, v) in keys.items():
+                        contents = os.pread(self.__fd, v[1], v[0])
+                        rec = encode_record(OP_PUT, state, key, '', contents, v[2])
+                        f.write(rec)
+                        offset += len(rec)
+                        if index.get(state) == None:
+                            index[state] = {}
+                        index[state][key] = (offset - len(contents), len(contents), v[2],)
+                f.flush()
+                os.fsync(f.fileno())
+            except Exception as e:
+                f.close()
+                os.unlink(tmp_path)
+                raise e
+            f.close()
+
+            os.replace(tmp_path, self.path)
+            os.close(self.__fd)
+            self.__fd = os.open(self.path, os.O_RDWR | os.O_APPEND)
+            self.generation = generation
+            self.end = offset
+            self.__index = {}
+            self.live = 0
+            for (state, keys) in index.items():
+                for (key, v) in keys.items():
+                    self.__set(state, key, v)
+            self.write_hint()
+            self.compactions += 1
+
+
+    def write_hint(self):
+        """Write the index to the hint file.
+
+        The hint file is written to a temporary file first, and moved in place when complete.
+        """
+        with self.__lock:
+            entries = []
+            for (state, keys) in self.__index.items():
+                for (key, v) in keys.items():
+                    entries.append(encode_string(state) + encode_string(key) + struct.pack(hint_entry_format, *v))
+            b = struct.pack(hint_header_format, hint_magic, version, self.generation, self.end, len(entries))
+            b += b''.join(entries)
+            b += struct.pack('<I', zlib.crc32(b))
+            tmp_path = self.hint_path + '.tmp'
+            f = open(tmp_path, 'wb')
+            f.write(b)
+            f.close()
+            os.replace(tmp_path, self.hint_path)
+
+
+    def close(self):
+        """Write the hint file and close the segment.
+        """
+        with self.__lock:
+            if self.__fd == None:
+                return
+            self.write_hint()
+            os.close(self.__fd)
+            self.__fd = None
+
+
+class LogStore:
+    """Store of contents for a state in the segment of a shep.store.log.LogStoreFactory.
+
+    :param path: State name
+    :type path: str
+    :param log: Segment shared by the states
+    :type log: shep.store.log.Log
+    """
+    def __init__(self, path, log, binary=False):
+        self.__path = path
+        self.__log = log
+        self.__binary = binary
+
+
+    def __to_contents(self, v):
+        if v == None:
+            return b''
+        if isinstance(v, bytes):
+            return v
+        return v.encode('utf-8')
+
+
+    def __to_result(self, v):
+        if self.__binary:
+            return v
+        return v.decode('utf-8')
+
+
+    def put(self, k, contents=None):
+        self.__log.write([(OP_PUT, self.__path, k, '', self.__to_contents(contents),)])
+
+
+    def put_many(self, items):
+        self.__log.write([(OP_PUT, self.__path, k, '', self.__to_contents(contents),) for (k, contents) in items])
+
+
+    def remove(self, k):
+        if self.__log.entry(self.__path, k) == None:
+            raise FileNotFoundError(k)
+        self.__log.write([(OP_REMOVE, self.__path, k, '', b'',)])
+
+
+    def remove_many(self, ks):
+        for k in ks:
+            if self.__log.entry(self.__path, k) == None:
+                raise FileNotFoundError(k)
+        self.__log.write([(OP_REMOVE, self.__path, k, '', b'',) for k in ks])
+
+
+    def get(self, k):
+        return self.__to_result(self.__log.read(self.__path, k))
+
+
+    def get_many(self, ks):
+        return [(k, self.get(k),) for k in ks]
+
+
+    def move(self, k, to_store):
+        """Move a content key to the store of another state by appending a single record, without copying its contents.
+
+        :raises FileNotFoundError: Content key does not exist in the state
+        """
+        failed = self.move_keys([k], to_store)
+        if len(failed) > 0:
+            raise failed[k]
+
+
+    def move_keys(self, ks, to_store, contents=True):
+        """Move several content keys to the store of another state by appending a record for each, without copying their contents.
+
+        Keys that do not exist in the state are reported, and the other keys are still moved.
+
+        :param contents: Ignored. Contents are always kept
+        :type contents: bool
+        :rtype: dict
+        :return: Content key to exception, for the keys that could not be moved
+        """
+        failed = {}
+        records = []
+        for k in ks:
+            if self.__log.entry(self.__path, k) == None:
+                failed[k] = FileNotFoundError(k)
+                continue
+            records.append((OP_MOVE, to_store.__path, k, self.__path, b'',))
+        self.__log.write(records)
+        return failed
+
+
+    def has(self, k):
+        return self.__log.entry(self.__path, k) != None
+
+
+    def list(self):
+        r = []
+        for k in self.__log.keys(self.__path):
+            try:
+                v = self.get(k)
+            except FileNotFoundError:
+                continue
+            if len(v) == 0:
+                v = None
+            r.append((k, v,))
+        return r
+
+
+    def list_keys(self):
+        return self.__log.keys(self.__path)
+
+
+    def count(self):
+        return self.__log.count(self.__path)
+
+
+    def marker(self):
+        """Return the number of writes to the state since the segment was opened.
+
+        :rtype: int
+        :return: Version
+        """
+        return self.__log.version(self.__path)
+
+
+    def path(self, k=None):
+        return None
+
+
+    def replace(self, k, contents):
+        if self.__log.entry(self.__path, k) == None:
+            raise FileNotFoundError(k)
+        self.put(k, contents)
+
+
+    def modified(self, k):
+        v = self.__log.entry(self.__path, k)
+        if v == None:
+            raise FileNotFoundError(k)
+        return v[2]
+
+
+    def register_modify(self, k):
+        pass
+
+
+class LogStoreFactory(StoreFactory):
+    """Provide a method to instantiate LogStore instances, that persist all states in a single append-only segment file.
+
+    Compaction runs in a background thread, every compact_interval seconds, when the segment is larger than compact_min_size bytes and the estimated fraction of dead records exceeds compact_ratio.
+
+    :param path: Directory of the segment and hint files
+    :type path: str
+    :param sync: Sync the segment to disk after every write
+    :type sync: bool
+    :param compact_ratio: Fraction of dead records in the segment above which it is compacted
+    :type compact_ratio: float
+    :param compact_min_size: Segment size in bytes below which it is not compacted
+    :type compact_min_size: int
+    :param compact_interval: Seconds between compaction checks. If None, the segment is only compacted when compact is called
+    :type compact_interval: float
+    """
+    def __init__(self, path, binary=False, sync=False, compact_ratio=0.5, compact_min_size=1 << 20, compact_interval=10.0):
+        self.__path = path
+        self.__binary = binary
+        self.log = Log(path, sync=sync)
+        self.compact_ratio = compact_ratio
+        self.compact_min_size = compact_min_size
+        self.__cond = threading.Condition()
+        self.__closing = False
+        self.__thread = None
+        if compact_interval != None:
+            self.__thread = threading.Thread(target=self.__run, args=(compact_interval,), daemon=True)
+            self.__thread.start()
+
+
+    def add(self, k):
+        k = str(k)
+        return LogStore(k, self.log, binary=self.__binary)
+
+
+    def ls(self):
+        return self.log.states()
+
+
+    def compact(self, force=False):
+        """Compact the segment if it is larger than compact_min_size and the fraction of dead records exceeds compact_ratio.
+
+        :param force: Compact regardless of size and dead records
+        :type force: bool
+        :rtype: bool
+        :returns: True if the segment was compacted
+        """
+        if not force:
+            if self.log.end < self.compact_min_size or self.log.dead() < self.compact_ratio:
+                return False
+        self.log.compact()
+        return True
+
+
+    def __run(self, interval):
+        while True:
+            with self.__cond:
+                if not self.__closing:
+                    self.__cond.wait(timeout=interval)
+                if self.__closing:
+                    return
+            try:
+                self.compact()
+            except Exception as e:
+                logg.error('segment compaction failed: {}'.format(e))
+
+
+    def get_manifest(self):
+        fp = os.path.join(self.__path, 'manifest')
+        try:
+            f = open(fp, 'rb')
+        except FileNotFoundError:
+            return None
+        r = f.read()
+        f.close()
+        return r
+
+
+    def put_manifest(self, b):
+        fp = os.path.join(self.__path, 'manifest')
+        tmp_path = fp + '.tmp'
+        f = open(tmp_path, 'wb')
+        f.write(b)
+        f.close()
+        os.replace(tmp_path, fp)
+
+
+    def close(self):
+        if self.__thread != None:
+            with self.__cond:
+                self.__closing = True
+                self.__cond.notify_all()
+            self.__thread.join()
+            self.__thread = None
+        self.log.close()
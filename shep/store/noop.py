@@ -15,10 +15,26 @@ class NoopStore:
         pass
 
 
+    def move_keys(self, ks, to_store, contents=True):
+        return {}
+
+
+    def has(self, k):
+        return False
+
+
     def list(self):
         return []
 
 
+    def list_keys(self):
+        return []
+
+
+    def count(self):
+        return 0
+
+
     def path(self):
         return None
 
@@ -36,9 +52,21 @@ class NoopStore:
 
 class NoopStoreFactory(StoreFactory):
 
+    def __init__(self):
+        self.__manifest = None
+
+
     def add(self, k):
         return NoopStore()
 
 
     def ls(self):
         return []
+
+
+    def get_manifest(self):
+        return self.__manifest
+
+
+    def put_manifest(self, b):
+        self.__manifest = b
@@ -14,6 +14,7 @@ class RedisStore:
         self.redis = redis
         self.__path = path
         self.__binary = binary
+        self.__version = '_ver.' + path
 
 
     def __to_path(self, k):
@@ -35,12 +36,18 @@ class RedisStore:
         if contents == None:
             contents = b''
         k = self.__to_path(k)
-        self.redis.set(k, contents)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(k, contents)
+        pipe.incr(self.__version)
+        pipe.execute()
 
 
     def remove(self, k):
         k = self.__to_path(k)
-        self.redis.delete(k)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(k)
+        pipe.incr(self.__version)
+        pipe.execute()
 
 
     def get(self, k):
@@ -49,6 +56,90 @@ class RedisStore:
         return self.__to_result(v)
 
     
+    def get_many(self, ks):
+        r = []
+        vs = self.redis.mget([self.__to_path(k) for k in ks])
+        for (k, v) in zip(ks, vs):
+            r.append((k, self.__to_result(v),))
+        return r
+
+
+    def put_many(self, items):
+        pipe = self.redis.pipeline(transaction=False)
+        for (k, contents) in items:
+            if contents == None:
+                contents = b''
+            pipe.set(self.__to_path(k), contents)
+        pipe.incr(self.__version)
+        pipe.execute()
+
+
+    def remove_many(self, ks):
+        if len(ks) == 0:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(*[self.__to_path(k) for k in ks])
+        pipe.incr(self.__version)
+        pipe.execute()
+
+
+    def batch(self, ops):
+        reads = []
+        for (k, store_from, store_to, contents, dirty) in ops:
+            if store_from != None and store_from != store_to and not dirty:
+                reads.append(store_from.__to_path(k))
+        vs = {}
+        if len(reads) > 0:
+            vs = dict(zip(reads, self.redis.mget(reads)))
+
+        pipe = self.redis.pipeline(transaction=True)
+        changed = {}
+        for (k, store_from, store_to, contents, dirty) in ops:
+            if store_from != None and store_from != store_to:
+                k_from = store_from.__to_path(k)
+                if not dirty:
+                    contents = vs[k_from]
+                    if contents == None:
+                        raise FileNotFoundError(k)
+                pipe.delete(k_from)
+                changed[store_from.__version] = True
+            if contents == None:
+                contents = b''
+            pipe.set(store_to.__to_path(k), contents)
+            changed[store_to.__version] = True
+        for k in changed.keys():
+            pipe.incr(k)
+        pipe.execute()
+
+
+    def move(self, k, to_store):
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.rename(self.__to_path(k), to_store.__to_path(k))
+        pipe.incr(self.__version)
+        pipe.incr(to_store.__version)
+        pipe.execute()
+
+
+    def move_keys(self, ks, to_store, contents=True):
+        failed = {}
+        if len(ks) == 0:
+            return failed
+        pipe = self.redis.pipeline(transaction=True)
+        for k in ks:
+            pipe.rename(self.__to_path(k), to_store.__to_path(k))
+        pipe.incr(self.__version)
+        pipe.incr(to_store.__version)
+        r = pipe.execute(raise_on_error=False)
+        for (k, v) in zip(ks, r):
+            if isinstance(v, Exception):
+                failed[k] = FileNotFoundError(k)
+        return failed
+
+
+    def has(self, k):
+        return self.redis.exists(self.__to_path(k)) > 0
+
+
     def list(self):
         (cursor, matches) = self.redis.scan(match=self.__path + '.*')
 
@@ -61,6 +152,21 @@ class RedisStore:
         return r
 
 
+    def list_keys(self):
+        r = []
+        for s in self.redis.scan_iter(match=self.__path + '.*'):
+            k = self.__from_path(s)
+            r.append(k.decode('utf-8'))
+        return r
+
+
+    def count(self):
+        c = 0
+        for k in self.redis.scan_iter(match=self.__path + '.*'):
+            c += 1
+        return c
+
+
     def path(self):
         return None
 
@@ -72,7 +178,22 @@ class RedisStore:
         v = self.redis.get(k)
         if v == None:
             raise FileNotFoundError(k)
-        self.redis.set(k, contents)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(k, contents)
+        pipe.incr(self.__version)
+        pipe.execute()
+
+
+    def marker(self):
+        """Return the version of the state, which is incremented by every write to it.
+
+        :rtype: int
+        :return: Version
+        """
+        v = self.redis.get(self.__version)
+        if v == None:
+            return 0
+        return int(v)
 
 
     def modified(self, k):
@@ -105,10 +226,20 @@ class RedisStoreFactory(StoreFactory):
         self.redis.close()
 
 
+    def get_manifest(self):
+        return self.redis.get('_manifest')
+
+
+    def put_manifest(self, b):
+        self.redis.set('_manifest', b)
+
+
     def ls(self):
         r = []
         (c, ks) = self.redis.scan(match='*')
         for k in ks:
+            if k[:1] == b'_':
+                continue
             v = k.rsplit(b'.', maxsplit=1)
             if v != k:
                 v = v[0].decode('utf-8')
@@ -1,6 +1,7 @@
 # standard imports
 import datetime
 import os
+import threading
 
 # external imports
 import rocksdb
@@ -9,12 +10,52 @@ import rocksdb
 from .base import StoreFactory
 
 
+class VersionCounter:
+    """In-process counters of the versions of the states of a database.
+
+    The version of a state is read from the database the first time it is incremented, and is counted in memory after that. A database can only be opened by one process, so no increments are lost.
+
+    :param db: Database
+    :type db: rocksdb.DB
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.__lock = threading.Lock()
+        self.__versions = {}
+
+
+    def next(self, k):
+        """Increment the version of a state.
+
+        :param k: Version key of the state
+        :type k: bytes
+        :rtype: int
+        :returns: New version
+        """
+        with self.__lock:
+            v = self.__versions.get(k)
+            if v == None:
+                v = self.db.get(k)
+                if v == None:
+                    v = 0
+                else:
+                    v = int(v)
+            v += 1
+            self.__versions[k] = v
+            return v
+
+
 class RocksDbStore:
 
-    def __init__(self, path, db, binary=False):
+    def __init__(self, path, db, binary=False, versions=None):
         self.db = db
         self.__path = path
         self.__binary = binary
+        self.__version = self.__to_key('_ver.' + path)
+        if versions == None:
+            versions = VersionCounter(db)
+        self.__versions = versions
 
 
     def __to_key(self, k):
@@ -42,6 +83,12 @@ class RocksDbStore:
         return v.decode('utf-8')
 
 
+    # add an increment of the version of the state to a write batch.
+    def __bump(self, batch):
+        v = self.__versions.next(self.__version)
+        batch.put(self.__version, str(v).encode('utf-8'))
+
+
     def put(self, k, contents=b''):
         if contents == None:
             contents = b''
@@ -49,13 +96,19 @@ class RocksDbStore:
             contents = self.__to_contents(contents)
         k = self.__to_path(k)
         k = self.__to_key(k)
-        self.db.put(k, contents)
+        batch = rocksdb.WriteBatch()
+        batch.put(k, contents)
+        self.__bump(batch)
+        self.db.write(batch)
 
 
     def remove(self, k):
         k = self.__to_path(k)
         k = self.__to_key(k)
-        self.db.delete(k)
+        batch = rocksdb.WriteBatch()
+        batch.delete(k)
+        self.__bump(batch)
+        self.db.write(batch)
 
 
     def get(self, k):
@@ -64,7 +117,108 @@ class RocksDbStore:
         v = self.db.get(k)
         return self.__to_result(v)
 
+
+    def get_many(self, ks):
+        r = []
+        kbs = [self.__to_key(self.__to_path(k)) for k in ks]
+        vs = self.db.multi_get(kbs)
+        for (k, kb) in zip(ks, kbs):
+            r.append((k, self.__to_result(vs[kb]),))
+        return r
+
+
+    def put_many(self, items):
+        batch = rocksdb.WriteBatch()
+        for (k, contents) in items:
+            if contents == None:
+                contents = b''
+            else:
+                contents = self.__to_contents(contents)
+            batch.put(self.__to_key(self.__to_path(k)), contents)
+        self.__bump(batch)
+        self.db.write(batch)
+
+
+    def remove_many(self, ks):
+        batch = rocksdb.WriteBatch()
+        for k in ks:
+            batch.delete(self.__to_key(self.__to_path(k)))
+        self.__bump(batch)
+        self.db.write(batch)
+
+
+    def batch(self, ops):
+        reads = []
+        for (k, store_from, store_to, contents, dirty) in ops:
+            if store_from != None and store_from != store_to and not dirty:
+                reads.append(store_from.__to_key(store_from.__to_path(k)))
+        vs = {}
+        if len(reads) > 0:
+            vs = self.db.multi_get(reads)
+
+        batch = rocksdb.WriteBatch()
+        changed = {}
+        for (k, store_from, store_to, contents, dirty) in ops:
+            if store_from != None and store_from != store_to:
+                kb_from = store_from.__to_key(store_from.__to_path(k))
+                if not dirty:
+                    contents = vs[kb_from]
+                    if contents == None:
+                        raise FileNotFoundError(k)
+                batch.delete(kb_from)
+                changed[store_from.__version] = store_from
+            if contents == None:
+                contents = b''
+            else:
+                contents = self.__to_contents(contents)
+            batch.put(store_to.__to_key(store_to.__to_path(k)), contents)
+            changed[store_to.__version] = store_to
+        for store in changed.values():
+            store.__bump(batch)
+        self.db.write(batch)
+
+
+    def move(self, k, to_store):
+        kb = self.__to_key(self.__to_path(k))
+        v = self.db.get(kb)
+        if v == None:
+            raise FileNotFoundError(k)
+        batch = rocksdb.WriteBatch()
+        batch.put(to_store.__to_key(to_store.__to_path(k)), v)
+        batch.delete(kb)
+        self.__bump(batch)
+        to_store.__bump(batch)
+        self.db.write(batch)
+
  
+    def move_keys(self, ks, to_store, contents=True):
+        failed = {}
+        if len(ks) == 0:
+            return failed
+        kbs = [self.__to_key(self.__to_path(k)) for k in ks]
+        vs = {}
+        if contents:
+            vs = self.db.multi_get(kbs)
+        batch = rocksdb.WriteBatch()
+        for (k, kb) in zip(ks, kbs):
+            v = b''
+            if contents:
+                v = vs[kb]
+                if v == None:
+                    failed[k] = FileNotFoundError(k)
+                    continue
+            batch.put(to_store.__to_key(to_store.__to_path(k)), v)
+            batch.delete(kb)
+        self.__bump(batch)
+        to_store.__bump(batch)
+        self.db.write(batch)
+        return failed
+
+
+    def has(self, k):
+        return self.db.get(self.__to_key(self.__to_path(k))) != None
+
+
     def list(self):
         it = self.db.iteritems()
         kb_start = self.__to_key(self.__path)
@@ -83,6 +237,32 @@ class RocksDbStore:
         return r
 
 
+    def list_keys(self):
+        it = self.db.iterkeys()
+        prefix = self.__to_key(self.__path + '.')
+        it.seek(prefix)
+        r = []
+        l = len(prefix)
+        for kb in it:
+            if kb[:l] != prefix:
+                break
+            r.append(kb[l:].decode('utf-8'))
+        return r
+
+
+    def count(self):
+        it = self.db.iterkeys()
+        prefix = self.__to_key(self.__path + '.')
+        it.seek(prefix)
+        c = 0
+        l = len(prefix)
+        for kb in it:
+            if kb[:l] != prefix:
+                break
+            c += 1
+        return c
+
+
     def path(self):
         return None
 
@@ -97,7 +277,22 @@ class RocksDbStore:
         v = self.db.get(k)
         if v == None:
             raise FileNotFoundError(k)
-        self.db.put(k, contents)
+        batch = rocksdb.WriteBatch()
+        batch.put(k, contents)
+        self.__bump(batch)
+        self.db.write(batch)
+
+
+    def marker(self):
+        """Return the version of the state, which is incremented by every write to it.
+
+        :rtype: int
+        :return: Version
+        """
+        v = self.db.get(self.__version)
+        if v == None:
+            return 0
+        return int(v)
 
 
     def modified(self, k):
@@ -123,22 +318,33 @@ class RocksDbStoreFactory(StoreFactory):
             os.makedirs(path)
         self.db = rocksdb.DB(path, rocksdb.Options(create_if_missing=True))
         self.__binary = binary
+        self.versions = VersionCounter(self.db)
 
 
     def add(self, k):
         k = str(k)
-        return RocksDbStore(k, self.db, binary=self.__binary)
+        return RocksDbStore(k, self.db, binary=self.__binary, versions=self.versions)
 
 
     def close(self):
         self.db.close()
 
 
+    def get_manifest(self):
+        return self.db.get(b'_manifest')
+
+
+    def put_manifest(self, b):
+        self.db.put(b'_manifest', b)
+
+
     def ls(self):
         it = self.db.iterkeys()
         it.seek_to_first()
         r = []
         for k in it:
+            if k[:1] == b'_':
+                continue
             v = k.rsplit(b'.', maxsplit=1)
             if v != k:
                 v = v[0].decode('utf-8')
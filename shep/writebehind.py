@@ -0,0 +1,199 @@
+# standard imports
+import atexit
+import threading
+import time
+import logging
+
+# local imports
+from shep.error import (
+        StateLockedKey,
+        StateWriteError,
+        )
+
+logg = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """Buffer of pending store operations for persisted state, written to the stores in batches by a background thread.
+
+    Operations on the same key are coalesced while pending. Only the state the key was last persisted in, the state it is in now and the latest contents are kept, so a key moved several times between flushes is only written once.
+
+    The buffer is flushed when interval seconds have passed since the last flush, or earlier when more than size keys are pending. It is also flushed on close, and when the interpreter exits.
+
+    Keys for which the store reports a locked key are put back in the buffer and retried on the next flush. Keys that fail for any other reason are also put back in the buffer, and the flush raises shep.error.StateWriteError for them.
+
+    :param interval: Maximum number of seconds between flushes
+    :type interval: float
+    :param size: Number of pending keys that triggers a flush
+    :type size: int
+    """
+
+    def __init__(self, interval=1.0, size=1000):
+        self.interval = interval
+        self.size = size
+        self.__pending = {}
+        self.__cond = threading.Condition()
+        self.__flush_lock = threading.Lock()
+        self.__thread = None
+        self.__closing = False
+        self.__write = None
+
+        self.flushes = 0
+        self.written = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+
+    def __len__(self):
+        return len(self.__pending)
+
+
+    def start(self, write):
+        """Start flushing in the background.
+
+        :param write: Function writing a batch to the stores. It receives a dict of content key to from state name, to state name, contents and contents changed flag, and returns a dict of content key to exception for the keys that failed
+        :type write: function
+        """
+        self.__write = write
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+
+    # add or coalesce an operation. from state name is None if the key has not been persisted yet.
+    def __add(self, key, from_state, to_state, contents, dirty):
+        with self.__cond:
+            entry = self.__pending.get(key)
+            if entry == None:
+                self.__pending[key] = [from_state, to_state, contents, dirty]
+            else:
+                entry[1] = to_state
+                if dirty:
+                    entry[2] = contents
+                    entry[3] = True
+                self.coalesced += 1
+            if len(self.__pending) >= self.size:
+                self.__cond.notify_all()
+
+
+    def put(self, key, to_state, contents=None):
+        """Buffer the addition of a key.
+        """
+        self.__add(key, None, to_state, contents, True)
+
+
+    def move(self, key, from_state, to_state):
+        """Buffer the move of a key between the stores of two states.
+        """
+        self.__add(key, from_state, to_state, None, False)
+
+
+    def replace(self, key, state, contents):
+        """Buffer the replacement of the contents of a key.
+        """
+        self.__add(key, state, state, contents, True)
+
+
+    # put failed entries back, under any operations added for the same keys since.
+    def __requeue(self, entries):
+        with self.__cond:
+            for (key, entry) in entries.items():
+                current = self.__pending.get(key)
+                if current == None:
+                    self.__pending[key] = entry
+                    continue
+                current[0] = entry[0]
+                if not current[3] and entry[3]:
+                    current[2] = entry[2]
+                    current[3] = True
+
+
+    def flush(self):
+        """Write all pending operations to the stores.
+
+        :raises StateWriteError: Operations failed for other reasons than a locked key. They are kept in the buffer
+        :rtype: int
+        :returns: Number of keys written
+        """
+        with self.__flush_lock:
+            with self.__cond:
+                entries = self.__pending
+                self.__pending = {}
+            if len(entries) == 0:
+                return 0
+
+            t = time.time()
+            failed = self.__write(entries)
+            latency = time.time() - t
+
+            retry = {}
+            errors = {}
+            for (key, e) in failed.items():
+                retry[key] = entries[key]
+                if not isinstance(e, StateLockedKey):
+                    self.errors += 1
+                    errors[key] = e
+                    logg.error('write behind failed for {}: {}'.format(key, e))
+            self.__requeue(retry)
+
+            c = len(entries) - len(failed)
+            self.flushes += 1
+            self.written += c
+            self.last_latency = latency
+            self.total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        if len(errors) > 0:
+            raise StateWriteError(errors)
+        return c
+
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                if len(self.__pending) < self.size and not self.__closing:
+                    self.__cond.wait(timeout=self.interval)
+                if self.__closing:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logg.error('write behind flush failed: {}'.format(e))
+
+
+    def metrics(self):
+        """Return the counters of the buffer.
+
+        :rtype: dict
+        :returns: Pending keys (depth), number of flushes, keys written, operations coalesced, failed keys, and last, maximum and average flush latency in seconds
+        """
+        average = 0.0
+        if self.flushes > 0:
+            average = self.total_latency / self.flushes
+        return {
+            'depth': len(self.__pending),
+            'flushes': self.flushes,
+            'written': self.written,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'average_latency': average,
+            }
+
+
+    def close(self):
+        """Stop the background thread and write all pending operations.
+        """
+        if self.__thread != None:
+            with self.__cond:
+                self.__closing = True
+                self.__cond.notify_all()
+            self.__thread.join()
+            self.__thread = None
+            atexit.unregister(self.close)
+        if self.__write != None:
+            self.flush()
@@ -0,0 +1,71 @@
+# standard imports
+import unittest
+
+# external imports
+try:
+    import numpy
+except ModuleNotFoundError:
+    numpy = None
+
+# local imports
+from shep import State
+from shep.compact import CompactState
+
+
+def setup_states(cls):
+    states = cls(3)
+    states.add('foo')
+    states.add('bar')
+    states.add('baz')
+    states.alias('xyzzy', states.FOO, states.BAR)
+    states.put('abcd')
+    states.put('bcde', state=states.FOO)
+    states.put('cdef', state=states.FOO)
+    states.put('defg', state=states.XYZZY)
+    states.put('efgh', state=states.BAR)
+    states.purge('efgh')
+    states.modified_last['abcd'] = 1000.0
+    states.modified_last['bcde'] = 1000.0
+    states.modified_last['cdef'] = 4600.0
+    states.modified_last['defg'] = 8200.0
+    return states
+
+
+@unittest.skipIf(numpy == None, 'numpy not available')
+class TestAnalytics(unittest.TestCase):
+
+    def columns(self, cls):
+        from shep.analytics import StateColumns
+        return StateColumns(setup_states(cls))
+
+
+    def test_columns(self):
+        for cls in [State, CompactState]:
+            c = self.columns(cls)
+            self.assertEqual(len(c), 4)
+            self.assertEqual(list(c.keys), ['abcd', 'bcde', 'cdef', 'defg'])
+            self.assertEqual(c.states.tolist(), [0, 1, 1, 3])
+            self.assertEqual(c.histogram(), {0: 1, 1: 2, 3: 1})
+
+
+    def test_ages(self):
+        for cls in [State, CompactState]:
+            c = self.columns(cls)
+            r = c.age_percentiles(percentiles=(0, 100,), now=10000.0)
+            self.assertEqual(r[1].tolist(), [5400.0, 9000.0])
+            self.assertEqual(r[3].tolist(), [1800.0, 1800.0])
+
+            r = c.stale(1, 6000, now=10000.0)
+            self.assertEqual(list(c.keys[r]), ['bcde'])
+
+            r = c.mask(required=1)
+            self.assertEqual(list(c.keys[r]), ['bcde', 'cdef', 'defg'])
+            r = c.mask(required=1, forbidden=2)
+            self.assertEqual(list(c.keys[r]), ['bcde', 'cdef'])
+
+            r = c.modified_per_hour(hours=3, now=10000.0)
+            self.assertEqual(r.tolist(), [1, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
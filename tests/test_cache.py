@@ -0,0 +1,119 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+
+# local imports
+from shep import State
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+from shep.cache import ContentCache
+
+
+class TestContentCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = ContentCache(max_items=2)
+        cache.put('foo', 'foo')
+        cache.put('bar', None)
+        self.assertEqual(cache.lookup('foo'), (True, 'foo',))
+        cache.put('baz', 'baz')
+        self.assertEqual(cache.lookup('bar'), (False, None,))
+        self.assertEqual(cache.lookup('foo'), (True, 'foo',))
+        self.assertEqual(cache.metrics(), {'items': 2, 'size': 6, 'hits': 2, 'misses': 1, 'evictions': 1})
+
+
+    def test_size(self):
+        cache = ContentCache(max_size=10)
+        cache.put('foo', 'xxxx')
+        cache.put('bar', 'yyyy')
+        cache.put('baz', 'zzzz')
+        self.assertNotIn('foo', cache)
+        self.assertEqual(cache.size, 8)
+        cache.put('bar', 'y')
+        self.assertEqual(cache.size, 5)
+        cache.put('xyzzy', 'x' * 11)
+        self.assertNotIn('xyzzy', cache)
+        self.assertEqual(cache.evictions, 1)
+        cache.remove('bar')
+        self.assertEqual(cache.size, 4)
+
+
+class TestPersistedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.factory = SimpleFileStoreFactory(self.d)
+        self.cache = ContentCache(max_items=2)
+        self.states = PersistedState(self.factory.add, 2, cache=self.cache)
+        self.states.add('foo')
+        self.states.add('bar')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+
+    def test_get(self):
+        self.states.put('abcd', contents='abcd')
+        self.states.put('bcde', contents='bcde')
+        self.states.put('cdef', state=self.states.FOO)
+        self.assertEqual(State.get(self.states, 'abcd'), None)
+        self.assertEqual(self.cache.evictions, 1)
+
+        self.assertEqual(self.states.get('abcd'), 'abcd')
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.states.get('abcd'), 'abcd')
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.states.get('cdef'), None)
+        self.assertEqual(self.states.get('xxxx'), None)
+
+
+    def test_coherence(self):
+        self.states.put('abcd', contents='abcd')
+        self.states.move('abcd', self.states.FOO)
+        self.assertEqual(self.states.get('abcd'), 'abcd')
+        self.states.replace('abcd', 'foo')
+        self.assertEqual(self.states.get('abcd'), 'foo')
+
+        self.states.put('bcde')
+        self.states.put('cdef')
+        self.assertNotIn('abcd', self.cache)
+        self.states.move('abcd', self.states.BAR)
+        self.assertEqual(self.states.get('abcd'), 'foo')
+
+        self.states.purge('abcd')
+        self.assertNotIn('abcd', self.cache)
+        self.assertEqual(self.states.get('abcd'), None)
+
+        states = PersistedState(self.factory.add, 2, cache=ContentCache())
+        states.add('foo')
+        states.add('bar')
+        states.sync()
+        self.assertEqual(State.get(states, 'abcd'), None)
+        self.assertEqual(states.get('abcd'), 'foo')
+
+
+    def test_keys_only(self):
+        self.states.put('abcd', contents='abcd')
+        self.states.put('bcde')
+        self.states.put('cdef')
+        self.states.move_many(['bcde', 'cdef'], self.states.FOO)
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'FOO', 'bcde')))
+        self.assertFalse(os.path.exists(os.path.join(self.d, 'NEW', 'cdef')))
+
+        cache = ContentCache()
+        states = PersistedState(self.factory.add, 2, cache=cache)
+        states.add('foo')
+        states.add('bar')
+        states.sync()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(sorted(states.list(states.FOO)), ['bcde', 'cdef'])
+        self.assertEqual(states.get('abcd'), 'abcd')
+        self.assertEqual(states.get('bcde'), None)
+        self.assertEqual(cache.misses, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+# standard imports
+import unittest
+import logging
+import random
+
+# local imports
+from shep import State
+from shep.compact import CompactState
+from shep.error import (
+        StateItemExists,
+        StateItemNotFound,
+        StateInvalid,
+        )
+
+logging.basicConfig(level=logging.DEBUG)
+logg = logging.getLogger()
+
+
+def setup_states(cls):
+    states = cls(3)
+    states.add('foo')
+    states.add('bar')
+    states.add('baz')
+    states.alias('xyzzy', states.FOO, states.BAR)
+    states.alias('plugh', states.BAR, states.BAZ)
+    return states
+
+
+class TestCompactState(unittest.TestCase):
+
+    def setUp(self):
+        self.states = setup_states(CompactState)
+
+
+    def test_put_move(self):
+        self.states.put('abcd', contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        with self.assertRaises(StateItemExists):
+            self.states.put('abcd')
+        self.assertEqual(self.states.get('abcd'), 'foo')
+        self.assertEqual(self.states.state('bcde'), self.states.FOO)
+
+        self.states.next('abcd')
+        self.states.set('abcd', self.states.BAR)
+        self.assertEqual(self.states.state('abcd'), self.states.XYZZY)
+        self.assertEqual(self.states.list(self.states.FOO), ['abcd', 'bcde'])
+        self.assertEqual(self.states.list(self.states.XYZZY), ['abcd'])
+        self.assertEqual(self.states.list(self.states.BAR), ['abcd'])
+        self.assertEqual(self.states.list(self.states.NEW), [])
+
+        self.states.unset('abcd', self.states.FOO)
+        self.assertEqual(self.states.list(self.states.XYZZY), [])
+        self.assertEqual(self.states.list(self.states.BAR), ['abcd'])
+
+        with self.assertRaises(StateInvalid):
+            self.states.move('abcd', self.states.FOO | self.states.BAZ)
+
+        a = self.states.modified('abcd')
+        self.assertEqual(self.states.modified_last['abcd'], a)
+
+        self.states.purge('abcd')
+        with self.assertRaises(StateItemNotFound):
+            self.states.state('abcd')
+        self.assertEqual(self.states.list(self.states.BAR), [])
+
+        self.states.put('cdef', state=self.states.PLUGH)
+        self.assertEqual(self.states.list(self.states.PLUGH), ['cdef'])
+        self.assertEqual(len(self.states.modified_last), 2)
+
+
+    def test_equivalence(self):
+        r = random.Random(42)
+        ref = setup_states(State)
+        targets = ref.all(numeric=True)
+        keys = []
+        for i in range(2000):
+            op = r.randrange(10)
+            if op < 3 or len(keys) == 0:
+                k = 'k{}'.format(i)
+                s = r.choice(targets)
+                ref.put(k, state=s)
+                self.states.put(k, state=s)
+                keys.append(k)
+            elif op < 9:
+                k = r.choice(keys)
+                s = r.choice(targets)
+                ref.move(k, s)
+                self.states.move(k, s)
+            else:
+                k = keys.pop(r.randrange(len(keys)))
+                ref.purge(k)
+                self.states.purge(k)
+
+        for s in targets:
+            self.assertEqual(sorted(self.states.list(s)), sorted(ref.list(s)))
+            q = self.states.query(required=s)
+            self.assertEqual(sorted(q), sorted(ref.query(required=s)))
+        self.assertEqual(self.states.count_by_state(), ref.count_by_state())
+        for k in keys:
+            self.assertEqual(self.states.state(k), ref.state(k))
+
+
+    def test_query_forbidden_optional(self):
+        self.states.put('abcd', state=self.states.FOO)
+        self.states.put('bcde', state=self.states.XYZZY)
+        r = list(self.states.query(optional=self.states.FOO, forbidden=self.states.FOO))
+        self.assertEqual(r, [])
+        r = list(self.states.query(optional=self.states.FOO | self.states.BAR, forbidden=self.states.BAR))
+        self.assertEqual(r, ['abcd'])
+
+
+    def test_modified_since(self):
+        self.__check_modified(self.states)
+
+
+    def test_modified_since_time_index(self):
+        self.__check_modified(setup_states(lambda bits: CompactState(bits, time_index=True)))
+
+
+    def __check_modified(self, states):
+        r = random.Random(42)
+        targets = states.all(numeric=True)
+        keys = []
+        for i in range(2000):
+            op = r.randrange(10)
+            if op < 3 or len(keys) == 0:
+                k = 'k{}'.format(i % 500)
+                if k in keys:
+                    continue
+                states.put(k, state=r.choice(targets))
+                keys.append(k)
+            elif op < 9:
+                states.move(r.choice(keys), r.choice(targets))
+            else:
+                k = keys.pop(r.randrange(len(keys)))
+                states.purge(k)
+
+        r = states.modified_since(0)
+        self.assertEqual(sorted(r), sorted(keys))
+        for s in targets:
+            expect = [k for k in keys if states.state(k) == s]
+            expect.sort(key=states.modified)
+            self.assertEqual(states.modified_since(0, state=s), expect)
+            self.assertEqual(states.oldest(s, n=5), expect[:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
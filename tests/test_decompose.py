@@ -0,0 +1,102 @@
+# standard imports
+import unittest
+import logging
+import time
+
+# local imports
+from shep import State
+from shep.state import join_elements
+
+logging.basicConfig(level=logging.DEBUG)
+logg = logging.getLogger()
+
+
+# uncached bit loops, as used before the decomposition cache was added
+def ref_is_pure(bits, v):
+    if v == 0:
+        return True
+    c = 1
+    for i in range(bits):
+        if c & v > 0:
+            break
+        c <<= 1
+    return c == v
+
+
+def ref_elements(states, bits, v):
+    r = []
+    c = 1
+    for i in range(bits):
+        if (v & c) > 0:
+            r.append(states.name(c))
+        c <<= 1
+    if len(r) == 1:
+        return states.name(v)
+    return join_elements(r)
+
+
+def ref_match(states, bits, v):
+    r = []
+    c = 1
+    for i in range(bits):
+        if v & c > 0:
+            try:
+                r.append(states.name(c))
+            except KeyError:
+                pass
+        c <<= 1
+    return r
+
+
+class TestDecompose(unittest.TestCase):
+
+    def setUp(self):
+        self.bits = 8
+        self.states = State(self.bits, check_alias=False)
+        for i in range(self.bits):
+            self.states.add('s' + 'abcdefgh'[i])
+
+
+    def test_equivalence(self):
+        for v in range(1, 1 << self.bits):
+            self.assertEqual(self.states.is_pure(v), ref_is_pure(self.bits, v))
+            self.assertEqual(self.states.elements(v), ref_elements(self.states, self.bits, v))
+            self.assertEqual(self.states.match(v, pure=True)[1], ref_match(self.states, self.bits, v))
+
+
+    def test_invalidate(self):
+        states = State(3)
+        states.add('foo')
+        states.add('bar')
+        v = states.FOO | states.BAR | 4
+        self.assertEqual(states.match(v)[1], ['FOO', 'BAR'])
+        states.add('baz')
+        self.assertEqual(states.match(v)[1], ['FOO', 'BAR', 'BAZ'])
+        self.assertEqual(states.elements(v), '_FOO__BAR__BAZ')
+
+
+    def test_bench(self):
+        n = 2000
+        values = list(range(1, 1 << self.bits))
+
+        t = time.perf_counter()
+        for i in range(n // 100):
+            for v in values:
+                ref_is_pure(self.bits, v)
+                ref_elements(self.states, self.bits, v)
+                ref_match(self.states, self.bits, v)
+        before = (time.perf_counter() - t) / ((n // 100) * len(values))
+
+        t = time.perf_counter()
+        for i in range(n // 100):
+            for v in values:
+                self.states.is_pure(v)
+                self.states.elements(v)
+                self.states.match(v, pure=True)
+        after = (time.perf_counter() - t) / ((n // 100) * len(values))
+
+        logg.info('is_pure+elements+match per call: uncached {:.2f}us cached {:.2f}us'.format(before * 1000000, after * 1000000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,15 +3,25 @@ import unittest
 import tempfile
 import os
 import shutil
+import threading
+import time
 
 # local imports
 from shep.persist import PersistedState
-from shep.store.file import SimpleFileStoreFactory
+from shep.store.file import (
+        SimpleFileStoreFactory,
+        GroupSync,
+        shard_name,
+        migrate,
+        WRITE_ATOMIC,
+        WRITE_DURABLE,
+        )
 from shep.error import (
         StateExists,
         StateInvalid,
         StateItemExists,
         StateLockedKey,
+        StateItemNotFound,
         )
 
 
@@ -335,5 +345,399 @@ class TestFileStore(unittest.TestCase):
         self.assertEqual(states.state(item), states._FOO__BAR)
 
 
+    def test_move_many(self):
+        self.states.alias('xyzzy', self.states.FOO | self.states.BAR)
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        self.states.put('cdef', state=self.states.BAR, contents='bar')
+
+        (r, e) = self.states.move_many(['abcd', 'bcde', 'cdef'], self.states.BAZ)
+        self.assertEqual(len(r), 3)
+        self.assertEqual(len(e), 0)
+        for k in ['abcd', 'bcde', 'cdef']:
+            fp = os.path.join(self.d, 'BAZ', k)
+            os.stat(fp)
+        fp = os.path.join(self.d, 'FOO', 'abcd')
+        with self.assertRaises(FileNotFoundError):
+            os.stat(fp)
+
+        fp = os.path.join(self.d, 'BAZ', 'cdef')
+        f = open(fp, 'r')
+        v = f.read()
+        f.close()
+        self.assertEqual(v, 'bar')
+
+        self.states.move_many(['abcd', 'bcde'], self.states.FOO)
+        (r, e) = self.states.set_many(['abcd', 'bcde', 'cdef'], self.states.BAR)
+        self.assertEqual(r['abcd'], self.states.XYZZY)
+        self.assertIsInstance(e['cdef'], StateInvalid)
+        fp = os.path.join(self.d, 'XYZZY', 'abcd')
+        os.stat(fp)
+        fp = os.path.join(self.d, 'FOO', 'abcd')
+        with self.assertRaises(FileNotFoundError):
+            os.stat(fp)
+
+        (r, e) = self.states.set_many(['abcd'], self.states.BAR)
+        self.assertEqual(r['abcd'], self.states.XYZZY)
+
+        (r, e) = self.states.unset_many(['abcd', 'bcde'], self.states.FOO)
+        self.assertEqual(len(r), 2)
+        fp = os.path.join(self.d, 'BAR', 'bcde')
+        os.stat(fp)
+
+
+    def test_count_persisted(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        self.states.put('cdef', state=self.states.BAR)
+
+        fp = os.path.join(self.d, 'FOO', 'defg')
+        f = open(fp, 'w')
+        f.close()
+
+        self.assertEqual(self.states.count_persisted(self.states.FOO), 3)
+        r = self.states.count_persisted()
+        self.assertEqual(r, {'NEW': 0, 'FOO': 3, 'BAR': 1, 'BAZ': 0})
+
+
+    def test_move_many_missing(self):
+        for k in ['a', 'b', 'c']:
+            self.states.put(k)
+        os.unlink(os.path.join(self.d, 'NEW', 'b'))
+
+        (r, e) = self.states.move_many(['a', 'b', 'c'], self.states.FOO)
+        self.assertEqual(sorted(r.keys()), ['a', 'c'])
+        self.assertIsInstance(e['b'], FileNotFoundError)
+        self.assertEqual(self.states.state('b'), self.states.NEW)
+        self.assertEqual(sorted(self.states.list(self.states.FOO)), ['a', 'c'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.d, 'FOO'))), ['a', 'c'])
+        self.assertEqual(os.listdir(os.path.join(self.d, 'NEW')), [])
+
+
+    def test_move_many_missing_verify(self):
+        events = []
+        def verify(state, key, from_state, to_state):
+            if to_state == state.NEW:
+                return 'no way back'
+        def callback(key, from_state, to_state):
+            events.append((key, from_state, to_state,))
+        states = PersistedState(self.factory.add, 3, verifier=verify, event_callback=callback)
+        states.add('foo')
+        states.put('a', contents='foo')
+        states.put('b', contents='bar')
+        os.unlink(os.path.join(self.d, 'NEW', 'b'))
+        events.clear()
+
+        (r, e) = states.move_many(['a', 'b'], states.FOO)
+        self.assertEqual(list(r.keys()), ['a'])
+        self.assertEqual(states.state('b'), states.NEW)
+        self.assertEqual(states.get('b'), 'bar')
+        self.assertEqual(sorted(events), [('a', 'NEW', 'FOO',), ('b', 'NEW', 'FOO',)])
+
+
+    def test_store_move(self):
+        self.states.alias('xyzzy', self.states.BAR | self.states.BAZ)
+        self.states.alias('plugh', self.states.FOO | self.states.BAZ)
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        fp = os.path.join(self.d, 'FOO', 'abcd')
+        ino = os.stat(fp).st_ino
+
+        self.states.move('abcd', self.states.BAR)
+        fp = os.path.join(self.d, 'BAR', 'abcd')
+        self.assertEqual(os.stat(fp).st_ino, ino)
+
+        self.states.set('abcd', self.states.BAZ)
+        self.states.unset('abcd', self.states.BAR)
+        self.states.change('abcd', self.states.FOO, self.states.BAZ)
+        fp = os.path.join(self.d, 'FOO', 'abcd')
+        self.assertEqual(os.stat(fp).st_ino, ino)
+        self.assertEqual(self.states.get('abcd'), 'foo')
+
+        store_from = self.factory.add('FOO')
+        store_to = self.factory.add('BAR')
+        with self.assertRaises(FileNotFoundError):
+            store_from.move('bcde', store_to)
+
+
+    def test_sync_delta(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        self.states.put('cdef', state=self.states.BAR)
+
+        # another process moves, removes and adds keys
+        os.rename(os.path.join(self.d, 'FOO', 'abcd'), os.path.join(self.d, 'BAR', 'abcd'))
+        os.unlink(os.path.join(self.d, 'BAR', 'cdef'))
+        f = open(os.path.join(self.d, 'BAZ', 'defg'), 'w')
+        f.write('baz')
+        f.close()
+
+        self.states.sync()
+        self.assertEqual(self.states.state('abcd'), self.states.BAR)
+        self.assertEqual(self.states.get('abcd'), 'foo')
+        self.assertEqual(self.states.state('bcde'), self.states.FOO)
+        self.assertEqual(self.states.state('defg'), self.states.BAZ)
+        self.assertEqual(self.states.get('defg'), 'baz')
+        with self.assertRaises(StateItemNotFound):
+            self.states.state('cdef')
+
+
+    def test_sync_delta_one(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        self.states.sync(self.states.FOO)
+
+        # another process moves a key to a state that is not synced here
+        os.rename(os.path.join(self.d, 'FOO', 'abcd'), os.path.join(self.d, 'BAZ', 'abcd'))
+        os.unlink(os.path.join(self.d, 'FOO', 'bcde'))
+
+        self.states.sync(self.states.FOO)
+        self.assertEqual(self.states.state('abcd'), self.states.BAZ)
+        self.assertEqual(self.states.get('abcd'), 'foo')
+        with self.assertRaises(StateItemNotFound):
+            self.states.state('bcde')
+
+
+    def test_sync_marker(self):
+        self.states.put('abcd', state=self.states.FOO)
+        self.states.put('bcde', state=self.states.FOO)
+        fp = os.path.join(self.d, 'FOO')
+        os.utime(fp, ns=(1000000000, 1000000000))
+        self.states.sync(self.states.FOO)
+
+        # unchanged marker, the state is not listed
+        os.unlink(os.path.join(fp, 'bcde'))
+        os.utime(fp, ns=(1000000000, 1000000000))
+        self.states.sync(self.states.FOO)
+        self.assertEqual(self.states.state('bcde'), self.states.FOO)
+
+        os.utime(fp, ns=(2000000000, 2000000000))
+        self.states.sync(self.states.FOO)
+        with self.assertRaises(StateItemNotFound):
+            self.states.state('bcde')
+        self.assertEqual(self.states.state('abcd'), self.states.FOO)
+
+
+    def test_sync_parallel(self):
+        for i in range(10):
+            self.states.put('foo{}'.format(i), state=self.states.FOO, contents='foo')
+            self.states.put('bar{}'.format(i), state=self.states.BAR)
+        self.states.put('baz', state=self.states.BAZ, contents='baz')
+        os.rename(os.path.join(self.d, 'FOO', 'foo0'), os.path.join(self.d, 'BAZ', 'foo0'))
+
+        states = PersistedState(self.factory.add, 3, sync_workers=4)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.sync()
+        self.assertEqual(sorted(states.list(states.FOO)), ['foo{}'.format(i) for i in range(1, 10)])
+        self.assertEqual(sorted(states.list(states.BAR)), sorted(self.states.list(states.BAR)))
+        self.assertEqual(states.state('foo0'), states.BAZ)
+        self.assertEqual(states.get('foo0'), 'foo')
+        self.assertEqual(list(states.sync_timing.keys()), ['NEW', 'FOO', 'BAR', 'BAZ'])
+
+        self.states.sync()
+        self.assertEqual(self.states.state('foo0'), states.BAZ)
+        self.assertEqual(self.states.count_by_state(), states.count_by_state())
+
+
+    def test_lazy(self):
+        self.states.alias('xyzzy', self.states.FOO | self.states.BAR)
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.BAR)
+        self.states.put('cdef', state=self.states.XYZZY)
+        self.states.put('defg', state=self.states.BAZ, contents='baz')
+
+        states = PersistedState(self.factory.add, 3, lazy=True)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.alias('xyzzy', states.FOO | states.BAR)
+
+        self.assertEqual(states.get('defg'), 'baz')
+        self.assertEqual(states.state('defg'), states.BAZ)
+        with self.assertRaises(StateItemNotFound):
+            states.state('xxxx')
+        self.assertEqual(states.columns()[0], ['defg'])
+
+        os.unlink(os.path.join(self.d, 'BAZ', 'defg'))
+        self.assertEqual(states.list(states.BAZ), [])
+        self.assertEqual(sorted(states.list(states.FOO)), ['abcd', 'cdef'])
+
+        # loaded states are not listed again
+        f = open(os.path.join(self.d, 'FOO', 'efgh'), 'w')
+        f.close()
+        self.assertEqual(sorted(states.list(states.FOO)), ['abcd', 'cdef'])
+
+        with self.assertRaises(StateItemExists):
+            states.put('bcde')
+
+        states.move('bcde', states.BAZ)
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'BAZ', 'bcde')))
+        self.assertEqual(states.count_by_state(), {states.FOO: 1, states.XYZZY: 1, states.BAZ: 1})
+
+
+    def test_sharded(self):
+        factory = SimpleFileStoreFactory(self.d, shards=16)
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.add('bar')
+        for i in range(20):
+            states.put('foo{}'.format(i), state=states.FOO, contents='foo')
+        states.move('foo0', states.BAR)
+
+        self.assertEqual(len(os.listdir(os.path.join(self.d, 'FOO'))), len(set([shard_name('foo{}'.format(i), 16) for i in range(20)])))
+        fp = os.path.join(self.d, 'BAR', shard_name('foo0', 16), 'foo0')
+        self.assertEqual(states.path(states.BAR, 'foo0'), fp)
+        self.assertTrue(os.path.exists(fp))
+
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.add('bar')
+        states.sync()
+        self.assertEqual(len(states.list(states.FOO)), 19)
+        self.assertEqual(states.get('foo0'), 'foo')
+        self.assertEqual(states.count_persisted(states.FOO), 19)
+
+
+    def test_sharded_lazy(self):
+        factory = SimpleFileStoreFactory(self.d, shards=16)
+        store = factory.add('FOO')
+        self.assertEqual(os.listdir(os.path.join(self.d, 'FOO')), [])
+        self.assertEqual(store.list(), [])
+        self.assertEqual(store.count(), 0)
+        self.assertEqual(list(store.scan()), [])
+        store.marker()
+
+        store.put('foo', contents='bar')
+        self.assertEqual(os.listdir(os.path.join(self.d, 'FOO')), [shard_name('foo', 16)])
+
+        to_store = factory.add('BAR')
+        store.move('foo', to_store)
+        self.assertEqual(os.listdir(os.path.join(self.d, 'BAR')), [shard_name('foo', 16)])
+        self.assertEqual(to_store.get('foo'), 'bar')
+
+
+    def test_migrate(self):
+        for i in range(20):
+            self.states.put('foo{}'.format(i), state=self.states.FOO, contents='foo')
+        self.states.put('bar', state=self.states.BAR)
+
+        self.assertEqual(migrate(self.d, 16), 21)
+        self.assertEqual(migrate(self.d, 16), 0)
+        self.assertEqual(migrate(self.d, 256), 21)
+        self.assertEqual(len(os.listdir(os.path.join(self.d, 'FOO'))), 256)
+
+        factory = SimpleFileStoreFactory(self.d, shards=256)
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.add('bar')
+        states.sync()
+        self.assertEqual(len(states.list(states.FOO)), 20)
+        self.assertEqual(states.state('bar'), states.BAR)
+
+        self.assertEqual(migrate(self.d, 0), 21)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.d, 'BAR'))), ['bar'])
+
+
+    def test_migrate_shard_name(self):
+        self.states.put('0a', state=self.states.FOO, contents='foo')
+        self.states.put('3', state=self.states.FOO, contents='bar')
+
+        self.assertEqual(migrate(self.d, 256), 2)
+        self.assertTrue(os.path.isdir(os.path.join(self.d, 'FOO', '0a')))
+        self.assertEqual(migrate(self.d, 16), 2)
+        self.assertEqual(migrate(self.d, 0), 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.d, 'FOO'))), ['0a', '3'])
+
+        store = SimpleFileStoreFactory(self.d).add('FOO')
+        self.assertEqual(store.get('0a'), 'foo')
+        self.assertEqual(store.get('3'), 'bar')
+
+
+    def test_scan(self):
+        factory = SimpleFileStoreFactory(self.d, use_lock=True)
+        store = factory.add('FOO')
+        for i in range(5):
+            store.put('foo{}'.format(i), contents='foo')
+        store.put('bar')
+
+        it = store.scan(contents=True, chunk_size=2)
+        chunk = next(it)
+        self.assertEqual(len(chunk), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.d, '.lock', '.list')))
+        r = chunk
+        for chunk in it:
+            r += chunk
+        self.assertEqual(sorted(r), [('bar', None)] + [('foo{}'.format(i), 'foo') for i in range(5)])
+        self.assertEqual([len(v) for v in store.scan(chunk_size=4)], [4, 2])
+
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.sync_chunk_size = 2
+        states.sync()
+        self.assertEqual(len(states.list(states.FOO)), 6)
+        self.assertEqual(states.get('foo0'), 'foo')
+
+
+    def test_write_atomic(self):
+        factory = SimpleFileStoreFactory(self.d, write_mode=WRITE_ATOMIC)
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.put('abcd', state=states.FOO, contents='foo')
+        ino = os.stat(os.path.join(self.d, 'FOO', 'abcd')).st_ino
+        states.replace('abcd', 'bar')
+        self.assertNotEqual(os.stat(os.path.join(self.d, 'FOO', 'abcd')).st_ino, ino)
+        self.assertEqual(os.listdir(os.path.join(self.d, '.tmp')), [])
+        self.assertNotIn('.tmp', factory.ls())
+
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.sync()
+        self.assertEqual(states.list(states.FOO), ['abcd'])
+        self.assertEqual(states.get('abcd'), 'bar')
+
+        with self.assertRaises(ValueError):
+            SimpleFileStoreFactory(self.d, write_mode='foo').add('FOO')
+
+
+    def test_write_durable(self):
+        factory = SimpleFileStoreFactory(self.d, write_mode=WRITE_DURABLE, sync_interval=0.01)
+        store = factory.add('FOO')
+        store_to = factory.add('BAR')
+
+        def put(i):
+            for j in range(5):
+                store.put('foo{}_{}'.format(i, j), contents='foo')
+
+        threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(store.count(), 40)
+        self.assertEqual(factory.group_sync.writes, 40)
+        self.assertLess(factory.group_sync.syncs, 40)
+
+        store.move('foo0_0', store_to)
+        store.replace('foo0_1', 'bar')
+        self.assertEqual(store.get('foo0_1'), 'bar')
+        self.assertEqual(store_to.list_keys(), ['foo0_0'])
+        self.assertEqual(factory.group_sync.writes, 42)
+        self.assertEqual(factory.group_sync.errors, 0)
+
+
+    def test_group_sync_error(self):
+        group_sync = GroupSync(interval=1.0)
+        t = time.time()
+        group_sync.sync(self.d)
+        self.assertLess(time.time() - t, 0.5)
+
+        with self.assertRaises(FileNotFoundError):
+            group_sync.sync(self.d, os.path.join(self.d, 'nope'))
+        self.assertEqual(group_sync.errors, 1)
+        group_sync.sync(self.d)
+        self.assertEqual(group_sync.syncs, 3)
+
+
 if __name__ == '__main__':
     unittest.main()
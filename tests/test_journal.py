@@ -0,0 +1,187 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+import threading
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+from shep.journal import (
+        Journal,
+        OP_PUT,
+        OP_MOVE,
+        OP_REPLACE,
+        )
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.path = os.path.join(self.d, 'journal')
+        self.factory = SimpleFileStoreFactory(os.path.join(self.d, 'store'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+
+    def test_replay(self):
+        journal = Journal(self.path)
+        journal.append([(OP_PUT, 'abcd', '', 'FOO', 'baz',)])
+        journal.append([
+            (OP_MOVE, 'abcd', 'FOO', 'BAR', None,),
+            (OP_REPLACE, 'abcd', '', 'BAR', b'xyzzy',),
+            ])
+        self.assertEqual(journal.seq, 3)
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(len(journal.pending), 3)
+        self.assertEqual(journal.pending[0], (1, OP_PUT, 'abcd', '', 'FOO', 'baz',))
+        self.assertEqual(journal.pending[2], (3, OP_REPLACE, 'abcd', '', 'BAR', b'xyzzy',))
+
+        r = []
+        journal.start(r.append)
+        self.assertEqual(len(r), 3)
+        self.assertEqual(journal.applied, 3)
+        journal.append([(OP_PUT, 'bcde', '', 'FOO', None,)])
+        journal.drain()
+        self.assertEqual(r[3][0], 4)
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(len(journal.pending), 0)
+        self.assertEqual(journal.seq, 4)
+        journal.close()
+
+
+    def test_torn(self):
+        journal = Journal(self.path)
+        journal.append([(OP_PUT, 'abcd', '', 'FOO', 'baz',)])
+        journal.append([(OP_PUT, 'bcde', '', 'FOO', 'baz',)])
+        journal.close()
+
+        st = os.stat(self.path)
+        os.truncate(self.path, st.st_size - 2)
+
+        journal = Journal(self.path)
+        self.assertEqual(len(journal.pending), 1)
+        self.assertEqual(journal.seq, 1)
+        journal.append([(OP_PUT, 'cdef', '', 'FOO', 'baz',)])
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual([v[2] for v in journal.pending], ['abcd', 'cdef'])
+        journal.close()
+
+
+    def test_durable(self):
+        journal = Journal(self.path)
+        r = []
+        def apply(entry):
+            r.append((entry[0], journal.durable,))
+        journal.start(apply)
+
+        threads = []
+        for i in range(4):
+            t = threading.Thread(target=lambda: [journal.append([(OP_PUT, 'abcd', '', 'FOO', 'baz',)]) for j in range(25)])
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        journal.close()
+
+        self.assertEqual([v[0] for v in r], list(range(1, 101)))
+        for (seq, durable) in r:
+            self.assertGreaterEqual(durable, seq)
+        self.assertEqual(journal.applied, 100)
+
+
+    def test_failure(self):
+        journal = Journal(self.path)
+        def apply(entry):
+            if entry[2] == 'bcde':
+                raise FileNotFoundError(entry[2])
+        journal.start(apply)
+        journal.append([(OP_PUT, 'abcd', '', 'FOO', 'baz',)])
+        journal.append([(OP_MOVE, 'bcde', 'FOO', 'BAR', None,)])
+        journal.append([(OP_PUT, 'cdef', '', 'FOO', 'baz',)])
+        with self.assertRaises(FileNotFoundError):
+            journal.drain()
+        self.assertEqual(journal.applied, 1)
+        with self.assertRaises(FileNotFoundError):
+            journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual([v[2] for v in journal.pending], ['bcde', 'cdef'])
+        journal.close()
+
+
+    def test_persist(self):
+        journal = Journal(self.path)
+        states = PersistedState(self.factory.add, 2, journal=journal)
+        states.add('foo')
+        states.add('bar')
+        states.put('abcd', state=states.FOO, contents='baz')
+        states.move('abcd', states.BAR)
+        states.replace('abcd', 'xyzzy')
+
+        keys = []
+        for i in range(100):
+            k = 'k{}'.format(i)
+            states.put(k)
+            keys.append(k)
+        syncs = journal.syncs
+        states.move_many(keys, states.FOO)
+        self.assertEqual(journal.syncs, syncs + 1)
+
+        states.flush()
+        self.assertEqual(journal.errors, 0)
+        fp = os.path.join(self.d, 'store', 'BAR', 'abcd')
+        f = open(fp, 'r')
+        v = f.read()
+        f.close()
+        self.assertEqual(v, 'xyzzy')
+        self.assertEqual(len(os.listdir(os.path.join(self.d, 'store', 'FOO'))), 100)
+        journal.close()
+
+        states = PersistedState(self.factory.add, 2)
+        states.add('foo')
+        states.add('bar')
+        states.sync()
+        self.assertEqual(states.state('abcd'), states.BAR)
+        self.assertEqual(len(states.list(states.FOO)), 100)
+
+
+    def test_persist_recover(self):
+        journal = Journal(self.path)
+        journal.append([
+            (OP_PUT, 'abcd', '', 'FOO', 'baz',),
+            (OP_PUT, 'bcde', '', 'FOO', None,),
+            (OP_MOVE, 'abcd', 'FOO', 'BAR', None,),
+            ])
+        journal.close()
+
+        journal = Journal(self.path)
+        states = PersistedState(self.factory.add, 2, journal=journal)
+        states.add('foo')
+        states.add('bar')
+        states.sync()
+        self.assertEqual(states.state('abcd'), states.BAR)
+        self.assertEqual(states.get('abcd'), 'baz')
+        self.assertEqual(states.state('bcde'), states.FOO)
+        journal.close()
+
+        # entries that were already applied are skipped on replay
+        os.unlink(self.path + '.applied')
+        journal = Journal(self.path)
+        states = PersistedState(self.factory.add, 2, journal=journal)
+        self.assertEqual(journal.applied, 3)
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+import threading
+import time
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+from shep.store.lock import StripedLock
+from shep.error import StateLockedKey
+
+
+class TestStripedLock(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.path = os.path.join(self.d, '.lock', 'stripes')
+        self.lock = StripedLock(self.path, stripes=16, timeout=1.0)
+
+
+    def tearDown(self):
+        self.lock.close()
+        shutil.rmtree(self.d)
+
+
+    def test_wait(self):
+        self.lock.acquire('abcd')
+        t = threading.Timer(0.05, self.lock.release, args=('abcd',))
+        t.start()
+        self.lock.acquire('abcd')
+        self.lock.release('abcd')
+        t.join()
+        m = self.lock.metrics()
+        self.assertEqual(m['acquired'], 2)
+        self.assertEqual(m['contended'], 1)
+        self.assertGreater(m['wait_time'], 0.01)
+
+        self.lock.timeout = 0
+        self.lock.acquire('abcd')
+        t = threading.Thread(target=self.assertRaises, args=(StateLockedKey, self.lock.acquire, 'abcd',))
+        t.start()
+        t.join()
+        self.lock.release('abcd')
+        self.assertEqual(self.lock.timeouts, 1)
+
+
+    def test_process(self):
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            lock = StripedLock(self.path, stripes=16)
+            lock.acquire('abcd')
+            os.write(w, b'x')
+            time.sleep(0.2)
+            # exit without releasing the lock
+            os._exit(0)
+        os.close(w)
+        os.read(r, 1)
+        os.close(r)
+
+        self.lock.timeout = 0.05
+        with self.assertRaises(StateLockedKey):
+            self.lock.acquire('abcd')
+        self.lock.acquire('bcde')
+        self.lock.release('bcde')
+
+        os.waitpid(pid, 0)
+        self.lock.acquire('abcd')
+        self.lock.release('abcd')
+        self.assertEqual(self.lock.timeouts, 1)
+
+
+    def test_store(self):
+        factory = SimpleFileStoreFactory(self.d, lock_manager=self.lock)
+        states = PersistedState(factory.add, 2)
+        states.add('foo')
+        states.put('abcd', contents='foo')
+        states.move('abcd', states.FOO)
+        self.assertEqual(states.get('abcd'), 'foo')
+        self.assertFalse(os.path.exists(os.path.join(self.d, '.lock', 'abcd')))
+
+        store = factory.add('FOO')
+        with self.assertRaises(FileNotFoundError):
+            store.get('bcde')
+
+        self.lock.timeout = 0.01
+        self.lock.acquire('abcd')
+        t = threading.Thread(target=self.assertRaises, args=(StateLockedKey, states.replace, 'abcd', 'bar',))
+        t.start()
+        t.join()
+        self.lock.release('abcd')
+        states.replace('abcd', 'bar')
+        self.assertEqual(store.get('abcd'), 'bar')
+
+        os.makedirs(os.path.join(self.d, 'FOO', 'bcde'))
+        with self.assertRaises(IsADirectoryError):
+            store.list()
+        os.rmdir(os.path.join(self.d, 'FOO', 'bcde'))
+        self.assertEqual(store.list(), [('abcd', 'bar',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.log import LogStoreFactory
+from shep.error import StateItemNotFound
+
+
+class TestLogStore(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.factory = LogStoreFactory(self.d, compact_interval=None)
+        self.states = PersistedState(self.factory.add, 3)
+        self.states.add('foo')
+        self.states.add('bar')
+        self.states.add('baz')
+
+
+    def tearDown(self):
+        self.factory.close()
+        shutil.rmtree(self.d)
+
+
+    def __reopen(self):
+        self.factory.close()
+        self.factory = LogStoreFactory(self.d, compact_interval=None)
+        states = PersistedState(self.factory.add, 3)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.sync()
+        return states
+
+
+    def test_persist(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        self.states.put('cdef', state=self.states.BAR, contents='bar')
+        self.states.move('abcd', self.states.BAZ)
+        self.states.replace('cdef', 'baz')
+        self.states.move_many(['bcde', 'cdef'], self.states.BAZ)
+
+        store = self.factory.add('BAZ')
+        self.assertEqual(store.get('abcd'), 'foo')
+        self.assertEqual(sorted(store.list_keys()), ['abcd', 'bcde', 'cdef'])
+        self.assertEqual(self.factory.add('FOO').count(), 0)
+        with self.assertRaises(FileNotFoundError):
+            self.factory.add('FOO').move('abcd', store)
+
+        states = self.__reopen()
+        self.assertEqual(states.state('abcd'), states.BAZ)
+        self.assertEqual(states.get('abcd'), 'foo')
+        self.assertEqual(states.get('bcde'), None)
+        self.assertEqual(states.get('cdef'), 'baz')
+        self.assertEqual(self.factory.ls(), ['BAZ'])
+
+
+    def test_move_append(self):
+        self.states.put('abcd', state=self.states.FOO, contents='x' * 1000)
+        end = self.factory.log.end
+        self.states.move('abcd', self.states.BAR)
+        self.assertLess(self.factory.log.end - end, 100)
+
+
+    def test_move_many_append(self):
+        keys = ['foo{}'.format(i) for i in range(99)]
+        for k in keys:
+            self.states.put(k, state=self.states.FOO, contents='x' * 1000)
+        end = self.factory.log.end
+        (r, e) = self.states.move_many(keys + ['nope'], self.states.BAR)
+        self.assertEqual(len(r), 99)
+        self.assertLess(self.factory.log.end - end, 99 * 100)
+        self.assertEqual(self.states.get('foo42'), 'x' * 1000)
+        self.assertEqual(self.factory.add('BAR').get('foo42'), 'x' * 1000)
+
+
+    def test_compact(self):
+        for i in range(10):
+            self.states.put('foo{}'.format(i), state=self.states.FOO, contents='foo' * 100)
+        for i in range(10):
+            self.states.move('foo{}'.format(i), self.states.BAR)
+            self.states.replace('foo{}'.format(i), 'bar')
+        self.assertFalse(self.factory.compact())
+        self.factory.compact_min_size = 0
+        self.assertGreater(self.factory.log.dead(), 0.5)
+        end = self.factory.log.end
+        self.assertTrue(self.factory.compact())
+        self.assertLess(self.factory.log.end, end / 2)
+        self.assertEqual(self.states.get('foo3'), 'bar')
+        self.assertEqual(self.factory.add('BAR').get('foo3'), 'bar')
+
+        self.states.put('abcd', state=self.states.BAZ, contents='baz')
+        states = self.__reopen()
+        self.assertEqual(len(states.list(states.BAR)), 10)
+        self.assertEqual(states.get('abcd'), 'baz')
+
+
+    def test_hint(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.factory.close()
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'hint')))
+
+        # records appended after the hint was written are read from the segment
+        factory = LogStoreFactory(self.d, compact_interval=None)
+        store = factory.add('FOO')
+        store.put('bcde', 'bar')
+        store.move('abcd', factory.add('BAR'))
+        self.factory = LogStoreFactory(self.d, compact_interval=None)
+        self.assertEqual(self.factory.add('BAR').get('abcd'), 'foo')
+        self.assertEqual(self.factory.add('FOO').list_keys(), ['bcde'])
+        self.factory.close()
+        factory.close()
+
+        f = open(os.path.join(self.d, 'hint'), 'r+b')
+        f.seek(30)
+        f.write(b'\xff')
+        f.close()
+        states = self.__reopen()
+        self.assertEqual(states.state('abcd'), states.BAR)
+        self.assertEqual(states.get('bcde'), 'bar')
+
+
+    def test_torn(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.states.put('bcde', state=self.states.FOO, contents='bar')
+        self.factory.close()
+        os.unlink(os.path.join(self.d, 'hint'))
+        fp = os.path.join(self.d, 'segment')
+        os.truncate(fp, os.stat(fp).st_size - 2)
+
+        states = self.__reopen()
+        self.assertEqual(states.get('abcd'), 'foo')
+        with self.assertRaises(StateItemNotFound):
+            states.state('bcde')
+
+
+if __name__ == '__main__':
+    unittest.main()
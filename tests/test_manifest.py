@@ -0,0 +1,114 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+from shep.store.noop import NoopStoreFactory
+from shep.manifest import (
+        encode,
+        decode,
+        )
+from shep.error import StateCorruptionError
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.factory = SimpleFileStoreFactory(self.d)
+        self.states = PersistedState(self.factory.add, 8)
+        self.states.add('foo')
+        self.states.add('bar')
+        self.states.add('baz')
+        self.states.alias('xyzzy', self.states.FOO | self.states.BAZ)
+        self.states.put('abcd', state=self.states.XYZZY, contents='foo')
+        self.states.put('bcde', state=self.states.BAR)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+
+    def test_encode(self):
+        schema = self.states.schema()
+        manifest = decode(encode(schema, serial=42))
+        self.assertEqual(manifest['serial'], 42)
+        self.assertEqual(manifest['states'], schema['states'])
+
+        b = encode(schema).replace(b'XYZZY', b'PLUGH')
+        with self.assertRaises(StateCorruptionError):
+            decode(b)
+
+
+    def test_from_manifest(self):
+        with self.assertRaises(FileNotFoundError):
+            PersistedState.from_manifest(self.factory)
+        self.assertEqual(self.states.write_manifest(self.factory), 0)
+        self.assertEqual(self.states.write_manifest(self.factory), 1)
+
+        states = PersistedState.from_manifest(self.factory)
+        self.assertEqual(states.schema(), self.states.schema())
+        self.assertEqual(states.manifest_serial, 1)
+        states.sync()
+        self.assertEqual(states.state('abcd'), states.XYZZY)
+        self.assertEqual(states.get('abcd'), 'foo')
+        self.assertEqual(states.list(states.BAR), ['bcde'])
+
+
+    def test_alias_order(self):
+        factory = SimpleFileStoreFactory(os.path.join(self.d, 'other'))
+        states = PersistedState(factory.add, 8, check_alias=False)
+        states.add('foo')
+        states.add('bar')
+        states.alias('xy', states.FOO | states.BAR)
+        states.add('baz')
+        states.put('abcd', state=states.FOO)
+        # creates the alias FOO__BAZ
+        states.set('abcd', states.BAZ)
+        states.write_manifest(factory)
+
+        restored = PersistedState.from_manifest(factory, check_alias=False)
+        self.assertEqual(restored.schema(), states.schema())
+        self.assertEqual(restored.BAZ, states.BAZ)
+        self.assertEqual(restored._FOO__BAZ, states._FOO__BAZ)
+        restored.sync(ignore_auto=False)
+        self.assertEqual(restored.state('abcd'), states.FOO | states.BAZ)
+        self.assertFalse(restored.manifest_drift())
+        restored.put('bcde', state=restored.BAZ)
+        self.assertTrue(os.path.exists(os.path.join(self.d, 'other', 'BAZ', 'bcde')))
+
+
+    def test_default_state(self):
+        factory = NoopStoreFactory()
+        states = PersistedState(factory.add, 2, default_state='start')
+        states.add('foo')
+        states.write_manifest(factory)
+        states = PersistedState.from_manifest(factory)
+        self.assertEqual(states.base_state_name, 'START')
+        self.assertEqual(states.FOO, 1)
+
+
+    def test_drift(self):
+        self.states.write_manifest(self.factory)
+        states = PersistedState.from_manifest(self.factory)
+        self.assertFalse(states.manifest_drift())
+
+        self.states.add('qux')
+        self.states.write_manifest(self.factory)
+        self.assertTrue(states.manifest_drift())
+        self.assertFalse(states.manifest_drift(apply=True))
+        self.assertEqual(states.QUX, self.states.QUX)
+
+        self.states.add('quux')
+        states.add('plugh')
+        self.states.write_manifest(self.factory)
+        with self.assertRaises(StateCorruptionError):
+            states.manifest_drift(apply=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,5 +52,42 @@ class TestStateReport(unittest.TestCase):
         self.assertIsNone(r[0])
 
 
+    def test_all(self):
+        r = self.states.all()
+        self.assertEqual(r, ('BAR', 'BAZ', 'FOO', 'NEW',))
+        self.assertIs(self.states.all(), r)
+
+        r = self.states.all(numeric=True)
+        self.assertEqual(r, (0, 1, 2, 4,))
+
+        self.states.alias('xyzzy', self.states.FOO | self.states.BAZ)
+        r = self.states.all()
+        self.assertEqual(r, ('BAR', 'BAZ', 'FOO', 'NEW', 'XYZZY',))
+
+        r = self.states.all(pure=True)
+        self.assertEqual(r, ('BAR', 'BAZ', 'FOO', 'NEW',))
+
+
+    def test_all_auto(self):
+        states = State(3, check_alias=False)
+        states.add('foo')
+        states.add('bar')
+        states.put('abcd', state=states.FOO | states.BAR)
+        r = states.all()
+        self.assertEqual(r, ('BAR', 'FOO', 'NEW',))
+        r = states.all(ignore_auto=False)
+        self.assertEqual(r, ('BAR', 'FOO', 'NEW', '_FOO__BAR',))
+
+
+    def test_from_name(self):
+        self.assertEqual(self.states.from_name('FOO'), self.states.FOO)
+        self.assertEqual(self.states.from_name('foo'), self.states.FOO)
+        self.assertEqual(self.states.from_name('NEW'), 0)
+        with self.assertRaises(ValueError):
+            self.states.from_name('f0o')
+        with self.assertRaises(AttributeError):
+            self.states.from_name('xyzzy')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,172 @@
+# standard imports
+import unittest
+import tempfile
+import shutil
+import os
+import time
+
+# local imports
+from shep import State
+from shep.compact import CompactState
+from shep.persist import PersistedState
+from shep.store.file import (
+        SimpleFileStore,
+        SimpleFileStoreFactory,
+        )
+from shep.error import (
+        StateCorruptionError,
+        StateItemNotFound,
+        )
+
+
+# store that cannot move keys without reading them, and writes empty contents when told the keys have none.
+class BlindMoveStore(SimpleFileStore):
+
+    def move_keys(self, ks, to_store, contents=True):
+        if contents:
+            return super(BlindMoveStore, self).move_keys(ks, to_store)
+        for k in ks:
+            to_store.put(k)
+            self.remove(k)
+        return {}
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.path = os.path.join(self.d, 'snapshot')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+
+    def setup_states(self, cls):
+        states = cls(3, check_alias=False)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.alias('xyzzy', states.FOO, states.BAR)
+        states.put('abcd', contents='foo')
+        states.put(b'bcde', state=states.FOO, contents=b'bar')
+        states.put('cdef', state=states.XYZZY)
+        states.put('defg', state=states.BAR | states.BAZ)
+        states.put('efgh')
+        states.purge('efgh')
+        return states
+
+
+    def test_roundtrip(self):
+        for cls in [State, CompactState]:
+            states = self.setup_states(cls)
+            states.snapshot(self.path, contents=True)
+
+            restored = cls(3, check_alias=False)
+            r = restored.restore(self.path)
+            self.assertTrue(r.contents)
+            self.assertEqual(restored.XYZZY, states.XYZZY)
+            self.assertEqual(restored._BAR__BAZ, states.BAR | states.BAZ)
+            self.assertEqual(restored.all(ignore_auto=False), states.all(ignore_auto=False))
+            for k in ['abcd', b'bcde', 'cdef', 'defg']:
+                self.assertEqual(restored.state(k), states.state(k))
+                self.assertEqual(restored.get(k), states.get(k))
+                self.assertEqual(restored.modified(k), states.modified(k))
+            with self.assertRaises(StateItemNotFound):
+                restored.state('efgh')
+            self.assertEqual(restored.list(states.FOO), states.list(states.FOO))
+            self.assertEqual(restored.count_by_state(), states.count_by_state())
+
+
+    def test_no_contents(self):
+        states = self.setup_states(State)
+        states.snapshot(self.path)
+        restored = State(3)
+        r = restored.restore(self.path)
+        self.assertFalse(r.contents)
+        self.assertIsNone(restored.get('abcd'))
+        self.assertEqual(restored.state('cdef'), restored.XYZZY)
+
+
+    def test_alias_order(self):
+        states = State(5)
+        states.add('foo')
+        states.add('bar')
+        states.alias('xy', states.FOO | states.BAR)
+        states.add('baz')
+        states.put('abcd', state=states.BAZ)
+        states.snapshot(self.path)
+
+        restored = State(5)
+        restored.restore(self.path)
+        self.assertEqual(restored.BAZ, states.BAZ)
+        self.assertEqual(restored.XY, states.XY)
+        self.assertEqual(restored.state('abcd'), states.BAZ)
+        self.assertEqual(restored.add('qux'), states.add('qux'))
+
+
+    def test_schema_conflict(self):
+        states = self.setup_states(State)
+        states.snapshot(self.path)
+        restored = State(3)
+        restored.add('bar')
+        with self.assertRaises(StateCorruptionError):
+            restored.restore(self.path)
+
+
+    def test_persisted(self):
+        store_path = os.path.join(self.d, 'store')
+        factory = SimpleFileStoreFactory(store_path)
+        states = PersistedState(factory.add, 3)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.put('abcd', contents='foo')
+        states.put('bcde', state=states.FOO, contents='bar')
+        states.put('cdef', state=states.FOO)
+        states.put('defg', state=states.BAR, contents='baz')
+        states.snapshot(self.path, contents=True)
+
+        # changes by another process after the snapshot
+        time.sleep(0.01)
+        states.move('bcde', states.BAZ)
+        states.replace('defg', 'xyzzy')
+        os.unlink(os.path.join(store_path, 'FOO', 'cdef'))
+        f = open(os.path.join(store_path, 'BAR', 'efgh'), 'w')
+        f.write('plugh')
+        f.close()
+
+        restored = PersistedState(factory.add, 3)
+        restored.restore(self.path)
+        self.assertEqual(restored.state('abcd'), restored.NEW)
+        self.assertEqual(restored.get('abcd'), 'foo')
+        self.assertEqual(restored.state('bcde'), restored.BAZ)
+        self.assertEqual(restored.get('bcde'), 'bar')
+        self.assertEqual(restored.get('defg'), 'xyzzy')
+        self.assertEqual(restored.state('efgh'), restored.BAR)
+        self.assertEqual(restored.get('efgh'), 'plugh')
+        with self.assertRaises(StateItemNotFound):
+            restored.state('cdef')
+        self.assertEqual(restored.list(restored.FOO), [])
+
+
+    def test_persisted_no_contents(self):
+        store_path = os.path.join(self.d, 'store')
+        factory = lambda k: BlindMoveStore(os.path.join(store_path, k))
+        states = PersistedState(factory, 3)
+        states.add('foo')
+        states.put('abcd', contents='foo')
+        states.put('bcde')
+        states.snapshot(self.path)
+
+        restored = PersistedState(factory, 3)
+        restored.restore(self.path, sync=False)
+        restored.move('abcd', restored.FOO)
+        restored.move('bcde', restored.FOO)
+        store = factory('FOO')
+        self.assertEqual(store.get('abcd'), 'foo')
+        self.assertEqual(store.get('bcde'), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -314,6 +314,20 @@ class TestState(unittest.TestCase):
         self.assertTrue(v)
 
 
+    def test_pure_unregistered(self):
+        states = State(3)
+        states.add('foo')
+        self.assertTrue(states.is_pure(states.NEW))
+        self.assertTrue(states.is_pure(states.FOO))
+        self.assertFalse(states.is_pure(2))
+        self.assertFalse(states.is_pure(8))
+        self.assertFalse(states.is_pure(1 << 64))
+
+        states.put('abcd')
+        with self.assertRaises(ValueError):
+            states.set('abcd', 2)
+
+
     def test_default(self):
         states = State(2, default_state='FOO')
         with self.assertRaises(StateItemNotFound):
@@ -381,5 +395,217 @@ class TestState(unittest.TestCase):
         self.assertEqual(states.state('foo'), states._ONE__TWO)
 
 
+    def test_move_from_alias_cleanup(self):
+        states = State(3)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.alias('xyzzy', states.BAR, states.BAZ)
+        states.put('abcd', state=states.XYZZY)
+        states.put('bcde', state=states.XYZZY)
+        states.move('abcd', states.FOO)
+        self.assertEqual(states.list(states.XYZZY), ['bcde'])
+        self.assertEqual(states.list(states.BAR), ['bcde'])
+        self.assertEqual(states.list(states.FOO), ['abcd'])
+
+        states.purge('bcde')
+        self.assertEqual(states.list(states.XYZZY), [])
+        self.assertEqual(states.list(states.BAZ), [])
+
+
+    def test_list_order(self):
+        states = State(1)
+        states.add('foo')
+        for k in ['c', 'a', 'b', 'd']:
+            states.put(k)
+        states.move('a', states.FOO)
+        self.assertEqual(states.list(states.NEW), ['c', 'b', 'd'])
+        states.move('a', states.NEW)
+        self.assertEqual(states.list(states.NEW), ['c', 'b', 'd', 'a'])
+
+
+    def test_move_many(self):
+        states = State(3)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.alias('xyzzy', states.FOO, states.BAR)
+        for k in ['abcd', 'bcde', 'cdef']:
+            states.put(k)
+
+        (r, e) = states.move_many(['abcd', 'bcde', 'xxxx'], states.FOO)
+        self.assertEqual(r, {'abcd': states.FOO, 'bcde': states.FOO})
+        self.assertIsInstance(e['xxxx'], StateItemNotFound)
+        self.assertEqual(states.list(states.FOO), ['abcd', 'bcde'])
+
+        with self.assertRaises(StateInvalid):
+            states.move_many(['abcd'], states.FOO | states.BAZ)
+
+        (r, e) = states.move_many({'abcd': states.BAR, 'cdef': states.FOO | states.BAZ})
+        self.assertEqual(r, {'abcd': states.BAR})
+        self.assertIsInstance(e['cdef'], StateInvalid)
+
+
+    def test_set_unset_many(self):
+        states = State(3)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.alias('xyzzy', states.FOO, states.BAR)
+        states.put('abcd', state=states.FOO)
+        states.put('bcde', state=states.FOO)
+        states.put('cdef', state=states.BAZ)
+
+        with self.assertRaises(ValueError):
+            states.set_many(['abcd'], states.XYZZY)
+
+        (r, e) = states.set_many(['abcd', 'bcde', 'cdef'], states.BAR)
+        self.assertEqual(r, {'abcd': states.XYZZY, 'bcde': states.XYZZY})
+        self.assertIsInstance(e['cdef'], StateInvalid)
+        self.assertEqual(states.modified('abcd'), states.modified('bcde'))
+
+        (r, e) = states.unset_many(['abcd', 'bcde', 'cdef'], states.FOO)
+        self.assertEqual(r, {'abcd': states.BAR, 'bcde': states.BAR})
+        self.assertIsInstance(e['cdef'], ValueError)
+        self.assertEqual(states.list(states.XYZZY), [])
+
+        (r, e) = states.change_many(['abcd', 'bcde'], states.FOO, states.BAR)
+        self.assertEqual(r, {'abcd': states.FOO, 'bcde': states.FOO})
+        self.assertEqual(len(e), 0)
+
+
+    def test_query(self):
+        states = State(3)
+        states.add('doing')
+        states.add('blocked')
+        states.add('review')
+        states.alias('doingblocked', states.DOING, states.BLOCKED)
+        states.alias('doingreview', states.DOING, states.REVIEW)
+        states.put('abcd')
+        states.put('bcde', state=states.DOING)
+        states.put('cdef', state=states.DOINGBLOCKED)
+        states.put('defg', state=states.DOINGREVIEW)
+        states.put('efgh', state=states.BLOCKED)
+
+        r = list(states.query(required=states.DOING, forbidden=states.BLOCKED))
+        self.assertEqual(r, ['bcde', 'defg'])
+
+        r = list(states.query(required=states.DOING | states.BLOCKED))
+        self.assertEqual(r, ['cdef'])
+
+        r = list(states.query(optional=states.BLOCKED | states.REVIEW))
+        self.assertEqual(len(r), 3)
+        for k in ['cdef', 'defg', 'efgh']:
+            self.assertIn(k, r)
+
+        r = list(states.query(optional=states.BLOCKED | states.REVIEW, forbidden=states.DOING))
+        self.assertEqual(r, ['efgh'])
+
+        r = list(states.query(forbidden=states.DOING))
+        self.assertEqual(r, ['abcd', 'efgh'])
+
+        r = list(states.query())
+        self.assertEqual(len(r), 5)
+
+        r = list(states.query(required=states.BLOCKED, forbidden=states.BLOCKED))
+        self.assertEqual(r, [])
+
+        r = list(states.query(optional=states.BLOCKED, forbidden=states.BLOCKED))
+        self.assertEqual(r, [])
+
+        self.assertTrue(states.matches(states.DOINGREVIEW, required=states.DOING, optional=states.REVIEW | states.BLOCKED))
+        self.assertFalse(states.matches(states.DOING, required=states.DOING, optional=states.REVIEW | states.BLOCKED))
+
+
+    def test_count_by_state(self):
+        states = State(3)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.alias('xyzzy', states.FOO, states.BAR)
+        states.put('abcd')
+        states.put('bcde')
+        states.put('cdef', state=states.FOO)
+        states.put('defg', state=states.XYZZY)
+
+        r = states.count_by_state()
+        self.assertEqual(r, {states.NEW: 2, states.FOO: 1, states.XYZZY: 1})
+
+        states.move('abcd', states.FOO)
+        states.set('cdef', states.BAR)
+        states.purge('defg')
+        r = states.count_by_state()
+        self.assertEqual(r, {states.NEW: 1, states.FOO: 1, states.XYZZY: 1})
+
+        r = states.histogram()
+        self.assertEqual(r, {'NEW': 1, 'FOO': 1, 'BAR': 0, 'BAZ': 0, 'XYZZY': 1})
+
+        r = states.histogram(aliases=False)
+        self.assertNotIn('XYZZY', r)
+
+        r = states.histogram(pure=False)
+        self.assertEqual(r, {'XYZZY': 1})
+
+
+    def test_now(self):
+        states = State(1)
+        a = states.now()
+        for i in range(1000):
+            b = states.now()
+            self.assertGreater(b, a)
+            a = b
+
+
+    def test_modified_since(self):
+        for time_index in [False, True]:
+            states = State(2, time_index=time_index)
+            states.add('foo')
+            states.add('bar')
+            states.put('abcd')
+            states.put('bcde')
+            ts = states.now()
+            states.put('cdef')
+            states.move('abcd', states.FOO)
+            self.assertEqual(states.modified_since(ts), ['cdef', 'abcd'])
+            self.assertEqual(states.modified_since(ts, state=states.NEW), ['cdef'])
+            self.assertEqual(states.modified_since(ts, state=states.FOO), ['abcd'])
+            self.assertEqual(states.modified_since(0, state=states.NEW), ['bcde', 'cdef'])
+
+            states.move('abcd', states.BAR)
+            self.assertEqual(states.modified_since(ts), ['cdef', 'abcd'])
+            self.assertEqual(states.modified_since(ts, state=states.FOO), [])
+
+            states.purge('cdef')
+            self.assertEqual(states.modified_since(ts), ['abcd'])
+
+            # keys of a batch share a timestamp, and only the time index keeps their order.
+            states.move_many(['bcde', 'abcd'], states.FOO)
+            r = states.modified_since(ts, state=states.FOO)
+            self.assertEqual(sorted(r), ['abcd', 'bcde'])
+            if time_index:
+                self.assertEqual(r, ['bcde', 'abcd'])
+
+
+    def test_oldest(self):
+        for time_index in [False, True]:
+            states = State(2, time_index=time_index)
+            states.add('foo')
+            for i in range(200):
+                states.put(str(i))
+            self.assertEqual(states.oldest(states.NEW, n=3), ['0', '1', '2'])
+            self.assertEqual(states.oldest(states.FOO), [])
+
+            for i in range(150):
+                states.move(str(i), states.FOO)
+            self.assertEqual(states.oldest(states.NEW, n=2), ['150', '151'])
+            self.assertEqual(states.oldest(states.FOO, n=2), ['0', '1'])
+
+            states.move('0', states.NEW)
+            self.assertEqual(states.oldest(states.FOO, n=1), ['1'])
+            r = states.oldest(states.NEW, n=100)
+            self.assertEqual(len(r), 51)
+            self.assertEqual(r[-1], '0')
+
+
 if __name__ == '__main__':
     unittest.main()
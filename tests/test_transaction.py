@@ -0,0 +1,197 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+from shep.journal import (
+        Journal,
+        OP_MOVE,
+        )
+from shep.error import StateTransitionInvalid
+
+
+def mock_verify(state, key, from_state, to_state):
+    if key == 'locked' and to_state == state.BAR:
+        return 'locked cannot move to bar'
+
+
+class TestTransaction(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.factory = SimpleFileStoreFactory(self.d)
+        self.states = PersistedState(self.factory.add, 3, verifier=mock_verify)
+        self.states.add('foo')
+        self.states.add('bar')
+        self.states.add('baz')
+        self.states.alias('xyzzy', self.states.FOO | self.states.BAZ)
+        self.states.put('parent', state=self.states.FOO, contents='parent')
+        self.states.put('child', state=self.states.FOO)
+        self.states.put('locked', state=self.states.FOO)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.d)
+
+
+    def __exists(self, state, key):
+        return os.path.exists(os.path.join(self.d, state, key))
+
+
+    def test_commit(self):
+        with self.states.transaction():
+            self.states.move('parent', self.states.BAR)
+            self.states.set('child', self.states.BAZ)
+            self.states.replace('parent', 'done')
+            self.states.put('new', state=self.states.FOO, contents='new')
+            self.states.move('new', self.states.BAR)
+            self.assertTrue(self.__exists('FOO', 'parent'))
+            self.assertFalse(self.__exists('BAR', 'new'))
+
+        self.assertEqual(self.states.state('parent'), self.states.BAR)
+        self.assertFalse(self.__exists('FOO', 'parent'))
+        self.assertFalse(self.__exists('FOO', 'new'))
+        self.assertTrue(self.__exists('XYZZY', 'child'))
+
+        f = open(os.path.join(self.d, 'BAR', 'parent'), 'r')
+        v = f.read()
+        f.close()
+        self.assertEqual(v, 'done')
+
+        f = open(os.path.join(self.d, 'BAR', 'new'), 'r')
+        v = f.read()
+        f.close()
+        self.assertEqual(v, 'new')
+
+
+    def test_rollback_verify(self):
+        with self.assertRaises(StateTransitionInvalid):
+            with self.states.transaction():
+                self.states.put('new')
+                self.states.move('parent', self.states.BAR)
+                self.states.replace('parent', 'done')
+                self.states.move('child', self.states.BAR)
+                self.states.move('locked', self.states.BAR)
+
+        self.assertEqual(self.states.state('parent'), self.states.FOO)
+        self.assertEqual(self.states.get('parent'), 'parent')
+        self.assertEqual(self.states.state('child'), self.states.FOO)
+        self.assertEqual(self.states.list(self.states.BAR), [])
+        self.assertNotIn('new', self.states.list(self.states.NEW))
+        self.assertTrue(self.__exists('FOO', 'parent'))
+        self.assertFalse(self.__exists('NEW', 'new'))
+
+
+    def test_rollback_store(self):
+        os.unlink(os.path.join(self.d, 'FOO', 'locked'))
+        with self.assertRaises(FileNotFoundError):
+            with self.states.transaction():
+                self.states.move('parent', self.states.BAZ)
+                self.states.replace('parent', 'done')
+                self.states.move('child', self.states.BAZ)
+                self.states.move('locked', self.states.BAZ)
+
+        self.assertEqual(self.states.state('parent'), self.states.FOO)
+        self.assertEqual(self.states.get('parent'), 'parent')
+        self.assertEqual(self.states.state('child'), self.states.FOO)
+        self.assertTrue(self.__exists('FOO', 'parent'))
+        self.assertTrue(self.__exists('FOO', 'child'))
+        self.assertEqual(os.listdir(os.path.join(self.d, 'BAZ')), [])
+
+        f = open(os.path.join(self.d, 'FOO', 'parent'), 'r')
+        v = f.read()
+        f.close()
+        self.assertEqual(v, 'parent')
+
+
+    def test_nested(self):
+        with self.states.transaction():
+            with self.states.transaction():
+                self.states.move('parent', self.states.BAR)
+            self.assertTrue(self.__exists('FOO', 'parent'))
+            self.states.move_many(['child', 'locked'], self.states.BAZ)
+        self.assertTrue(self.__exists('BAR', 'parent'))
+        self.assertTrue(self.__exists('BAZ', 'child'))
+        self.assertTrue(self.__exists('BAZ', 'locked'))
+
+
+    def test_journal(self):
+        journal = Journal(os.path.join(self.d, 'journal'))
+        states = PersistedState(self.factory.add, 3, journal=journal)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.put('parent', state=states.FOO, contents='parent')
+        states.put('child', state=states.FOO)
+
+        syncs = journal.syncs
+        with states.transaction():
+            states.move('parent', states.BAR)
+            states.move('child', states.BAR)
+            states.replace('child', 'child')
+        self.assertEqual(journal.syncs, syncs + 1)
+
+        states.flush()
+        journal.close()
+        self.assertTrue(self.__exists('BAR', 'parent'))
+        f = open(os.path.join(self.d, 'BAR', 'child'), 'r')
+        v = f.read()
+        f.close()
+        self.assertEqual(v, 'child')
+
+
+    def test_tx_journal(self):
+        path = os.path.join(self.d, 'tx')
+        journal = Journal(path)
+        states = PersistedState(self.factory.add, 3, tx_journal=journal)
+        states.add('foo')
+        states.add('bar')
+        states.add('baz')
+        states.sync()
+        with states.transaction():
+            states.move('parent', states.BAR)
+            states.move('child', states.BAR)
+        self.assertTrue(self.__exists('BAR', 'parent'))
+        self.assertEqual(journal.applied, journal.seq)
+        journal.close()
+
+        # crash after the journal was written, before the operations were performed.
+        journal = Journal(path)
+        journal.append([
+            (OP_MOVE, 'parent', 'BAR', 'BAZ', None,),
+            (OP_MOVE, 'child', 'BAR', 'BAZ', None,),
+            ], atomic=True)
+        journal.close()
+
+        journal = Journal(path)
+        states = PersistedState(self.factory.add, 3, tx_journal=journal)
+        self.assertTrue(self.__exists('BAZ', 'parent'))
+        self.assertTrue(self.__exists('BAZ', 'child'))
+        self.assertEqual(len(journal.pending), 0)
+        journal.close()
+
+
+    def test_tx_journal_torn(self):
+        path = os.path.join(self.d, 'tx')
+        journal = Journal(path)
+        journal.append([
+            (OP_MOVE, 'parent', 'FOO', 'BAR', None,),
+            (OP_MOVE, 'child', 'FOO', 'BAR', None,),
+            ], atomic=True)
+        journal.close()
+        os.truncate(path, os.stat(path).st_size - 2)
+
+        journal = Journal(path)
+        self.assertEqual(len(journal.pending), 0)
+        states = PersistedState(self.factory.add, 3, tx_journal=journal)
+        self.assertTrue(self.__exists('FOO', 'parent'))
+        self.assertTrue(self.__exists('FOO', 'child'))
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# standard imports
+import unittest
+import tempfile
+import os
+import shutil
+import time
+
+# local imports
+from shep.persist import PersistedState
+from shep.store.file import SimpleFileStoreFactory
+from shep.writebehind import WriteBehind
+from shep.error import (
+        StateLockedKey,
+        StateWriteError,
+        )
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.factory = SimpleFileStoreFactory(self.d)
+        self.buffer = WriteBehind(interval=3600, size=1000000)
+        self.states = PersistedState(self.factory.add, 3, write_behind=self.buffer)
+        self.states.add('foo')
+        self.states.add('bar')
+        self.states.add('baz')
+
+
+    def tearDown(self):
+        self.buffer.close()
+        shutil.rmtree(self.d)
+
+
+    def __read(self, state, key):
+        fp = os.path.join(self.d, state, key)
+        f = open(fp, 'r')
+        v = f.read()
+        f.close()
+        return v
+
+
+    def test_coalesce(self):
+        self.states.put('abcd', contents='foo')
+        self.states.put('bcde', state=self.states.FOO)
+        self.states.flush()
+        self.assertEqual(self.__read('NEW', 'abcd'), 'foo')
+
+        self.states.move('abcd', self.states.FOO)
+        self.states.move('abcd', self.states.BAR)
+        self.states.replace('abcd', 'bar')
+        self.states.move('abcd', self.states.BAZ)
+        self.states.move('bcde', self.states.BAR)
+        self.states.move('bcde', self.states.FOO)
+        self.assertEqual(len(self.buffer), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.d, 'BAZ', 'abcd')))
+
+        self.states.flush()
+        self.assertEqual(self.__read('BAZ', 'abcd'), 'bar')
+        self.assertFalse(os.path.exists(os.path.join(self.d, 'NEW', 'abcd')))
+        self.assertFalse(os.path.exists(os.path.join(self.d, 'BAR', 'abcd')))
+        self.assertEqual(self.__read('FOO', 'bcde'), '')
+
+        r = self.buffer.metrics()
+        self.assertEqual(r['depth'], 0)
+        self.assertEqual(r['flushes'], 2)
+        self.assertEqual(r['written'], 4)
+        self.assertEqual(r['coalesced'], 4)
+        self.assertEqual(r['errors'], 0)
+
+
+    def test_many(self):
+        keys = []
+        for i in range(100):
+            k = 'k{}'.format(i)
+            self.states.put(k)
+            keys.append(k)
+        self.states.move_many(keys, self.states.FOO)
+        self.assertEqual(len(self.buffer), 100)
+        self.states.flush()
+        self.assertEqual(len(os.listdir(os.path.join(self.d, 'FOO'))), 100)
+        self.assertEqual(len(os.listdir(os.path.join(self.d, 'NEW'))), 0)
+
+
+    def test_size(self):
+        self.buffer.close()
+        self.buffer = WriteBehind(interval=3600, size=10)
+        self.states = PersistedState(self.factory.add, 3, write_behind=self.buffer)
+        for i in range(10):
+            self.states.put('k{}'.format(i))
+        for i in range(100):
+            if len(self.buffer) == 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertEqual(len(os.listdir(os.path.join(self.d, 'NEW'))), 10)
+
+
+    def test_retry(self):
+        calls = []
+        def write(entries):
+            calls.append(dict(entries))
+            if len(calls) == 1:
+                return {'abcd': StateLockedKey('abcd')}
+            return {}
+
+        buffer = WriteBehind(interval=3600)
+        buffer.start(write)
+        buffer.move('abcd', 'FOO', 'BAR')
+        buffer.flush()
+        buffer.move('abcd', 'BAR', 'BAZ')
+        buffer.close()
+        self.assertEqual(calls[1]['abcd'][:2], ['FOO', 'BAZ'])
+
+
+    def test_partial(self):
+        os.makedirs(os.path.join(self.d, 'NEW', 'bcde'))
+        self.states.put('abcd', contents='foo')
+        self.states.put('bcde', contents='bar')
+        self.states.put('cdef', contents='baz')
+        with self.assertRaises(StateWriteError) as e:
+            self.states.flush()
+        self.assertEqual(list(e.exception.failed.keys()), ['bcde'])
+        self.assertEqual(self.__read('NEW', 'abcd'), 'foo')
+        self.assertEqual(self.__read('NEW', 'cdef'), 'baz')
+
+        r = self.buffer.metrics()
+        self.assertEqual(r['written'], 2)
+        self.assertEqual(r['errors'], 1)
+        self.assertEqual(r['depth'], 1)
+
+        os.rmdir(os.path.join(self.d, 'NEW', 'bcde'))
+        self.states.flush()
+        self.assertEqual(self.__read('NEW', 'bcde'), 'bar')
+        self.assertEqual(len(self.buffer), 0)
+
+
+    def test_close(self):
+        self.states.put('abcd', state=self.states.FOO, contents='foo')
+        self.buffer.close()
+        self.assertEqual(self.__read('FOO', 'abcd'), 'foo')
+
+
+if __name__ == '__main__':
+    unittest.main()